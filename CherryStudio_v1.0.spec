@@ -1,5 +1,10 @@
 # -*- mode: python ; coding: utf-8 -*-
+import os
 
+# 离线BPE词表由 python -m src.fetch_tokenizer 获取并校验，随src目录打包；缺失时拒绝打包，避免发布只能近似计数的版本
+TOKENIZER_JSON = 'F:\\cherrystudio-python\\src\\tokenizers\\deepseek\\tokenizer.json'
+if not os.path.exists(TOKENIZER_JSON):
+    raise SystemExit(f'缺少离线词表 {TOKENIZER_JSON}，请先运行 python -m src.fetch_tokenizer')
 
 a = Analysis(
     ['F:\\cherrystudio-python\\main.py'],
@@ -0,0 +1,32 @@
+import asyncio
+
+from PySide6.QtCore import Signal
+
+from .http_pool import get_shared_pool
+from .request_engine import AsyncJob
+
+
+class APIKeyTestJob(AsyncJob):
+    """在请求引擎上发送一条测试消息，检查API密钥和Base URL是否可用；结果经信号排队送回界面线程"""
+    result_ready = Signal(str, str)  # 结果(success/error/timeout), AI回复或错误信息
+
+    def __init__(self, api_key: str, base_url: str, model: str = "deepseek-chat", timeout: float = 10.0):
+        super().__init__()
+        self.api_key = api_key
+        self.base_url = base_url
+        self.model = model
+        self.timeout = timeout
+
+    async def run(self):
+        try:
+            client = get_shared_pool().async_client(self.base_url, self.api_key)
+            response = await asyncio.wait_for(client.chat.completions.create(
+                model=self.model,
+                messages=[{"role": "user", "content": "测试消息，请回复'连接成功'"}],
+                max_tokens=10
+            ), self.timeout)
+            self.result_ready.emit("success", response.choices[0].message.content or "")
+        except asyncio.TimeoutError:
+            self.result_ready.emit("timeout", "")
+        except Exception as e:
+            self.result_ready.emit("error", str(e))
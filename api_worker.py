@@ -1,12 +1,21 @@
+import asyncio
+import time
 from datetime import datetime
 from typing import Optional
-from PySide6.QtCore import QThread, Signal
+from PySide6.QtCore import Signal
+from .endpoint_router import get_shared_router, is_endpoint_failure
+from .hedging import get_shared_hedger, hedged_open
+from .http_pool import get_shared_pool
 from .llm_adapters import LLMAdapter, LLMConfig, LLMProvider
-from .token_calculator import TokenCalculator
+from .rate_limiter import get_shared_limiter
+from .request_engine import AsyncJob
+from .retry_policy import RetryPolicy, describe_error
+from .token_calculator import get_shared_calculator
+from .usage_calibration import AttemptUsage, UsageCalibrator
 from .api_key_manager import DEFAULT_BASE_URL
 
-class APIWorker(QThread):
-    """API调用工作线程"""
+class APIWorker(AsyncJob):
+    """API调用任务，在共享的请求引擎上以协程运行"""
     response_received = Signal(str, dict)
     stream_chunk_received = Signal(str, str)
     error_occurred = Signal(str)
@@ -14,17 +23,36 @@ class APIWorker(QThread):
     progress_updated = Signal(str)
     token_usage_updated = Signal(int, int, int)  # 输入token, 输出token, 总token
     thinking_process_updated = Signal(str)  # 新增：思考过程更新信号
+    retry_scheduled = Signal(int, float, str)  # 第几次重试, 等待秒数, 原因
+    stream_reset = Signal()  # 无法续写时从头重新生成，界面应清空已显示的内容
     
     def __init__(self, api_key, messages, model="deepseek-chat", stream=False, 
-                 base_url=DEFAULT_BASE_URL, provider: Optional[str] = None):
+                 base_url=DEFAULT_BASE_URL, provider: Optional[str] = None,
+                 input_tokens: Optional[int] = None, usage_calibrator: Optional[UsageCalibrator] = None,
+                 retry_policy: Optional[RetryPolicy] = None):
         super().__init__()
+        self.finished.connect(self.finished_signal)
         self.api_key = api_key
         self.messages = messages
         self.model = model
         self.stream = stream
-        self.base_url = base_url
+        # 同一服务配置了备用端点时，从当前最快的健康端点开始，失败后依次切换
+        self.endpoint_router = get_shared_router()
+        self.endpoints = self.endpoint_router.ordered(base_url)
+        self.base_url = self.endpoints[0]
+        self.failed_endpoints = []
         self.start_time = None
-        self.token_calculator = TokenCalculator()
+        self.request_started = None
+        self.token_calculator = get_shared_calculator()
+        self.input_tokens = input_tokens
+        self.usage_calibrator = usage_calibrator
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.retries = 0
+        self.rate_limiter = get_shared_limiter()
+        self.reservation = None
+        self.hedger = get_shared_hedger()
+        self.hedge = None
+        self.hedge_reservation = None
         self.is_reasoner_model = "reasoner" in model.lower()
         
         # 确定LLM提供商
@@ -41,137 +69,354 @@ class APIWorker(QThread):
         else:
             self.provider = LLMProvider.OPENAI  # 默认
         
-    def run(self):
+    async def run(self):
         try:
             self.start_time = datetime.now()
+            self.request_started = time.monotonic()
             
-            # 初始化LLM适配器
-            config = LLMConfig(
-                provider=self.provider,
-                api_key=self.api_key,
-                base_url=self.base_url,
-                model=self.model
-            )
-            adapter = LLMAdapter(config)
+            self.adapter = self._create_adapter()
+            get_shared_pool().begin_request()
             
             if self.stream:
-                self.stream_response(adapter)
+                self.hedger.on_request()
+                await self.stream_response(self.adapter)
             else:
-                self.normal_response(adapter)
+                await self.normal_response(self.adapter)
                 
         except Exception as e:
             self.error_occurred.emit(f"API调用错误: {str(e)}")
-        finally:
-            self.finished_signal.emit()
     
-    def normal_response(self, adapter):
+    def _count_input_tokens(self):
+        """输入token数，调用方已通过话题索引算好时直接使用"""
+        if self.input_tokens is not None:
+            return self.input_tokens
+        return self.token_calculator.calculate_messages_tokens(self.messages)
+    
+    def _finalize_usage(self, metadata, input_tokens, output_tokens, server_usage, reasoning_tokens=0,
+                        source="server"):
+        """写入用量信息：优先使用服务端返回的真实用量（多次尝试合计时source可为mixed），否则使用校准后的估算值"""
+        metadata["provider"] = self.provider.value
+        metadata["estimated_usage"] = {
+            "model": self.model,
+            "prompt_tokens": input_tokens,
+            "completion_tokens": output_tokens,
+            "message_count": len(self.messages)
+        }
+        
+        if server_usage is not None:
+            usage = server_usage.to_dict()
+            metadata["usage_source"] = source
+        else:
+            if self.usage_calibrator:
+                input_tokens = self.usage_calibrator.calibrate(self.model, "prompt", input_tokens, len(self.messages))
+                output_tokens = self.usage_calibrator.calibrate(self.model, "completion", output_tokens)
+            usage = {
+                "prompt_tokens": input_tokens,
+                "completion_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens,
+                "reasoning_tokens": reasoning_tokens
+            }
+            metadata["usage_source"] = "estimate"
+        
+        metadata["usage"] = usage
+        return usage
+    
+    def _unsent_usage(self, metadata):
+        """停止时请求还在排队等待额度或等待重试，没有发出：不产生用量，也不记账"""
+        metadata["provider"] = self.provider.value
+        metadata["not_sent"] = True
+        usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "reasoning_tokens": 0}
+        metadata["usage"] = usage
+        return usage
+    
+    def _create_adapter(self, base_url=None):
+        """为当前端点（或指定端点）初始化LLM适配器"""
+        config = LLMConfig(
+            provider=self.provider,
+            api_key=self.api_key,
+            base_url=base_url or self.base_url,
+            model=self.model
+        )
+        return LLMAdapter(config)
+    
+    async def normal_response(self, adapter):
         """正常响应模式"""
         self.progress_updated.emit("正在与AI对话...")
-        response = adapter.chat_completion(self.messages, stream=False)
-        
-        # 处理不同模型的响应格式
-        if self.provider == LLMProvider.OPENAI or self.provider == LLMProvider.DEEPSEEK:
-            content = response.choices[0].message.content
-            model_name = response.model
-        elif self.provider == LLMProvider.GEMINI:
-            content = response
-            model_name = self.model
-        elif self.provider == LLMProvider.ANTHROPIC:
-            content = response.content[0].text
-            model_name = self.model
-        else:
-            content = str(response)
-            model_name = self.model
+        while True:
+            adapter = self.adapter  # 故障转移后为新端点的适配器
+            await self._admit(adapter)
+            try:
+                response = await adapter.chat_completion(self.messages, stream=False)
+                break
+            except Exception as e:
+                # 失败的请求没有产生用量，退还占用的速率限制额度
+                self.reservation.settle(0)
+                await self._wait_for_retry(e)
         
         # 计算token使用量
-        input_tokens = self.token_calculator.calculate_messages_tokens(self.messages)
-        output_tokens = self.token_calculator.calculate_tokens(content)
-        total_tokens = input_tokens + output_tokens
+        input_tokens = self._count_input_tokens()
+        reasoning_tokens = self.token_calculator.calculate_tokens(response.reasoning)
+        output_tokens = self.token_calculator.calculate_tokens(response.content) + reasoning_tokens
         
         metadata = {
-            "model": model_name,
-            "usage": {
-                "prompt_tokens": input_tokens,
-                "completion_tokens": output_tokens,
-                "total_tokens": total_tokens
-            },
-            "created": int(datetime.now().timestamp())
+            "model": response.model,
+            "created": int(datetime.now().timestamp()),
+            "latency": round(time.monotonic() - self.request_started, 3)
         }
+        usage = self._finalize_usage(metadata, input_tokens, output_tokens, response.usage, reasoning_tokens)
+        if response.reasoning:
+            metadata["thinking_content"] = response.reasoning
+        if self.retries:
+            metadata["retries"] = self.retries
+        self._settle_rate_limit(metadata, usage["total_tokens"] if metadata["usage_source"] == "server" else None)
+        self._record_endpoint(metadata)
         
-        self.response_received.emit(content, metadata)
-        self.token_usage_updated.emit(input_tokens, output_tokens, total_tokens)
+        self.response_received.emit(response.content, metadata)
+        self.token_usage_updated.emit(usage["prompt_tokens"], usage["completion_tokens"], usage["total_tokens"])
     
-    def stream_response(self, adapter):
+    async def stream_response(self, adapter):
         """流式响应模式"""
         self.progress_updated.emit("开始流式响应...")
-        response = adapter.chat_completion(self.messages, stream=True)
         
         full_content = ""
         thinking_content = ""  # 用于累积思考过程
         chunk_count = 0
         
         # 计算输入token
-        input_tokens = self.token_calculator.calculate_messages_tokens(self.messages)
-        
-        if self.provider == LLMProvider.OPENAI or self.provider == LLMProvider.DEEPSEEK:
-            # 处理OpenAI/DEEPSEEK风格的流式响应
-            for chunk in response:
-                if chunk.choices and chunk.choices[0].delta:
-                    delta = chunk.choices[0].delta
-                    
-                    # 处理思考过程
-                    if self.is_reasoner_model and hasattr(delta, 'reasoning_content') and delta.reasoning_content:
-                        thinking_chunk = delta.reasoning_content
-                        thinking_content += thinking_chunk
-                        chunk_count += 1
-                        self.thinking_process_updated.emit(thinking_chunk)
-                        self._emit_chunk(f"[思考] {thinking_chunk}", chunk_count)
-                        continue
-                    
-                    # 处理普通内容
-                    if hasattr(delta, 'content') and delta.content:
-                        content_chunk = delta.content
-                        full_content += content_chunk
-                        chunk_count += 1
-                        self._emit_chunk(content_chunk, chunk_count)
+        input_tokens = self._count_input_tokens()
+        
+        # 输出token随数据块增量统计，无需在结束后重新分词
+        self.stream_counter = self.token_calculator.create_stream_counter()
+        attempt_usage = AttemptUsage()
+        last_usage = None
+        
+        cancelled = False
+        failure = None
+        resumed = False
+        in_flight = False  # 停止时是否有请求已发出
+        try:
+            while True:
+                prefix = ""
+                if full_content and adapter.supports_prefix:
+                    # 流中途断开：把已收到的回答作为前缀续写，不从头生成
+                    prefix = full_content
+                    resumed = True
+                elif chunk_count:
+                    # 不支持前缀续写，从头重新生成
+                    full_content = ""
+                    thinking_content = ""
+                    chunk_count = 0
+                    self.stream_counter = self.token_calculator.create_stream_counter()
+                    self.stream_reset.emit()
+                
+                adapter = self.adapter  # 故障转移后为新端点的适配器
+                await self._admit(adapter)
+                in_flight = True
+                chunks = None
+                server_usage = None
+                attempt_tokens = self.stream_counter.tokens
+                attempt_reasoning = self.stream_counter.channel_tokens("reasoning")
+                succeeded = False
+                try:
+                    # 各提供商的流式响应统一为ChatChunk；首token迟迟不来时向另一端点发出相同的请求，续写请求不对冲
+                    async def open_stream(adapter=adapter, prefix=prefix):
+                        return adapter.stream_chat(self.messages, prefix=prefix)
+                    delay = self.hedger.delay(self.model)
+                    opened = await hedged_open(open_stream, None if prefix else self._hedge_starter(delay, adapter),
+                                               delay, lambda chunk: bool(chunk.content or chunk.reasoning))
+                    chunks = opened.stream
+                    if opened.winner:
+                        self.hedger.record_win()
+                        self.hedge["won"] = True
+                        self.base_url = self.hedge["endpoint"]
+                        self.adapter = self._create_adapter()
+                        # 原请求没有产生输出，额度全部退还；之后按对冲请求的实际用量结算
+                        self.reservation.settle(0)
+                        self.reservation, self.hedge_reservation = self.hedge_reservation, None
+                    async for chunk in opened.chunks():
+                        if chunk.usage is not None:
+                            server_usage = chunk.usage.merge(server_usage)
                         
-        elif self.provider == LLMProvider.ANTHROPIC:
-            # 处理Anthropic风格的流式响应
-            for chunk in response:
-                if chunk.event == "content_block_delta":
-                    content_chunk = chunk.delta.text
-                    full_content += content_chunk
-                    chunk_count += 1
-                    self._emit_chunk(content_chunk, chunk_count)
-                    
-        elif self.provider == LLMProvider.OLLAMA:
-            # 处理Ollama风格的流式响应
-            for chunk in response:
-                if chunk.get("message"):
-                    content_chunk = chunk["message"]["content"]
-                    full_content += content_chunk
-                    chunk_count += 1
-                    self._emit_chunk(content_chunk, chunk_count)
-        
-        # 计算输出token（包括思考过程和最终回答）
-        output_tokens = self.token_calculator.calculate_tokens(full_content + thinking_content)
-        total_tokens = input_tokens + output_tokens
+                        # 处理思考过程
+                        if chunk.reasoning:
+                            thinking_content += chunk.reasoning
+                            chunk_count += 1
+                            self.stream_counter.feed(chunk.reasoning, "reasoning")
+                            self.thinking_process_updated.emit(chunk.reasoning)
+                            self._emit_chunk(f"[思考] {chunk.reasoning}", chunk_count)
+                        
+                        # 处理普通内容
+                        if chunk.content:
+                            full_content += chunk.content
+                            chunk_count += 1
+                            self.stream_counter.feed(chunk.content)
+                            self._emit_chunk(chunk.content, chunk_count)
+                    succeeded = True
+                    break
+                except Exception as e:
+                    in_flight = False
+                    await self._wait_for_retry(e)
+                finally:
+                    # 停止时立即关闭HTTP流，服务端随之停止生成
+                    if chunks is not None:
+                        await chunks.aclose()
+                    # 服务端用量只覆盖本次尝试；中途断开、没有用量的尝试按本次输入和已收到的输出估算
+                    consumed = attempt_usage.add(server_usage,
+                                                 input_tokens + (self.token_calculator.calculate_tokens(prefix)
+                                                                 if prefix else 0),
+                                                 self.stream_counter.tokens - attempt_tokens,
+                                                 self.stream_counter.channel_tokens("reasoning") - attempt_reasoning)
+                    if not succeeded:
+                        # 失败或停止的尝试按实际消耗结算，其余额度退还给排队的请求
+                        self.reservation.settle(consumed)
+                    if self.hedge_reservation is not None:
+                        # 落败或未完成的对冲请求在首token前被取消，没有产生输出
+                        self.hedge_reservation.settle(0)
+                        self.hedge_reservation = None
+                    last_usage = server_usage
+        except asyncio.CancelledError:
+            cancelled = True
+        except Exception as e:
+            # 重试用尽：已收到的部分回答照常保存，再报告错误
+            if not full_content:
+                raise
+            failure = f"API调用错误: {str(e)}"
+        
+        # 输出token（包括思考过程和最终回答）
+        output_tokens = self.stream_counter.tokens
+        server_usage, usage_source = attempt_usage.total()
         
         metadata = {
             "model": self.model,
             "stream": True,
             "created": int(datetime.now().timestamp()),
             "chunks_received": chunk_count,
-            "usage": {
-                "prompt_tokens": input_tokens,
-                "completion_tokens": output_tokens,
-                "total_tokens": total_tokens
-            },
+            "tokens_per_second": round(self.stream_counter.tokens_per_second, 1),
+            "ttft": self._ttft(self.stream_counter),
             "thinking_content": thinking_content  # 包含思考过程
         }
+        if cancelled:
+            # 已生成的部分同样计费，没有服务端用量时按已接收的内容估算
+            metadata["cancelled"] = True
+        if self.retries:
+            metadata["retries"] = self.retries
+        if resumed:
+            metadata["resumed"] = True
+        if attempt_usage.attempts > 1:
+            # 用量为各次尝试的合计，不能用于校准单次请求的估算
+            metadata["attempts"] = attempt_usage.attempts
+        if failure:
+            metadata["interrupted"] = failure
+        if self.hedge:
+            metadata["hedge"] = self.hedge
+        if not resumed:
+            self.hedger.record(self.model, metadata["ttft"])
+        if cancelled and not in_flight and not attempt_usage.attempts:
+            usage = self._unsent_usage(metadata)
+        else:
+            usage = self._finalize_usage(metadata, input_tokens, output_tokens, server_usage,
+                                         self.stream_counter.channel_tokens("reasoning"), usage_source or "server")
+        # 此前的尝试已各自结算，这里只结算最后一次
+        self._settle_rate_limit(metadata, last_usage.total_tokens if last_usage else None)
+        self._record_endpoint(metadata)
         
         self.response_received.emit(full_content, metadata)
-        self.token_usage_updated.emit(input_tokens, output_tokens, total_tokens)
+        self.token_usage_updated.emit(usage["prompt_tokens"], usage["completion_tokens"], usage["total_tokens"])
+        if failure:
+            self.error_occurred.emit(failure)
+    
+    async def _wait_for_retry(self, error):
+        """暂时性错误按重试策略等待后返回，否则重新抛出"""
+        delay = self.retry_policy.next_delay(self.retries, error)
+        if delay is None:
+            raise error
+        self.retries += 1
+        if is_endpoint_failure(error):
+            self.endpoint_router.record_failure(self.base_url)
+            fallback = self._next_endpoint()
+            if fallback:
+                # 端点故障时立即改用备用端点，无需退避等待；流式响应在新端点上照常续写
+                self.failed_endpoints.append(self.base_url)
+                self.base_url = fallback
+                self.adapter = self._create_adapter()
+                self.progress_updated.emit(f"{describe_error(error)}，切换到备用端点 {fallback}")
+                get_shared_pool().begin_request()
+                return
+        if getattr(error, "status_code", None) == 429:
+            # 本地额度估计偏高，让同一额度下排队的请求一起等待
+            self.rate_limiter.penalize(self.provider.value, self.api_key, self.model, delay)
+        reason = describe_error(error)
+        self.retry_scheduled.emit(self.retries, delay, reason)
+        self.progress_updated.emit(f"{reason}，{delay:.1f}秒后第{self.retries}次重试...")
+        await asyncio.sleep(delay)
+        get_shared_pool().begin_request()
+    
+    async def _admit(self, adapter):
+        """按预估的token数（输入 + 最大输出）申请速率限制额度，额度不足时排队等待"""
+        tokens = self._count_input_tokens() + adapter.config.max_tokens
+        provider = self.provider.value
+        if self.rate_limiter.would_wait(provider, self.api_key, self.model, tokens):
+            queued = self.rate_limiter.waiting(provider, self.api_key, self.model)
+            self.progress_updated.emit(f"等待速率限制额度（前面还有{queued}个请求）..." if queued
+                                       else "等待速率限制额度...")
+        self.reservation = await self.rate_limiter.acquire(provider, self.api_key, self.model, tokens)
+        if self.reservation.waited:
+            # 排队时间不计入首token延迟
+            self.request_started += self.reservation.waited
+    
+    def _settle_rate_limit(self, metadata, actual_tokens):
+        """用本次请求的服务端用量修正限流额度（没有时保留预估值），并按响应头中的限额校正本地估计"""
+        if self.reservation is None:
+            return
+        self.reservation.settle(actual_tokens)
+        self.rate_limiter.observe(self.provider.value, self.api_key, self.model,
+                                  get_shared_pool().rate_limit_headers())
+        if self.reservation.waited >= 0.1:
+            metadata["rate_limit_wait"] = round(self.reservation.waited, 2)
+    
+    def _hedge_starter(self, delay, adapter):
+        """超过阈值仍无首token时调用：预算允许时向另一端点（没有备用端点时为同一端点的新请求）发出副本"""
+        def start():
+            tokens = self._count_input_tokens() + adapter.config.max_tokens
+            provider = self.provider.value
+            # 对冲请求不排队，也不挤占其他请求的速率限制额度
+            if self.rate_limiter.would_wait(provider, self.api_key, self.model, tokens):
+                return None
+            if not self.hedger.try_spend():
+                return None
+            target = self._next_endpoint() or self.base_url
+            self.hedge = {"endpoint": target, "delay": round(delay, 2), "won": False}
+            self.progress_updated.emit(f"{delay:.1f}秒内未收到首token，向 {target} 发出对冲请求...")
+            hedge_adapter = self._create_adapter(target)
+            
+            async def open_hedge():
+                self.hedge_reservation = await self.rate_limiter.acquire(provider, self.api_key, self.model, tokens)
+                return hedge_adapter.stream_chat(self.messages)
+            return open_hedge
+        return start
+    
+    def _next_endpoint(self):
+        """本次请求尚未失败过的下一个端点，按当前优先顺序"""
+        for url in self.endpoint_router.ordered(self.base_url):
+            if url != self.base_url and url not in self.failed_endpoints:
+                return url
+        return None
+    
+    def _record_endpoint(self, metadata):
+        """被动记录端点延迟，供后续请求选择最快的端点"""
+        latency = metadata.get("ttft") if metadata.get("stream") else metadata.get("latency")
+        if not metadata.get("interrupted") and (latency is not None or not metadata.get("cancelled")):
+            self.endpoint_router.record_success(self.base_url, latency)
+        if len(self.endpoints) > 1:
+            metadata["endpoint"] = self.base_url
+        if self.failed_endpoints:
+            metadata["failover"] = self.failed_endpoints + [self.base_url]
+    
+    def _ttft(self, stream_counter):
+        """首token延迟（秒），从发起请求到收到第一个内容数据块"""
+        if stream_counter.first_chunk_time is None or self.request_started is None:
+            return None
+        return round(stream_counter.first_chunk_time - self.request_started, 3)
     
     def _emit_chunk(self, content_chunk, chunk_count):
         """发送数据块并更新进度"""
@@ -180,6 +425,8 @@ class APIWorker(QThread):
         timestamp = f"{time_diff.seconds}.{time_diff.microseconds // 100000:01d}"
         
         if chunk_count % 5 == 0:
-            self.progress_updated.emit(f"已接收 {chunk_count} 个数据块...")
+            self.progress_updated.emit(
+                f"已接收 {chunk_count} 个数据块，输出 {self.stream_counter.tokens} tokens"
+                f"（{self.stream_counter.tokens_per_second:.1f} tokens/s）")
         
         self.stream_chunk_received.emit(content_chunk, timestamp)
\ No newline at end of file
@@ -0,0 +1,100 @@
+from dataclasses import dataclass, field
+from typing import List, Tuple
+
+from .history_retrieval import HistoryRetriever
+
+# 不超过该token数的附件直接放入输入框，更大的附件按相关性选取片段
+INLINE_ATTACHMENT_TOKENS = 2000
+DEFAULT_CHUNK_TOKENS = 512
+# 一条消息中附件片段最多占用的输入预算比例，给后续几轮对话留出空间
+MAX_ATTACHMENT_SHARE = 0.5
+
+
+@dataclass
+class Attachment:
+    """分段并建立检索索引的附件"""
+    name: str
+    chunks: List[str]
+    chunk_tokens: List[int]
+    index: HistoryRetriever = field(default_factory=HistoryRetriever, repr=False)
+
+    def __post_init__(self):
+        self._documents = [{"content": chunk} for chunk in self.chunks]
+        self.index.sync(self.name, self._documents)
+
+    @property
+    def total_tokens(self) -> int:
+        return sum(self.chunk_tokens)
+
+    @classmethod
+    def from_text(cls, name: str, text: str, calculator, chunk_tokens: int = DEFAULT_CHUNK_TOKENS) -> "Attachment":
+        """按行切分为约chunk_tokens个token的片段；超长的单行按字符比例切开"""
+        lines = text.splitlines(keepends=True)
+        counts = calculator.calculate_tokens_batch(lines)
+
+        chunks, sizes = [], []
+        current, current_tokens = [], 0
+        for line, tokens in zip(lines, counts):
+            pieces = [(line, tokens)]
+            if tokens > chunk_tokens:
+                step = max(len(line) * chunk_tokens // tokens, 1)
+                parts = [line[i:i + step] for i in range(0, len(line), step)]
+                pieces = list(zip(parts, calculator.calculate_tokens_batch(parts)))
+            for piece, piece_tokens in pieces:
+                if current and current_tokens + piece_tokens > chunk_tokens:
+                    chunks.append("".join(current))
+                    sizes.append(current_tokens)
+                    current, current_tokens = [], 0
+                current.append(piece)
+                current_tokens += piece_tokens
+        if current:
+            chunks.append("".join(current))
+            sizes.append(current_tokens)
+        return cls(name, chunks, sizes)
+
+    def rank(self, query: str) -> List[int]:
+        """按与问题的相关性排序的片段下标；没有匹配时首尾交替（日志的开头和结尾通常最有用）"""
+        ranked = [i for _, i in self.index.search(self.name, self._documents, query or "", len(self.chunks))]
+        seen = set(ranked)
+        head, tail = 0, len(self.chunks) - 1
+        fallback = []
+        while head <= tail:
+            fallback.append(head)
+            if tail != head:
+                fallback.append(tail)
+            head, tail = head + 1, tail - 1
+        return ranked + [i for i in fallback if i not in seen]
+
+    def select(self, query: str, budget: int) -> Tuple[str, List[int]]:
+        """在budget个token内选取最相关的片段，按原顺序拼接，被省略的部分用标记说明"""
+        if self.total_tokens <= budget:
+            return self.render(list(range(len(self.chunks)))), list(range(len(self.chunks)))
+
+        # 预留标题行的token
+        selected, used = [], 40
+        for i in self.rank(query):
+            # 每段另留约16个token给省略标记
+            if used + self.chunk_tokens[i] + 16 <= budget:
+                selected.append(i)
+                used += self.chunk_tokens[i] + 16
+        selected.sort()
+        return self.render(selected), selected
+
+    def render(self, selected: List[int]) -> str:
+        parts = [f"📎 附件 {self.name}（共{len(self.chunks)}段，约{self.total_tokens} tokens"]
+        if len(selected) < len(self.chunks):
+            parts[0] += f"，按与问题的相关性选取了{len(selected)}段）"
+        else:
+            parts[0] += "）"
+
+        previous = -1
+        for i in selected + [len(self.chunks)]:
+            if i - previous > 1:
+                omitted = range(previous + 1, i)
+                tokens = sum(self.chunk_tokens[j] for j in omitted)
+                label = f"{omitted.start + 1}" if len(omitted) == 1 else f"{omitted.start + 1}-{omitted.stop}"
+                parts.append(f"…[省略第{label}段，约{tokens} tokens]…")
+            if i < len(self.chunks):
+                parts.append(self.chunks[i].rstrip("\n"))
+            previous = i
+        return "\n".join(parts)
@@ -0,0 +1,293 @@
+import json
+import heapq
+import re
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+try:
+    # regex库支持\p{..}属性类，可与官方分词器的预分词规则完全一致
+    import regex as _regex
+except ImportError:
+    _regex = None
+
+# 随程序打包的离线词表（HuggingFace tokenizer.json格式，DeepSeek-V3/R1共用）
+DEFAULT_TOKENIZER_PATH = Path(__file__).parent / "tokenizers" / "deepseek" / "tokenizer.json"
+
+# DeepSeek tokenizer.json中的预分词规则（按顺序依次切分，保留匹配和未匹配部分）
+DEEPSEEK_PRETOKENIZE_PATTERNS = [
+    r"\p{N}{1,3}",
+    r"[一-龥぀-ゟ゠-ヿ]+",
+    r"[!\"#$%&'()*+,\-./:;<=>?@\[\\\]^_`{|}~][A-Za-z]+"
+    r"|[^\r\n\p{L}\p{P}\p{S}]?[\p{L}\p{M}]+"
+    r"| ?[\p{P}\p{S}]+[\r\n]*"
+    r"|\s*[\r\n]+|\s+(?!\S)|\s+",
+]
+
+# 未安装regex库时使用标准库re的近似规则（\p{L}≈[^\W\d_]，\p{P}\p{S}≈[^\w\s]|_）
+FALLBACK_PRETOKENIZE_PATTERNS = [
+    r"\d{1,3}",
+    r"[一-龥぀-ゟ゠-ヿ]+",
+    r"[!\"#$%&'()*+,\-./:;<=>?@\[\\\]^_`{|}~][A-Za-z]+"
+    r"|(?:[^\S\r\n]|\d)?[^\W\d_]+"
+    r"| ?(?:[^\w\s]|_)+[\r\n]*"
+    r"|\s*[\r\n]+|\s+(?!\S)|\s+",
+]
+
+
+@lru_cache(maxsize=None)
+def bytes_to_unicode() -> Dict[int, str]:
+    """字节到可见Unicode字符的映射（与GPT-2/DeepSeek的byte-level BPE一致）"""
+    bs = (list(range(ord("!"), ord("~") + 1))
+          + list(range(ord("¡"), ord("¬") + 1))
+          + list(range(ord("®"), ord("ÿ") + 1)))
+    cs = bs[:]
+    n = 0
+    for b in range(256):
+        if b not in bs:
+            bs.append(b)
+            cs.append(256 + n)
+            n += 1
+    return dict(zip(bs, (chr(c) for c in cs)))
+
+
+class BPETokenizer:
+    """离线byte-level BPE分词器"""
+
+    def __init__(self, vocab: Dict[str, int], merges: Iterable[Tuple[str, str]],
+                 pretokenize_patterns: Optional[List[str]] = None,
+                 added_tokens: Optional[Dict[str, int]] = None,
+                 cache_size: int = 50000):
+        self.encoder = vocab
+        self.decoder = {v: k for k, v in vocab.items()}
+        self.bpe_ranks = {tuple(pair): rank for rank, pair in enumerate(merges)}
+        self.added_tokens = added_tokens or {}
+        self.cache_size = cache_size
+        self.cache: Dict[str, Tuple[int, ...]] = {}
+
+        # latin-1解码后按表转换，一次translate完成字节到BPE字符的映射
+        self.byte_encoder = bytes_to_unicode()
+        self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
+
+        self.exact_pretokenizer = _regex is not None
+        if pretokenize_patterns is None:
+            pretokenize_patterns = DEEPSEEK_PRETOKENIZE_PATTERNS
+        if _regex is not None:
+            self.patterns = [_regex.compile(p) for p in pretokenize_patterns]
+        else:
+            self.patterns = [re.compile(p) for p in FALLBACK_PRETOKENIZE_PATTERNS]
+
+        if self.added_tokens:
+            alternatives = sorted(self.added_tokens, key=len, reverse=True)
+            self.added_pattern = re.compile("|".join(re.escape(t) for t in alternatives))
+        else:
+            self.added_pattern = None
+
+    @classmethod
+    def from_tokenizer_json(cls, path) -> "BPETokenizer":
+        """从HuggingFace格式的tokenizer.json加载"""
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+
+        model = data["model"]
+        if model.get("type", "BPE") != "BPE":
+            raise ValueError(f"不支持的分词模型类型: {model.get('type')}")
+
+        merges = [tuple(m.split(" ", 1)) if isinstance(m, str) else tuple(m)
+                  for m in model["merges"]]
+        added_tokens = {t["content"]: t["id"] for t in data.get("added_tokens", [])}
+        patterns = cls._read_split_patterns(data.get("pre_tokenizer")) or None
+        return cls(model["vocab"], merges, patterns, added_tokens)
+
+    @classmethod
+    def from_files(cls, vocab_path, merges_path) -> "BPETokenizer":
+        """从GPT-2风格的vocab.json + merges.txt加载"""
+        with open(vocab_path, 'r', encoding='utf-8') as f:
+            vocab = json.load(f)
+
+        merges = []
+        with open(merges_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if not line or line.startswith("#version"):
+                    continue
+                merges.append(tuple(line.split(" ", 1)))
+        return cls(vocab, merges)
+
+    @staticmethod
+    def _read_split_patterns(pre_tokenizer) -> List[str]:
+        """提取pre_tokenizer中的Split正则"""
+        if not pre_tokenizer:
+            return []
+        if pre_tokenizer.get("type") == "Sequence":
+            steps = pre_tokenizer.get("pretokenizers", [])
+        else:
+            steps = [pre_tokenizer]
+        return [step["pattern"]["Regex"] for step in steps
+                if step.get("type") == "Split" and "Regex" in step.get("pattern", {})]
+
+    def pretokenize(self, text: str) -> List[str]:
+        """按预分词规则依次切分文本（Isolated模式）"""
+        pieces = [text]
+        for pattern in self.patterns:
+            split_pieces = []
+            for piece in pieces:
+                pos = 0
+                for match in pattern.finditer(piece):
+                    start, end = match.span()
+                    if start > pos:
+                        split_pieces.append(piece[pos:start])
+                    if end > start:
+                        split_pieces.append(piece[start:end])
+                    pos = end
+                if pos < len(piece):
+                    split_pieces.append(piece[pos:])
+            pieces = split_pieces
+        return pieces
+
+    def _bpe(self, word: str) -> Tuple[int, ...]:
+        """对单个预分词片段执行BPE合并，返回token id
+
+        使用双向链表 + 最小堆，合并复杂度为O(n log n)，长片段不会退化为O(n^2)。
+        """
+        cached = self.cache.get(word)
+        if cached is not None:
+            return cached
+
+        symbols: List[Optional[str]] = list(word)
+        n = len(symbols)
+        if n > 1:
+            ranks = self.bpe_ranks
+            nxt = list(range(1, n + 1))
+            nxt[-1] = -1
+            prev = list(range(-1, n - 1))
+
+            heap = []
+            for i in range(n - 1):
+                rank = ranks.get((symbols[i], symbols[i + 1]))
+                if rank is not None:
+                    heap.append((rank, i, symbols[i], symbols[i + 1]))
+            heapq.heapify(heap)
+
+            while heap:
+                rank, i, left, right = heapq.heappop(heap)
+                j = nxt[i]
+                # 跳过已失效的候选（任一侧已被合并）
+                if j == -1 or symbols[i] != left or symbols[j] != right:
+                    continue
+
+                merged = left + right
+                symbols[i] = merged
+                symbols[j] = None
+                k = nxt[j]
+                nxt[i] = k
+                if k != -1:
+                    prev[k] = i
+
+                p = prev[i]
+                if p != -1:
+                    rank = ranks.get((symbols[p], merged))
+                    if rank is not None:
+                        heapq.heappush(heap, (rank, p, symbols[p], merged))
+                if k != -1:
+                    rank = ranks.get((merged, symbols[k]))
+                    if rank is not None:
+                        heapq.heappush(heap, (rank, i, merged, symbols[k]))
+
+        encoder = self.encoder
+        ids = []
+        for symbol in symbols:
+            if symbol is None:
+                continue
+            token_id = encoder.get(symbol)
+            if token_id is not None:
+                ids.append(token_id)
+            else:
+                # 词表缺失时逐字节回退
+                ids.extend(encoder.get(ch, 0) for ch in symbol)
+        result = tuple(ids)
+
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[word] = result
+        return result
+
+    def _encode_ordinary(self, text: str, ids: List[int]):
+        """编码不含特殊token的文本"""
+        for piece in self.pretokenize(text):
+            word = piece.encode('utf-8').decode('latin-1').translate(self.byte_encoder)
+            ids.extend(self._bpe(word))
+
+    def encode(self, text: str) -> List[int]:
+        """将文本编码为token id列表"""
+        ids: List[int] = []
+        if not text:
+            return ids
+
+        if self.added_pattern is None:
+            self._encode_ordinary(text, ids)
+            return ids
+
+        pos = 0
+        for match in self.added_pattern.finditer(text):
+            if match.start() > pos:
+                self._encode_ordinary(text[pos:match.start()], ids)
+            ids.append(self.added_tokens[match.group()])
+            pos = match.end()
+        if pos < len(text):
+            self._encode_ordinary(text[pos:], ids)
+        return ids
+
+    def count_pieces(self, pieces: Iterable[str]) -> int:
+        """计算已预分词片段的token数量（不处理特殊token）"""
+        total = 0
+        for piece in pieces:
+            word = piece.encode('utf-8').decode('latin-1').translate(self.byte_encoder)
+            total += len(self._bpe(word))
+        return total
+
+    def count_tokens(self, text: str) -> int:
+        """计算文本的精确token数量"""
+        return len(self.encode(text))
+
+    def decode(self, ids: Iterable[int]) -> str:
+        """将token id列表解码为文本"""
+        added_by_id = {v: k for k, v in self.added_tokens.items()}
+        parts = []
+        buffer = bytearray()
+        for token_id in ids:
+            if token_id in added_by_id:
+                parts.append(buffer.decode('utf-8', errors='replace'))
+                buffer = bytearray()
+                parts.append(added_by_id[token_id])
+                continue
+            token = self.decoder.get(token_id, "")
+            buffer.extend(self.byte_decoder[ch] for ch in token if ch in self.byte_decoder)
+        parts.append(buffer.decode('utf-8', errors='replace'))
+        return "".join(parts)
+
+
+_default_tokenizer = None
+_default_tokenizer_loaded = False
+_default_tokenizer_error: Optional[str] = None
+
+
+def load_default_tokenizer() -> Optional[BPETokenizer]:
+    """加载随程序打包的DeepSeek分词器，词表缺失或损坏时返回None，原因见default_tokenizer_error()"""
+    global _default_tokenizer, _default_tokenizer_loaded, _default_tokenizer_error
+    if not _default_tokenizer_loaded:
+        _default_tokenizer_loaded = True
+        try:
+            _default_tokenizer = BPETokenizer.from_tokenizer_json(DEFAULT_TOKENIZER_PATH)
+        except FileNotFoundError:
+            _default_tokenizer = None
+            _default_tokenizer_error = f"词表文件不存在: {DEFAULT_TOKENIZER_PATH}"
+        except Exception as e:
+            _default_tokenizer = None
+            _default_tokenizer_error = f"词表加载失败: {e}"
+    return _default_tokenizer
+
+
+def default_tokenizer_error() -> Optional[str]:
+    """离线词表未能加载的原因"""
+    return _default_tokenizer_error
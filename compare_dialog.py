@@ -0,0 +1,235 @@
+import json
+from PySide6.QtWidgets import (
+    QDialog, QVBoxLayout, QHBoxLayout, QListWidget, QListWidgetItem, QLabel,
+    QPushButton, QTextEdit, QSplitter, QWidget, QTableWidget, QTableWidgetItem,
+    QHeaderView, QGroupBox
+)
+from PySide6.QtCore import Qt, Signal
+from PySide6.QtGui import QGuiApplication, QTextCursor
+from .assistant_manager import AssistantManager
+from .model_compare import CompareSession, CompareTarget, append_result
+from .usage_ledger import format_costs
+
+COMPARE_MODELS = ["deepseek-chat", "deepseek-reasoner"]
+
+
+class CompareDialog(QDialog):
+    """多模型对比：同一个提示同时发给多个模型或助手，回答并排流式显示"""
+    compare_finished = Signal(dict)  # 一次对比的完整结果
+
+    def __init__(self, api_key, base_url, prompt="", ledger=None, usage_calibrator=None,
+                 results_path=None, parent=None):
+        super().__init__(parent)
+        self.api_key = api_key
+        self.base_url = base_url
+        self.ledger = ledger
+        self.usage_calibrator = usage_calibrator
+        self.results_path = results_path
+        self.session = None
+        self.columns = []
+        self.setup_ui(prompt)
+
+    def setup_ui(self, prompt):
+        """初始化UI"""
+        self.setWindowTitle("多模型对比")
+        self.setMinimumSize(1100, 700)
+
+        main_layout = QVBoxLayout(self)
+
+        # 提示和对比对象
+        top_layout = QHBoxLayout()
+        prompt_group = QGroupBox("提示")
+        prompt_layout = QVBoxLayout(prompt_group)
+        self.prompt_edit = QTextEdit()
+        self.prompt_edit.setAcceptRichText(False)
+        self.prompt_edit.setPlainText(prompt)
+        prompt_layout.addWidget(self.prompt_edit)
+
+        target_group = QGroupBox("对比对象")
+        target_layout = QVBoxLayout(target_group)
+        self.target_list = QListWidget()
+        self.populate_targets()
+        target_layout.addWidget(self.target_list)
+
+        top_layout.addWidget(prompt_group, 2)
+        top_layout.addWidget(target_group, 1)
+
+        # 按钮区域
+        button_layout = QHBoxLayout()
+        self.start_button = QPushButton("开始对比")
+        self.start_button.clicked.connect(self.start_compare)
+        self.stop_button = QPushButton("停止")
+        self.stop_button.setEnabled(False)
+        self.stop_button.clicked.connect(self.stop_compare)
+        self.copy_button = QPushButton("复制结果")
+        self.copy_button.setEnabled(False)
+        self.copy_button.clicked.connect(self.copy_result)
+        self.status_label = QLabel("")
+        button_layout.addWidget(self.start_button)
+        button_layout.addWidget(self.stop_button)
+        button_layout.addWidget(self.copy_button)
+        button_layout.addWidget(self.status_label, 1)
+
+        # 并排显示的回答
+        self.column_splitter = QSplitter(Qt.Orientation.Horizontal)
+
+        # 汇总表
+        self.summary_table = QTableWidget(0, 7)
+        self.summary_table.setHorizontalHeaderLabels(["对比对象", "首token", "速度", "输入", "输出", "耗时", "费用"])
+        self.summary_table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
+        self.summary_table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        self.summary_table.setMaximumHeight(160)
+
+        main_layout.addLayout(top_layout, 1)
+        main_layout.addLayout(button_layout)
+        main_layout.addWidget(self.column_splitter, 4)
+        main_layout.addWidget(self.summary_table)
+
+    def populate_targets(self):
+        """DeepSeek模型和所有助手，默认勾选DeepSeek的两个模型"""
+        self.targets = [CompareTarget(label=model, model=model, provider="deepseek",
+                                      api_key=self.api_key, base_url=self.base_url)
+                        for model in COMPARE_MODELS]
+        self.targets += [CompareTarget.from_assistant(assistant, self.api_key, self.base_url)
+                         for assistant in AssistantManager().get_all_assistants()]
+        for index, target in enumerate(self.targets):
+            text = target.label if target.label == target.model else f"{target.label} ({target.model})"
+            item = QListWidgetItem(text)
+            item.setFlags(item.flags() | Qt.ItemFlag.ItemIsUserCheckable)
+            item.setCheckState(Qt.CheckState.Checked if index < len(COMPARE_MODELS) else Qt.CheckState.Unchecked)
+            self.target_list.addItem(item)
+
+    def selected_targets(self):
+        return [target for index, target in enumerate(self.targets)
+                if self.target_list.item(index).checkState() == Qt.CheckState.Checked]
+
+    def start_compare(self):
+        """为每个选中的对象建立一列，并发发出请求"""
+        prompt = self.prompt_edit.toPlainText().strip()
+        targets = self.selected_targets()
+        if not prompt or len(targets) < 2:
+            self.status_label.setText("请输入提示并至少选择两个对比对象")
+            return
+
+        self.clear_columns()
+        for target in targets:
+            self.add_column(target)
+        self.summary_table.setRowCount(0)
+
+        self.session = CompareSession(prompt, targets, ledger=self.ledger,
+                                      usage_calibrator=self.usage_calibrator, parent=self)
+        self.session.chunk_received.connect(self.handle_chunk)
+        self.session.thinking_received.connect(self.handle_thinking)
+        self.session.entry_finished.connect(self.handle_entry_finished)
+        self.session.finished.connect(self.handle_finished)
+        self.session.start()
+
+        self.start_button.setEnabled(False)
+        self.stop_button.setEnabled(True)
+        self.copy_button.setEnabled(False)
+        self.status_label.setText(f"正在对比 {len(targets)} 个模型...")
+
+    def stop_compare(self):
+        if self.session is not None:
+            self.session.cancel()
+
+    def clear_columns(self):
+        for column in self.columns:
+            column["widget"].deleteLater()
+        self.columns = []
+
+    def add_column(self, target):
+        widget = QWidget()
+        layout = QVBoxLayout(widget)
+        layout.setContentsMargins(4, 4, 4, 4)
+        title = QLabel(f"<b>{target.label}</b>" + ("" if target.label == target.model else f"<br>{target.model}"))
+        thinking_edit = QTextEdit()
+        thinking_edit.setReadOnly(True)
+        thinking_edit.setMaximumHeight(120)
+        thinking_edit.setStyleSheet("color: #64748b;")
+        thinking_edit.hide()
+        content_edit = QTextEdit()
+        content_edit.setReadOnly(True)
+        stats_label = QLabel("等待首token...")
+        stats_label.setWordWrap(True)
+        stats_label.setStyleSheet("color: #64748b; font-size: 12px;")
+        layout.addWidget(title)
+        layout.addWidget(thinking_edit)
+        layout.addWidget(content_edit, 1)
+        layout.addWidget(stats_label)
+        self.column_splitter.addWidget(widget)
+        self.columns.append({"widget": widget, "thinking": thinking_edit,
+                             "content": content_edit, "stats": stats_label})
+
+    @staticmethod
+    def _append(text_edit, text):
+        cursor = text_edit.textCursor()
+        cursor.movePosition(QTextCursor.MoveOperation.End)
+        cursor.insertText(text)
+        text_edit.setTextCursor(cursor)
+        text_edit.ensureCursorVisible()
+
+    def handle_chunk(self, index, chunk):
+        column = self.columns[index]
+        if not column["content"].toPlainText():
+            column["stats"].setText("接收中...")
+        self._append(column["content"], chunk)
+
+    def handle_thinking(self, index, chunk):
+        column = self.columns[index]
+        column["thinking"].show()
+        self._append(column["thinking"], chunk)
+
+    def handle_entry_finished(self, index):
+        """一个对象回答结束：显示完整回答和指标，并加入汇总表"""
+        entry = self.session.entries[index]
+        column = self.columns[index]
+        if entry.content:
+            column["content"].setPlainText(entry.content)
+        row = entry.to_dict()
+        cost = format_costs({row["currency"]: row["cost"]}) if row["currency"] else "-"
+        ttft = f"{row['ttft']:.2f}s" if row["ttft"] is not None else "-"
+        speed = f"{row['tokens_per_second']:.1f} tokens/s" if row["tokens_per_second"] is not None else "-"
+        elapsed = f"{row['elapsed']:.1f}s" if row["elapsed"] is not None else "-"
+        if entry.error:
+            column["stats"].setText(entry.error)
+        else:
+            column["stats"].setText(f"首token {ttft} · {speed} · 输入 {row['prompt_tokens']} / "
+                                    f"输出 {row['completion_tokens']} · {cost}"
+                                    + ("（已停止）" if row["cancelled"] else ""))
+
+        table_row = self.summary_table.rowCount()
+        self.summary_table.insertRow(table_row)
+        for column_index, value in enumerate([row["label"], ttft, speed, str(row["prompt_tokens"]),
+                                              str(row["completion_tokens"]), elapsed, cost]):
+            self.summary_table.setItem(table_row, column_index, QTableWidgetItem(value))
+
+    def handle_finished(self):
+        """全部结束：保存对比结果"""
+        result = self.session.result()
+        if self.results_path:
+            try:
+                append_result(self.results_path, result)
+            except Exception as e:
+                print(f"保存对比结果失败: {e}")
+        costs = {}
+        for entry in result["entries"]:
+            if entry["currency"]:
+                costs[entry["currency"]] = costs.get(entry["currency"], 0.0) + entry["cost"]
+        self.status_label.setText(f"对比完成，总费用 {format_costs(costs)}")
+        self.start_button.setEnabled(True)
+        self.stop_button.setEnabled(False)
+        self.copy_button.setEnabled(True)
+        self.compare_finished.emit(result)
+
+    def copy_result(self):
+        """以JSON复制本次对比结果"""
+        if self.session is not None:
+            QGuiApplication.clipboard().setText(json.dumps(self.session.result(), ensure_ascii=False, indent=2))
+            self.status_label.setText("对比结果已复制")
+
+    def done(self, result):
+        # 关闭对话框时停止未完成的请求
+        if self.session is not None and self.session.is_running():
+            self.session.cancel()
+        super().done(result)
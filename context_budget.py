@@ -0,0 +1,225 @@
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+from .history_retrieval import format_retrieved
+
+# 各模型的上下文长度（token），按模型名前缀匹配（最长前缀优先）
+MODEL_CONTEXT_LENGTHS: Dict[str, int] = {
+    "deepseek-chat": 128000,
+    "deepseek-reasoner": 128000,
+    "gpt-4o": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4.1": 1047576,
+    "gpt-3.5-turbo": 16385,
+    "claude-": 200000,
+    "gemini-1.5": 1048576,
+    "gemini-2": 1048576,
+    "gemini-pro": 32760,
+}
+
+DEFAULT_CONTEXT_LENGTH = 32768
+
+
+def context_length(model: str) -> int:
+    """模型的上下文长度，未知模型使用保守的默认值"""
+    if model in MODEL_CONTEXT_LENGTHS:
+        return MODEL_CONTEXT_LENGTHS[model]
+    matches = [name for name in MODEL_CONTEXT_LENGTHS if model and model.startswith(name)]
+    return MODEL_CONTEXT_LENGTHS[max(matches, key=len)] if matches else DEFAULT_CONTEXT_LENGTH
+
+
+def input_budget(model: str, max_tokens: int) -> int:
+    """可用于输入（系统提示 + 历史 + 新消息）的token预算：上下文长度减去为输出预留的max_tokens"""
+    return max(context_length(model) - max_tokens, 0)
+
+
+@dataclass
+class ContextWindow:
+    """一次请求实际发送的上下文"""
+    messages: List[dict]
+    input_tokens: int
+    start: int  # 发送的第一条历史消息在话题中的下标
+    budget: int
+    retrieved: List[int] = field(default_factory=list)  # 检索补充的较早消息下标
+
+    @property
+    def overflow(self) -> bool:
+        return self.input_tokens > self.budget
+
+
+class ContextBuilder:
+    """按token预算构建上下文：系统提示（和较早对话的摘要）之后，从最新消息向前填充历史
+
+    消息的token数取自TopicTokenIndex（每条只计算一次，话题前缀和随追加增量更新），
+    因此每次发送只需一次O(log n)的二分查找，不会重新计算整个话题。
+
+    prefix_stable为True时记住每个话题的窗口起点，预算允许时后续请求只在末尾追加，
+    请求前缀逐字节不变，可命中DeepSeek的上下文缓存；超出预算时一次多淘汰
+    EVICTION_HEADROOM比例的预算，之后若干轮又可以只追加。
+    """
+
+    EVICTION_HEADROOM = 0.25
+    # 检索补充的较早消息最多占用的预算比例和条数
+    RETRIEVAL_SHARE = 0.15
+    RETRIEVAL_LIMIT = 6
+
+    def __init__(self, calculator, token_index, prefix_stable: bool = True, retriever=None):
+        self.calculator = calculator
+        self.token_index = token_index
+        self.prefix_stable = prefix_stable
+        self.retriever = retriever
+        self.window_starts: Dict[str, int] = {}
+
+    def select_start(self, topic_id: str, history: List[dict], budget: int, reserved: int = 0,
+                     min_start: int = 0) -> int:
+        """在预留reserved个token后，返回能放入预算的最早历史下标（至少保留最新一条）
+
+        min_start之前的消息已由摘要代替，不再原文发送。
+        """
+        count = self.token_index.fit_latest(topic_id, history, budget - reserved)
+        start = len(history) - max(count, 1 if history else 0)
+        start = max(start, min(min_start, len(history) - 1))
+        # 从用户消息开始，避免上下文以孤立的助手回复开头（Anthropic等接口要求首条为用户消息）
+        while start < len(history) - 1 and history[start].get("role") == "assistant":
+            start += 1
+        return start
+
+    def _prefix(self, system_message: dict, summary):
+        """固定前缀：系统提示 + 摘要（摘要需提供covered和to_message()）"""
+        prefix = [system_message]
+        covered = 0
+        if summary is not None and summary.covered:
+            prefix.append(summary.to_message())
+            covered = summary.covered
+        return prefix, self.calculator.calculate_messages_tokens(prefix), covered
+
+    def _window_start(self, topic_id: str, history: List[dict], budget: int, reserved: int,
+                      covered: int, previous: int = None) -> int:
+        fit_start = self.select_start(topic_id, history, budget, reserved, covered)
+        if not self.prefix_stable:
+            return fit_start
+        floor = min(covered, len(history) - 1) if history else 0
+        if previous is not None and max(fit_start, floor) <= previous < len(history):
+            # 上次的起点仍放得下，保持前缀不变
+            return previous
+        if fit_start > floor:
+            # 需要淘汰较早的消息：按缩小后的预算选择起点，留出余量
+            reduced = int(budget * (1 - self.EVICTION_HEADROOM))
+            return max(fit_start, self.select_start(topic_id, history, reduced, reserved, covered))
+        return fit_start
+
+    def build(self, topic_id: str, history: List[dict], system_message: dict,
+              model: str, max_tokens: int, summary=None, query: str = None) -> ContextWindow:
+        budget = input_budget(model, max_tokens)
+        prefix, prefix_tokens, covered = self._prefix(system_message, summary)
+        start = self._window_start(topic_id, history, budget, prefix_tokens, covered,
+                                   self.window_starts.get(topic_id))
+        self.window_starts[topic_id] = start
+
+        messages = list(prefix)
+        messages.extend({"role": m["role"], "content": m["content"]} for m in history[start:])
+        input_tokens = prefix_tokens + self.token_index.range_tokens(topic_id, history, start)
+        window = ContextWindow(messages, input_tokens, start, budget)
+        if self.retriever is not None and query and start > 0:
+            self._splice_retrieved(window, topic_id, history, query)
+        return window
+
+    def _splice_retrieved(self, window: ContextWindow, topic_id: str, history: List[dict], query: str):
+        """检索窗口之前与query相关的消息，在剩余预算内插入到最新用户消息之前
+
+        插在末尾附近而不是前缀中，不破坏上一轮请求已缓存的前缀。
+        """
+        available = min(window.budget - window.input_tokens, int(window.budget * self.RETRIEVAL_SHARE))
+        used = self.calculator.calculate_messages_tokens([format_retrieved(history, [])])
+        selected = []
+        for _, i in self.retriever.search(topic_id, history, query, window.start):
+            if len(selected) >= self.RETRIEVAL_LIMIT:
+                break
+            # 每条另加约8个token的序号和角色标注
+            tokens = self.token_index.message_tokens(history[i]) + 8
+            if used + tokens <= available:
+                selected.append(i)
+                used += tokens
+        if not selected:
+            return
+
+        block = format_retrieved(history, selected)
+        position = len(window.messages)
+        if window.messages[-1].get("role") == "user":
+            position -= 1
+        window.messages.insert(position, block)
+        window.input_tokens += self.calculator.calculate_messages_tokens([block])
+        window.retrieved = sorted(selected)
+
+    def preview_tokens(self, topic_id: str, history: List[dict], system_message: dict,
+                       model: str, max_tokens: int, draft_tokens: int = 0, summary=None) -> int:
+        """草稿发送后实际会占用的输入token数（用于预算指示）"""
+        budget = input_budget(model, max_tokens)
+        _, reserved, covered = self._prefix(system_message, summary)
+        if draft_tokens:
+            reserved += draft_tokens + self.calculator.calculate_tokens("user")
+        if not history:
+            return reserved
+        start = self._window_start(topic_id, history, budget, reserved, covered,
+                                   self.window_starts.get(topic_id))
+        return reserved + self.token_index.range_tokens(topic_id, history, start)
+
+    def reset(self, topic_id: str = None):
+        """丢弃记住的窗口起点（话题被删除或重新加载时）"""
+        if topic_id is None:
+            self.window_starts.clear()
+        else:
+            self.window_starts.pop(topic_id, None)
+
+
+class PrefixCacheStats:
+    """上下文缓存命中统计
+
+    按话题累计输入token与缓存命中token；按模型用最小二乘拟合
+    首token延迟 ≈ 固定开销 + 每token预填充耗时 × 未命中token数，
+    命中token数乘以每token预填充耗时即为节省的首token延迟估计。
+    """
+
+    def __init__(self):
+        self.topics: Dict[str, dict] = {}
+        self.models: Dict[str, List[float]] = {}  # 模型 -> [n, Σx, Σy, Σx², Σxy]
+
+    def record(self, topic_id: str, model: str, usage: dict, ttft: float = None):
+        prompt = usage.get("prompt_tokens", 0)
+        hit = usage.get("prompt_cache_hit_tokens", 0)
+        stats = self.topics.setdefault(topic_id, {"requests": 0, "prompt_tokens": 0, "hit_tokens": 0, "model": model})
+        stats["requests"] += 1
+        stats["prompt_tokens"] += prompt
+        stats["hit_tokens"] += hit
+        stats["model"] = model
+        if ttft is not None and ttft > 0:
+            miss = prompt - hit
+            sums = self.models.setdefault(model, [0.0] * 5)
+            for i, value in enumerate((1.0, miss, ttft, miss * miss, miss * ttft)):
+                sums[i] += value
+
+    def prefill_seconds_per_token(self, model: str) -> float:
+        n, sx, sy, sxx, sxy = self.models.get(model, [0.0] * 5)
+        denominator = n * sxx - sx * sx
+        if n < 3 or denominator <= 0:
+            return 0.0
+        return max((n * sxy - sx * sy) / denominator, 0.0)
+
+    def topic_stats(self, topic_id: str) -> dict:
+        stats = dict(self.topics.get(topic_id, {"requests": 0, "prompt_tokens": 0, "hit_tokens": 0, "model": ""}))
+        stats["hit_rate"] = stats["hit_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] else 0.0
+        stats["saved_seconds"] = stats["hit_tokens"] * self.prefill_seconds_per_token(stats["model"])
+        return stats
+
+    def forget(self, topic_id: str):
+        self.topics.pop(topic_id, None)
+
+    def to_dict(self) -> dict:
+        return {"topics": self.topics, "models": self.models}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "PrefixCacheStats":
+        stats = cls()
+        stats.topics = dict((data or {}).get("topics", {}))
+        stats.models = dict((data or {}).get("models", {}))
+        return stats
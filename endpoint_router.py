@@ -0,0 +1,179 @@
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+from .http_pool import endpoint_key
+from .retry_policy import is_transient
+
+
+@dataclass
+class EndpointStats:
+    """一个端点的被动观测结果：来自真实请求，不额外发送探测请求"""
+    latency: Optional[float] = None  # 首token延迟（非流式为总耗时）的指数移动平均，秒
+    updated: float = 0.0  # 最近一次观测的时间（time.monotonic）
+    successes: int = 0
+    failures: int = 0
+    consecutive_failures: int = 0
+    cooldown_until: float = 0.0
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.cooldown_until
+
+
+class EndpointRouter:
+    """同一服务的多个等价端点（官方地址、镜像、代理）之间的选择与故障转移
+
+    请求发往当前最快的健康端点：按首token延迟的指数移动平均排序，尚无观测或观测已过期的端点
+    排在最前，借正常请求重新测量。连接失败、超时或5xx的端点进入冷却期，连续失败时冷却时间加倍；
+    冷却中的端点排在最后，其他端点都不可用时仍会被尝试。
+    """
+
+    def __init__(self, smoothing: float = 0.3, stale_after: float = 600.0,
+                 base_cooldown: float = 10.0, max_cooldown: float = 300.0):
+        self.smoothing = smoothing
+        self.stale_after = stale_after
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self._groups: Dict[str, List[str]] = {}  # 端点 -> 所在的等价端点组
+        self._stats: Dict[str, EndpointStats] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(base_urls: Iterable[str]) -> List[str]:
+        urls = []
+        for url in base_urls:
+            url = url.strip().rstrip("/")
+            if url and url not in urls:
+                urls.append(url)
+        return urls
+
+    @staticmethod
+    def _register(groups: Dict[str, List[str]], urls: List[str]):
+        # 新组中任一端点原来所在的组整体作废，旧组的其他成员不再指向已移除的备用端点
+        for url in urls:
+            for member in groups.get(url, []):
+                groups.pop(member, None)
+        if len(urls) > 1:
+            for url in urls:
+                groups[url] = urls
+
+    def set_group(self, base_urls: Iterable[str]):
+        """登记一组等价端点（第一个为主端点），替换其中各端点原来所在的组；只有一个端点时相当于取消备用"""
+        urls = self._normalize(base_urls)
+        if not urls:
+            return
+        with self._lock:
+            self._register(self._groups, urls)
+
+    def set_groups(self, groups: Iterable[Iterable[str]]):
+        """替换全部端点组（设置变更后调用），不再出现在设置中的旧组随之清除"""
+        registered: Dict[str, List[str]] = {}
+        for base_urls in groups:
+            self._register(registered, self._normalize(base_urls))
+        with self._lock:
+            self._groups = registered
+
+    def group(self, base_url: str) -> List[str]:
+        base_url = base_url.rstrip("/")
+        with self._lock:
+            return list(self._groups.get(base_url, [base_url]))
+
+    def ordered(self, base_url: str) -> List[str]:
+        """base_url所在组的端点，按优先顺序排列"""
+        urls = self.group(base_url)
+        now = time.monotonic()
+        with self._lock:
+            stats = [self._stats.get(endpoint_key(url)) for url in urls]
+
+        def rank(item):
+            index, url, stat = item
+            if stat is not None and not stat.healthy(now):
+                return (2, stat.cooldown_until, index)
+            if stat is None or stat.latency is None or now - stat.updated > self.stale_after:
+                return (0, 0.0, index)
+            return (1, stat.latency, index)
+
+        return [url for _, url, _ in sorted(((i, url, stat) for i, (url, stat) in enumerate(zip(urls, stats))),
+                                            key=rank)]
+
+    def best(self, base_url: str) -> str:
+        return self.ordered(base_url)[0]
+
+    def record_success(self, base_url: str, latency: Optional[float] = None):
+        now = time.monotonic()
+        with self._lock:
+            stat = self._stats.setdefault(endpoint_key(base_url), EndpointStats())
+            stat.successes += 1
+            stat.consecutive_failures = 0
+            stat.cooldown_until = 0.0
+            if latency is not None:
+                stale = stat.latency is None or now - stat.updated > self.stale_after
+                stat.latency = latency if stale else stat.latency + self.smoothing * (latency - stat.latency)
+                stat.updated = now
+
+    def record_failure(self, base_url: str) -> float:
+        """记录一次端点故障，返回冷却秒数"""
+        now = time.monotonic()
+        with self._lock:
+            stat = self._stats.setdefault(endpoint_key(base_url), EndpointStats())
+            stat.failures += 1
+            stat.consecutive_failures += 1
+            cooldown = min(self.max_cooldown, self.base_cooldown * 2 ** (stat.consecutive_failures - 1))
+            stat.cooldown_until = now + cooldown
+            return cooldown
+
+    def stats(self, base_url: str) -> Optional[EndpointStats]:
+        with self._lock:
+            stat = self._stats.get(endpoint_key(base_url))
+            return EndpointStats(**vars(stat)) if stat else None
+
+    def describe(self, base_url: str) -> List[str]:
+        """端点组的状态说明，用于界面提示"""
+        now = time.monotonic()
+        lines = []
+        for url in self.ordered(base_url):
+            stat = self.stats(url)
+            if stat is None:
+                lines.append(f"{url}: 尚无数据")
+                continue
+            state = "可用" if stat.healthy(now) else f"冷却中（{stat.cooldown_until - now:.0f}s）"
+            latency = f"{stat.latency:.2f}s" if stat.latency is not None else "-"
+            lines.append(f"{url}: {state}，首token {latency}，成功 {stat.successes} / 失败 {stat.failures}")
+        return lines
+
+
+def parse_endpoint_groups(text: str) -> Dict[str, List[str]]:
+    """解析端点组设置：每行为主端点（或提供商名称）后跟空格分隔的备用端点"""
+    groups: Dict[str, List[str]] = {}
+    for line in text.splitlines():
+        parts = line.split()
+        if len(parts) > 1:
+            groups[parts[0].rstrip("/")] = [url.rstrip("/") for url in parts[1:]]
+    return groups
+
+
+def format_endpoint_groups(groups: Dict[str, List[str]]) -> str:
+    return "\n".join(" ".join([primary] + fallbacks) for primary, fallbacks in groups.items())
+
+
+def is_endpoint_failure(exc: BaseException) -> bool:
+    """端点本身的故障（连接失败、超时、5xx），换一个端点可能成功；限流和4xx与端点无关"""
+    status = getattr(exc, "status_code", None)
+    if isinstance(status, int):
+        return status >= 500
+    return is_transient(exc)
+
+
+_shared_router = None
+_shared_router_lock = threading.Lock()
+
+
+def get_shared_router() -> EndpointRouter:
+    """获取进程内共享的端点路由"""
+    global _shared_router
+    if _shared_router is None:
+        with _shared_router_lock:
+            if _shared_router is None:
+                _shared_router = EndpointRouter()
+    return _shared_router
@@ -0,0 +1,88 @@
+"""
+获取随程序打包的DeepSeek离线词表 - 打包前运行
+
+用法: python -m src.fetch_tokenizer [--url URL] [--pin]
+
+下载tokenizer.json到tokenizers/deepseek/，按仓库中的tokenizer.json.sha256校验；
+首次获取或有意升级词表时加--pin，校验词表结构后写入新的校验值，随代码一起提交。
+"""
+
+import argparse
+import hashlib
+import sys
+import tempfile
+import urllib.request
+from pathlib import Path
+
+from .bpe_tokenizer import DEFAULT_TOKENIZER_PATH, BPETokenizer
+
+# 仓库中的校验值对应DeepSeek-V3/R1的词表：128000个BPE token + 818个特殊token，共7847602字节
+TOKENIZER_URL = "https://huggingface.co/deepseek-ai/DeepSeek-V3/resolve/main/tokenizer.json"
+CHECKSUM_PATH = DEFAULT_TOKENIZER_PATH.with_name(DEFAULT_TOKENIZER_PATH.name + ".sha256")
+
+# DeepSeek-V3/R1词表约12.8万个token，明显偏小说明下载到的不是完整词表
+MIN_VOCAB_SIZE = 100000
+
+
+def sha256_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def expected_checksum():
+    if not CHECKSUM_PATH.exists():
+        return None
+    return CHECKSUM_PATH.read_text(encoding="utf-8").split()[0].lower()
+
+
+def validate(path: Path):
+    """确认文件是可加载的byte-level BPE词表"""
+    tokenizer = BPETokenizer.from_tokenizer_json(path)
+    if len(tokenizer.encoder) < MIN_VOCAB_SIZE:
+        raise ValueError(f"词表只有{len(tokenizer.encoder)}个token，不是完整的DeepSeek词表")
+    if tokenizer.count_tokens("你好，world") <= 0:
+        raise ValueError("词表无法正常分词")
+
+
+def fetch(url: str, pin: bool) -> int:
+    expected = expected_checksum()
+    if expected is None and not pin:
+        print(f"缺少校验值文件 {CHECKSUM_PATH}，首次获取请加--pin并提交生成的校验值", file=sys.stderr)
+        return 1
+
+    DEFAULT_TOKENIZER_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=DEFAULT_TOKENIZER_PATH.parent, suffix=".part", delete=False) as tmp:
+        tmp_path = Path(tmp.name)
+    try:
+        print(f"下载 {url} ...")
+        urllib.request.urlretrieve(url, tmp_path)
+        checksum = sha256_file(tmp_path)
+        if pin:
+            validate(tmp_path)
+        elif checksum != expected:
+            print(f"校验失败: 期望 {expected}，实际 {checksum}", file=sys.stderr)
+            return 1
+        tmp_path.replace(DEFAULT_TOKENIZER_PATH)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+    if pin:
+        CHECKSUM_PATH.write_text(f"{checksum}  {DEFAULT_TOKENIZER_PATH.name}\n", encoding="utf-8")
+        print(f"已写入校验值 {CHECKSUM_PATH}")
+    print(f"词表已保存到 {DEFAULT_TOKENIZER_PATH}（sha256 {checksum}）")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="获取并校验离线DeepSeek词表")
+    parser.add_argument("--url", default=TOKENIZER_URL, help="tokenizer.json下载地址")
+    parser.add_argument("--pin", action="store_true", help="校验词表结构后更新仓库中的校验值")
+    args = parser.parse_args()
+    sys.exit(fetch(args.url, args.pin))
+
+
+if __name__ == "__main__":
+    main()
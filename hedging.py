@@ -0,0 +1,173 @@
+import asyncio
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional
+
+# 打开流式请求的协程函数，返回可异步迭代的流（SDK的AsyncStream或异步生成器）
+StreamOpener = Callable[[], Awaitable[Any]]
+
+
+class HedgePolicy:
+    """对冲请求的触发阈值和预算
+
+    阈值取该模型最近首token延迟的分位数（默认p90），样本不足时使用默认值；超过阈值仍没有首个数据块时
+    才发出副本，因此只有最慢的一成左右请求会被对冲。预算按令牌桶计：每个请求积累budget_ratio个额度，
+    每次对冲消耗1个，额外请求数长期不超过请求总数的budget_ratio。
+    """
+
+    def __init__(self, enabled: bool = False, percentile: float = 0.9, budget_ratio: float = 0.05,
+                 max_burst: float = 2.0, min_samples: int = 10, window: int = 100,
+                 default_delay: float = 3.0, min_delay: float = 0.3, max_delay: float = 10.0):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.budget_ratio = budget_ratio
+        self.max_burst = max_burst
+        self.min_samples = min_samples
+        self.window = window
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.credits = 0.0
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._samples: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def configure(self, enabled: bool, budget_ratio: Optional[float] = None):
+        with self._lock:
+            self.enabled = enabled
+            if budget_ratio is not None:
+                self.budget_ratio = max(0.0, budget_ratio)
+
+    def delay(self, model: str) -> Optional[float]:
+        """发出对冲请求前等待首个数据块的秒数；未启用时为None"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            samples = sorted(self._samples.get(model, ()))
+        if len(samples) < self.min_samples:
+            return self.default_delay
+        threshold = samples[min(len(samples) - 1, int(len(samples) * self.percentile))]
+        return min(self.max_delay, max(self.min_delay, threshold))
+
+    def record(self, model: str, ttft: Optional[float]):
+        if ttft is None:
+            return
+        with self._lock:
+            self._samples.setdefault(model, deque(maxlen=self.window)).append(ttft)
+
+    def on_request(self):
+        """每个请求为对冲预算积累额度"""
+        with self._lock:
+            self.requests += 1
+            self.credits = min(self.max_burst, self.credits + self.budget_ratio)
+
+    def try_spend(self) -> bool:
+        """预算足够时占用一次对冲"""
+        with self._lock:
+            if not self.enabled or self.credits < 1.0:
+                return False
+            self.credits -= 1.0
+            self.hedges += 1
+            return True
+
+    def record_win(self):
+        with self._lock:
+            self.hedge_wins += 1
+
+    def describe(self) -> str:
+        with self._lock:
+            if not self.hedges:
+                return f"对冲请求: 0 / {self.requests}"
+            return (f"对冲请求: {self.hedges} / {self.requests}（{self.hedges / max(self.requests, 1):.1%}），"
+                    f"其中 {self.hedge_wins} 次先返回首token")
+
+
+@dataclass
+class OpenedStream:
+    """已收到首个内容数据块的流；buffered为此前读到的数据块（含首个内容块）"""
+    stream: Any
+    buffered: List[Any] = field(default_factory=list)
+    hedged: bool = False  # 是否发出过对冲请求
+    winner: int = 0  # 0为原请求，1为对冲请求
+
+    async def chunks(self) -> AsyncIterator[Any]:
+        """先交出已读到的数据块，再继续读取流"""
+        for chunk in self.buffered:
+            yield chunk
+        async for chunk in self.stream:
+            yield chunk
+
+
+async def close_stream(stream):
+    close = getattr(stream, "aclose", None) or getattr(stream, "close", None)
+    if close is not None:
+        await close()
+
+
+async def _open_until_first(opener: StreamOpener, is_content: Callable[[Any], bool]) -> OpenedStream:
+    stream = await opener()
+    buffered = []
+    try:
+        async for chunk in stream:
+            buffered.append(chunk)
+            if is_content(chunk):
+                break
+    except BaseException:
+        await close_stream(stream)
+        raise
+    return OpenedStream(stream, buffered)
+
+
+async def hedged_open(opener: StreamOpener, start_hedge: Optional[Callable[[], Optional[StreamOpener]]],
+                      delay: Optional[float], is_content: Callable[[Any], bool]) -> OpenedStream:
+    """打开流式请求并等到首个内容数据块
+
+    delay秒内仍没有首个内容块时调用start_hedge，它返回对冲请求的opener（预算不足等情况返回None则不对冲）。
+    两个请求中先收到内容的胜出，另一个立即取消并关闭连接；其中一个失败时继续等另一个，都失败时抛出原请求的错误。
+    """
+    tasks = [asyncio.ensure_future(_open_until_first(opener, is_content))]
+    winner = None
+    try:
+        if delay is not None and start_hedge is not None:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            hedge_opener = start_hedge() if not done else None
+            if hedge_opener is not None:
+                tasks.append(asyncio.ensure_future(_open_until_first(hedge_opener, is_content)))
+        pending = set(tasks)
+        while pending and winner is None:
+            _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in tasks:
+                if task.done() and not task.cancelled() and task.exception() is None:
+                    winner = task
+                    break
+        if winner is None:
+            raise tasks[0].exception()
+        opened = winner.result()
+        opened.hedged = len(tasks) > 1
+        opened.winner = tasks.index(winner)
+        return opened
+    finally:
+        losers = [task for task in tasks if task is not winner]
+        for task in losers:
+            task.cancel()
+        for task, result in zip(losers, await asyncio.gather(*losers, return_exceptions=True)):
+            # 同时完成的另一个请求也要关闭
+            if isinstance(result, OpenedStream):
+                await close_stream(result.stream)
+
+
+_shared_hedger = None
+_shared_hedger_lock = threading.Lock()
+
+
+def get_shared_hedger() -> HedgePolicy:
+    """获取进程内共享的对冲策略"""
+    global _shared_hedger
+    if _shared_hedger is None:
+        with _shared_hedger_lock:
+            if _shared_hedger is None:
+                _shared_hedger = HedgePolicy()
+    return _shared_hedger
@@ -0,0 +1,103 @@
+import math
+import re
+from collections import Counter
+from typing import Dict, List, Tuple
+
+_WORD_PATTERN = re.compile(r'[a-z0-9_]+|[一-鿿]+')
+
+# 高频虚词不参与检索
+_STOPWORDS = {
+    "the", "a", "an", "and", "or", "of", "to", "in", "is", "it", "for", "on", "with", "that",
+    "this", "be", "are", "was", "as", "at", "by", "i", "you", "we", "can", "do",
+}
+
+RETRIEVAL_HEADER = "以下是本话题较早对话中与当前问题相关的片段，供参考：\n"
+
+
+def tokenize(text: str) -> List[str]:
+    """检索用分词：英文按单词（小写），汉字按相邻二元组（单字成词时保留单字）"""
+    terms = []
+    for match in _WORD_PATTERN.finditer(text.lower()):
+        word = match.group()
+        if word[0] >= "一":
+            if len(word) == 1:
+                terms.append(word)
+            else:
+                terms.extend(word[i:i + 2] for i in range(len(word) - 1))
+        elif word not in _STOPWORDS:
+            terms.append(word)
+    return terms
+
+
+class _TopicIndex:
+    def __init__(self):
+        self.postings: Dict[str, List[Tuple[int, int]]] = {}  # 词 -> [(消息下标, 词频)]
+        self.lengths: List[int] = []
+        self.total_length = 0
+
+    def add(self, text: str):
+        doc = len(self.lengths)
+        counts = Counter(tokenize(text))
+        for term, tf in counts.items():
+            self.postings.setdefault(term, []).append((doc, tf))
+        length = sum(counts.values())
+        self.lengths.append(length)
+        self.total_length += length
+
+
+class HistoryRetriever:
+    """话题内的BM25检索
+
+    每个话题维护倒排索引，新消息追加时增量加入；消息被删除时重建。
+    倒排表按消息下标递增，检索时只统计指定下标之前（未随窗口发送）的消息。
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.topics: Dict[str, _TopicIndex] = {}
+
+    def sync(self, topic_id: str, messages: List[dict]) -> _TopicIndex:
+        index = self.topics.get(topic_id)
+        if index is None or len(index.lengths) > len(messages):
+            index = _TopicIndex()
+            self.topics[topic_id] = index
+        for message in messages[len(index.lengths):]:
+            index.add(message.get("content", ""))
+        return index
+
+    def invalidate(self, topic_id: str = None):
+        if topic_id is None:
+            self.topics.clear()
+        else:
+            self.topics.pop(topic_id, None)
+
+    def search(self, topic_id: str, messages: List[dict], query: str, end: int) -> List[Tuple[float, int]]:
+        """在messages[:end]中检索与query相关的消息，按得分从高到低返回(得分, 下标)"""
+        index = self.sync(topic_id, messages)
+        doc_count = len(index.lengths)
+        if end <= 0 or not doc_count:
+            return []
+        average_length = index.total_length / doc_count or 1.0
+
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            postings = index.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc, tf in postings:
+                if doc >= end:
+                    break
+                norm = self.k1 * (1 - self.b + self.b * index.lengths[doc] / average_length)
+                scores[doc] = scores.get(doc, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        return sorted(((score, doc) for doc, score in scores.items()), reverse=True)
+
+
+def format_retrieved(messages: List[dict], indices: List[int]) -> dict:
+    """把检索到的消息按原顺序合并为一条系统消息"""
+    parts = []
+    for i in sorted(indices):
+        role = "用户" if messages[i].get("role") == "user" else "AI"
+        parts.append(f"[第{i + 1}条 {role}] {messages[i].get('content', '')}")
+    return {"role": "system", "content": RETRIEVAL_HEADER + "\n\n".join(parts)}
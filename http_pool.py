@@ -0,0 +1,294 @@
+import argparse
+import contextvars
+import hashlib
+import importlib.util
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+from openai import AsyncOpenAI, OpenAI
+
+# 安装了h2时启用HTTP/2，同一连接上可并发多个流
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# httpcore在新建连接时上报的事件
+_CONNECT_EVENTS = ("connection.connect_tcp.complete", "connection.start_tls.complete")
+_SSE_DONE = b"data: [DONE]"
+
+# 当前请求的连接情况；按线程/异步任务隔离，并发请求互不干扰
+_request_state: contextvars.ContextVar = contextvars.ContextVar("request_state", default=None)
+
+
+def endpoint_key(base_url: str) -> str:
+    """连接复用的粒度：协议+主机+端口"""
+    parts = urlsplit(base_url)
+    return f"{parts.scheme}://{parts.netloc}".lower()
+
+
+class _SSEByteStream(httpx.SyncByteStream):
+    """SDK读到[DONE]就关闭响应，HTTP/1.1下未读完的响应体会让连接被丢弃。
+
+    已经收到[DONE]时先读完剩余的结束标记再关闭，连接得以放回连接池；
+    中途取消的流不受影响，直接关闭。
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._iterator = iter(stream)
+        self._tail = b""
+
+    def __iter__(self):
+        for chunk in self._iterator:
+            self._tail = (self._tail + chunk)[-64:]
+            yield chunk
+
+    def close(self):
+        if _SSE_DONE in self._tail:
+            for _ in self._iterator:
+                pass
+        self._stream.close()
+
+
+class _AsyncSSEByteStream(httpx.AsyncByteStream):
+    """_SSEByteStream的异步版本"""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._iterator = stream.__aiter__()
+        self._tail = b""
+
+    async def __aiter__(self):
+        async for chunk in self._iterator:
+            self._tail = (self._tail + chunk)[-64:]
+            yield chunk
+
+    async def aclose(self):
+        if _SSE_DONE in self._tail:
+            async for _ in self._iterator:
+                pass
+        await self._stream.aclose()
+
+
+class ConnectionPool:
+    """按端点共享的长连接HTTP客户端
+
+    每个端点只建一个httpx.Client，保持keep-alive连接（可用时走HTTP/2），
+    同一端点不同密钥的OpenAI客户端共用它，后续请求省去TCP/TLS握手。
+    同步客户端线程安全，可在任意线程使用；异步客户端绑定创建它的事件循环，
+    只应在请求引擎的线程中使用。
+    """
+
+    def __init__(self, max_connections: int = 20, max_keepalive: int = 10,
+                 keepalive_expiry: float = 120.0, timeout: float = 120.0, connect_timeout: float = 10.0):
+        self.limits = httpx.Limits(max_connections=max_connections,
+                                   max_keepalive_connections=max_keepalive,
+                                   keepalive_expiry=keepalive_expiry)
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self._http_clients: Dict[str, httpx.Client] = {}
+        self._async_http_clients: Dict[str, httpx.AsyncClient] = {}
+        self._clients: Dict[Tuple[str, str, bool], object] = {}
+        self._ttft: Dict[str, Dict[str, list]] = {}  # 端点 -> {"warm"/"cold": [次数, 总秒数]}
+        self._lock = threading.Lock()
+
+    def http_client(self, base_url: str) -> httpx.Client:
+        key = endpoint_key(base_url)
+        with self._lock:
+            client = self._http_clients.get(key)
+            if client is None:
+                client = httpx.Client(http2=HTTP2_AVAILABLE, limits=self.limits, timeout=self.timeout,
+                                      event_hooks={"request": [self._on_request],
+                                                   "response": [self._on_response]})
+                self._http_clients[key] = client
+            return client
+
+    def async_http_client(self, base_url: str) -> httpx.AsyncClient:
+        key = endpoint_key(base_url)
+        with self._lock:
+            client = self._async_http_clients.get(key)
+            if client is None:
+                client = httpx.AsyncClient(http2=HTTP2_AVAILABLE, limits=self.limits, timeout=self.timeout,
+                                           event_hooks={"request": [self._on_async_request],
+                                                        "response": [self._on_async_response]})
+                self._async_http_clients[key] = client
+            return client
+
+    def client(self, base_url: str, api_key: str):
+        """获取该端点和密钥对应的OpenAI客户端"""
+        return self._sdk_client(OpenAI, self.http_client, base_url, api_key)
+
+    def async_client(self, base_url: str, api_key: str):
+        """获取该端点和密钥对应的AsyncOpenAI客户端"""
+        return self._sdk_client(AsyncOpenAI, self.async_http_client, base_url, api_key)
+
+    def async_anthropic_client(self, base_url: str, api_key: str):
+        """获取AsyncAnthropic客户端
+
+        新版SDK改用自带的HTTP库，不接受httpx客户端，因此按端点和密钥缓存整个客户端来保持其连接。
+        """
+        from anthropic import AsyncAnthropic
+        return self._sdk_client(AsyncAnthropic, None, base_url, api_key)
+
+    def _sdk_client(self, factory, http_client, base_url: str, api_key: str):
+        key = (base_url.rstrip("/"), hashlib.sha256(api_key.encode("utf-8")).hexdigest(),
+               factory.__name__)
+        with self._lock:
+            client = self._clients.get(key)
+        if client is None:
+            options = {"http_client": http_client(base_url)} if http_client else {}
+            # 关闭SDK自带的重试，由RetryPolicy统一处理（含Retry-After和流式续写）
+            client = factory(api_key=api_key, base_url=base_url, max_retries=0, **options)
+            with self._lock:
+                client = self._clients.setdefault(key, client)
+        return client
+
+    def begin_request(self):
+        """在发起请求的线程或异步任务中调用，开始记录本次请求是否新建了连接"""
+        _request_state.set({"new_connection": None, "http_version": "", "rate_limit_headers": {}})
+
+    def connection_info(self) -> dict:
+        """当前线程/任务上一次请求的连接情况：warm为复用已有连接，cold为新建连接，未收到响应时为unknown"""
+        state = _request_state.get() or {}
+        return {"connection": {True: "cold", False: "warm"}.get(state.get("new_connection"), "unknown"),
+                "http_version": state.get("http_version", "")}
+
+    def rate_limit_headers(self) -> Dict[str, str]:
+        """当前线程/任务上一次响应中与限额相关的响应头，供限流器校正额度"""
+        state = _request_state.get() or {}
+        return state.get("rate_limit_headers", {})
+
+    def _on_request(self, request: httpx.Request):
+        state = _request_state.get()
+        if state is not None:
+            def trace(event: str, info: dict):
+                if event in _CONNECT_EVENTS:
+                    state["new_connection"] = True
+            request.extensions["trace"] = trace
+
+    def _on_response(self, response: httpx.Response):
+        self._record_response(response)
+        if response.headers.get("content-type", "").startswith("text/event-stream"):
+            response.stream = _SSEByteStream(response.stream)
+
+    async def _on_async_request(self, request: httpx.Request):
+        state = _request_state.get()
+        if state is not None:
+            async def trace(event: str, info: dict):
+                if event in _CONNECT_EVENTS:
+                    state["new_connection"] = True
+            request.extensions["trace"] = trace
+
+    async def _on_async_response(self, response: httpx.Response):
+        self._record_response(response)
+        if response.headers.get("content-type", "").startswith("text/event-stream"):
+            response.stream = _AsyncSSEByteStream(response.stream)
+
+    @staticmethod
+    def _record_response(response: httpx.Response):
+        state = _request_state.get()
+        if state is not None:
+            if state["new_connection"] is None:
+                state["new_connection"] = False
+            state["http_version"] = response.http_version
+            state["rate_limit_headers"] = {k: v for k, v in response.headers.items() if "ratelimit" in k}
+
+    def record_ttft(self, base_url: str, connection: str, ttft: Optional[float]):
+        if ttft is None or connection not in ("warm", "cold"):
+            return
+        with self._lock:
+            stats = self._ttft.setdefault(endpoint_key(base_url), {}).setdefault(connection, [0, 0.0])
+            stats[0] += 1
+            stats[1] += ttft
+
+    def ttft_stats(self, base_url: str) -> Dict[str, Tuple[int, float]]:
+        """端点的首token延迟统计：{"warm"/"cold": (次数, 平均秒数)}"""
+        with self._lock:
+            stats = self._ttft.get(endpoint_key(base_url), {})
+            return {kind: (count, total / count) for kind, (count, total) in stats.items() if count}
+
+    def close(self):
+        with self._lock:
+            clients = list(self._http_clients.values())
+            self._http_clients.clear()
+            self._clients = {k: v for k, v in self._clients.items() if k[2] != "OpenAI"}
+        for client in clients:
+            client.close()
+
+    async def aclose(self):
+        """关闭异步客户端，需在创建它们的事件循环中调用"""
+        with self._lock:
+            clients = list(self._async_http_clients.values())
+            self._async_http_clients.clear()
+            sdk_clients = [v for k, v in self._clients.items() if k[2] == "AsyncAnthropic"]
+            self._clients = {k: v for k, v in self._clients.items() if not k[2].startswith("Async")}
+        for client in clients:
+            await client.aclose()
+        for client in sdk_clients:
+            await client.close()
+
+
+_shared_pool = None
+_shared_pool_lock = threading.Lock()
+
+
+def get_shared_pool() -> ConnectionPool:
+    """获取进程内共享的连接池"""
+    global _shared_pool
+    if _shared_pool is None:
+        with _shared_pool_lock:
+            if _shared_pool is None:
+                _shared_pool = ConnectionPool()
+    return _shared_pool
+
+
+def measure_ttft(pool: ConnectionPool, base_url: str, api_key: str, model: str) -> Tuple[str, float]:
+    """发送一条最短的流式请求，返回(连接情况, 首token延迟秒数)"""
+    client = pool.client(base_url, api_key)
+    pool.begin_request()
+    started = time.perf_counter()
+    stream = client.chat.completions.create(
+        model=model, messages=[{"role": "user", "content": "hi"}], max_tokens=1, stream=True)
+    ttft = None
+    for chunk in stream:
+        if ttft is None and chunk.choices:
+            ttft = time.perf_counter() - started
+    info = pool.connection_info()
+    return info["connection"], ttft if ttft is not None else time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="对比新建连接与复用连接的首token延迟")
+    parser.add_argument("--base-url", default="https://api.deepseek.com")
+    parser.add_argument("--model", default="deepseek-chat")
+    parser.add_argument("--requests", type=int, default=5, help="每种情况的请求次数")
+    args = parser.parse_args()
+    api_key = os.environ.get("DEEPSEEK_API_KEY")
+    if not api_key:
+        parser.error("请通过环境变量DEEPSEEK_API_KEY提供API密钥")
+
+    results = {"cold": [], "warm": []}
+    for _ in range(args.requests):
+        # 每次使用新的连接池，必然新建连接
+        cold_pool = ConnectionPool()
+        results["cold"].append(measure_ttft(cold_pool, args.base_url, api_key, args.model)[1])
+        cold_pool.close()
+
+    pool = ConnectionPool()
+    measure_ttft(pool, args.base_url, api_key, args.model)  # 预热
+    for _ in range(args.requests):
+        connection, ttft = measure_ttft(pool, args.base_url, api_key, args.model)
+        results[connection].append(ttft)
+    pool.close()
+
+    print(f"HTTP/2: {'启用' if HTTP2_AVAILABLE else '未安装h2，使用HTTP/1.1'}")
+    for kind, label in (("cold", "新建连接"), ("warm", "复用连接")):
+        samples = sorted(results[kind])
+        if samples:
+            print(f"{label}: {len(samples)}次，平均 {sum(samples) / len(samples) * 1000:.0f}ms，"
+                  f"中位数 {samples[len(samples) // 2] * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
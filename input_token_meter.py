@@ -0,0 +1,142 @@
+import re
+import threading
+from bisect import bisect_right
+from itertools import accumulate
+from typing import List
+
+from PySide6.QtCore import QThread, Signal
+
+# 分段位置：换行符之后紧跟非空白字符处。预分词片段不会跨越这种位置，
+# 英文单词也不会被切断，因此各段计数之和与整体计算完全一致
+_SEGMENT_BOUNDARY = re.compile(r'(?<=\n)(?=\S)')
+
+
+def _split_segments(text: str) -> List[str]:
+    return [segment for segment in _SEGMENT_BOUNDARY.split(text) if segment]
+
+
+def _common_prefix(a: str, b: str) -> int:
+    """公共前缀长度（分段比较，总开销O(n)）"""
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _common_suffix(a: str, b: str, limit: int) -> int:
+    """公共后缀长度，不超过limit"""
+    lo, hi = 0, limit
+    la, lb = len(a), len(b)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[la - mid:la - lo] == b[lb - mid:lb - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+class IncrementalTextCounter:
+    """按行分段缓存token数，文本变化时只对编辑区域所在的段重新计数"""
+
+    def __init__(self, calculator):
+        self.calculator = calculator
+        self.exact = calculator.is_exact
+        self.text = ""
+        self.segments: List[str] = []
+        self.units: List[int] = []  # 每段的token数（近似模式下为权重，最后统一取整）
+        self.total_units = 0
+
+    def _count(self, segment: str) -> int:
+        if self.exact:
+            return self.calculator.calculate_tokens(segment)
+        return self.calculator.estimate_weight(segment)
+
+    @property
+    def tokens(self) -> int:
+        return self.total_units if self.exact else self.total_units // 10
+
+    def reset(self):
+        self.exact = self.calculator.is_exact
+        self.text = ""
+        self.segments = []
+        self.units = []
+        self.total_units = 0
+
+    def update(self, text: str) -> int:
+        """更新为新文本并返回token数"""
+        old = self.text
+        if text == old:
+            return self.tokens
+        if not self.segments:
+            self.segments = _split_segments(text)
+            self.units = [self._count(s) for s in self.segments]
+            self.total_units = sum(self.units)
+            self.text = text
+            return self.tokens
+
+        prefix = _common_prefix(old, text)
+        suffix = _common_suffix(old, text, min(len(old), len(text)) - prefix)
+        starts = [0] + list(accumulate(len(s) for s in self.segments))
+
+        # 编辑可能合并或拆分相邻段，向前、向后各多取一段，保证区域两端仍是分段边界
+        first = max(bisect_right(starts, prefix) - 2, 0)
+        last = min(bisect_right(starts, len(old) - suffix), len(self.segments) - 1)
+        region_start = starts[first]
+        region_end = starts[last + 1] + len(text) - len(old)
+
+        new_segments = _split_segments(text[region_start:region_end])
+        new_units = [self._count(s) for s in new_segments]
+        self.total_units += sum(new_units) - sum(self.units[first:last + 1])
+        self.segments[first:last + 1] = new_segments
+        self.units[first:last + 1] = new_units
+        self.text = text
+        return self.tokens
+
+
+class InputTokenMeter(QThread):
+    """在后台线程中计算输入框草稿的token数
+
+    只处理最新一次提交，连续输入或大段粘贴时中间状态直接丢弃，不会阻塞界面。
+    """
+    counted = Signal(int, int)  # 提交序号, token数
+
+    def __init__(self, calculator, parent=None):
+        super().__init__(parent)
+        self.counter = IncrementalTextCounter(calculator)
+        self._condition = threading.Condition()
+        self._pending = None
+        self._serial = 0
+        self._stopping = False
+
+    def submit(self, text: str) -> int:
+        """提交新的草稿文本，返回提交序号"""
+        with self._condition:
+            self._serial += 1
+            self._pending = (self._serial, text)
+            self._condition.notify()
+            return self._serial
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self.wait()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while self._pending is None and not self._stopping:
+                    self._condition.wait()
+                if self._stopping:
+                    return
+                serial, text = self._pending
+                self._pending = None
+
+            if self.counter.exact != self.counter.calculator.is_exact:
+                self.counter.reset()
+            self.counted.emit(serial, self.counter.update(text))
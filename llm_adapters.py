@@ -1,8 +1,12 @@
-from typing import Dict, Any, Optional
-import httpx
+import json
+from typing import AsyncIterator, Dict, Any, Optional
 from dataclasses import dataclass
 from enum import Enum
 
+from .http_pool import get_shared_pool
+from .retry_policy import continuation_messages, deepseek_beta_url
+from .usage_calibration import ServerUsage
+
 class LLMProvider(Enum):
     OPENAI = "openai"
     GEMINI = "gemini"
@@ -11,6 +15,18 @@ class LLMProvider(Enum):
     OLLAMA = "ollama"
     LM_STUDIO = "lm_studio"
 
+# 未配置base_url时使用的默认地址
+DEFAULT_BASE_URLS = {
+    LLMProvider.OPENAI: "https://api.openai.com/v1",
+    LLMProvider.DEEPSEEK: "https://api.deepseek.com",
+    LLMProvider.ANTHROPIC: "https://api.anthropic.com",
+    LLMProvider.OLLAMA: "http://localhost:11434",
+    LLMProvider.LM_STUDIO: "http://localhost:1234/v1",
+}
+
+# 使用OpenAI兼容接口的提供商
+OPENAI_COMPATIBLE = (LLMProvider.OPENAI, LLMProvider.DEEPSEEK, LLMProvider.LM_STUDIO)
+
 @dataclass
 class LLMConfig:
     provider: LLMProvider
@@ -20,80 +36,241 @@ class LLMConfig:
     temperature: float = 0.7
     max_tokens: int = 2000
 
+@dataclass
+class ChatChunk:
+    """流式响应中的一个增量；usage只在携带用量的数据块上出现"""
+    content: str = ""
+    reasoning: str = ""
+    usage: Optional[ServerUsage] = None
+
+@dataclass
+class ChatResponse:
+    """非流式响应"""
+    content: str
+    model: str
+    reasoning: str = ""
+    usage: Optional[ServerUsage] = None
+
+def _split_system(messages: list[dict]):
+    """Anthropic/Gemini的系统提示单独传递"""
+    system = "\n\n".join(m["content"] for m in messages if m.get("role") == "system")
+    return system, [m for m in messages if m.get("role") != "system"]
+
 class LLMAdapter:
-    """统一的多模型服务适配器"""
-    
+    """统一的多模型服务适配器
+
+    各提供商都使用原生异步客户端（AsyncOpenAI、AsyncAnthropic、httpx.AsyncClient），
+    流式响应统一为ChatChunk的异步迭代器，多个提供商的请求可以在同一个事件循环中并发。
+    客户端都取自共享连接池，同一端点的请求复用已建立的连接。
+    """
+
     def __init__(self, config: LLMConfig):
         self.config = config
+        self.base_url = config.base_url or DEFAULT_BASE_URLS.get(config.provider)
         self.client = self._initialize_client()
-        
+
     def _initialize_client(self):
-        """根据配置初始化客户端"""
-        if self.config.provider == LLMProvider.OPENAI:
-            from openai import OpenAI
-            return OpenAI(api_key=self.config.api_key, base_url=self.config.base_url)
+        """根据配置初始化异步客户端"""
+        pool = get_shared_pool()
+        if self.config.provider in OPENAI_COMPATIBLE:
+            return pool.async_client(self.base_url, self.config.api_key)
         elif self.config.provider == LLMProvider.GEMINI:
             import google.generativeai as genai
             genai.configure(api_key=self.config.api_key)
             return genai
         elif self.config.provider == LLMProvider.ANTHROPIC:
-            import anthropic
-            return anthropic.Anthropic(api_key=self.config.api_key)
+            return pool.async_anthropic_client(self.base_url, self.config.api_key)
         elif self.config.provider == LLMProvider.OLLAMA:
-            return httpx.Client(base_url=self.config.base_url or "http://localhost:11434")
+            return pool.async_http_client(self.base_url)
         else:
             raise ValueError(f"Unsupported provider: {self.config.provider}")
-    
+
     async def chat_completion(self, messages: list[dict], stream: bool = False):
-        """统一聊天补全接口"""
-        if self.config.provider == LLMProvider.OPENAI:
-            return await self._openai_chat(messages, stream)
+        """统一聊天补全接口：非流式返回ChatResponse，流式返回ChatChunk的异步迭代器"""
+        if stream:
+            return self.stream_chat(messages)
+        if self.config.provider in OPENAI_COMPATIBLE:
+            return await self._openai_chat(messages)
         elif self.config.provider == LLMProvider.GEMINI:
             return await self._gemini_chat(messages)
         elif self.config.provider == LLMProvider.ANTHROPIC:
-            return await self._anthropic_chat(messages, stream)
+            return await self._anthropic_chat(messages)
         elif self.config.provider == LLMProvider.OLLAMA:
-            return await self._ollama_chat(messages, stream)
-    
-    async def _openai_chat(self, messages: list[dict], stream: bool):
+            return await self._ollama_chat(messages)
+
+    @property
+    def supports_prefix(self) -> bool:
+        """是否支持以已生成的回答为前缀续写（DeepSeek对话前缀续写、Anthropic预填充）"""
+        return self.config.provider in (LLMProvider.DEEPSEEK, LLMProvider.ANTHROPIC)
+
+    def stream_chat(self, messages: list[dict], prefix: str = "") -> AsyncIterator[ChatChunk]:
+        """流式聊天，逐个产出ChatChunk；prefix为中断前已收到的回答，仅在supports_prefix时可用"""
+        if prefix and not self.supports_prefix:
+            raise ValueError(f"{self.config.provider.value} 不支持前缀续写")
+        if self.config.provider in OPENAI_COMPATIBLE:
+            return self._openai_stream(messages, prefix)
+        elif self.config.provider == LLMProvider.GEMINI:
+            return self._gemini_stream(messages)
+        elif self.config.provider == LLMProvider.ANTHROPIC:
+            if prefix:
+                # 以assistant消息结尾时Anthropic从该内容继续生成；末尾不能有空白
+                messages = messages + [{"role": "assistant", "content": prefix.rstrip()}]
+            return self._anthropic_stream(messages)
+        elif self.config.provider == LLMProvider.OLLAMA:
+            return self._ollama_stream(messages)
+        raise ValueError(f"Unsupported provider: {self.config.provider}")
+
+    async def _openai_chat(self, messages: list[dict]) -> ChatResponse:
         """处理OpenAI风格API调用"""
         response = await self.client.chat.completions.create(
             model=self.config.model,
             messages=messages,
-            stream=stream,
             temperature=self.config.temperature,
             max_tokens=self.config.max_tokens
         )
-        return response
-    
-    async def _gemini_chat(self, messages: list[dict]):
-        """处理Gemini API调用"""
-        model = self.client.GenerativeModel(self.config.model)
-        chat = model.start_chat()
-        response = await chat.send_message(messages[-1]["content"])
-        return response.text
-    
-    async def _anthropic_chat(self, messages: list[dict], stream: bool):
-        """处理Anthropic API调用"""
-        message = self.client.messages.create(
+        message = response.choices[0].message
+        return ChatResponse(content=message.content or "", model=response.model,
+                            reasoning=getattr(message, 'reasoning_content', None) or "",
+                            usage=ServerUsage.from_usage(getattr(response, 'usage', None)))
+
+    async def _openai_stream(self, messages: list[dict], prefix: str = ""):
+        client = self.client
+        if prefix:
+            client = get_shared_pool().async_client(deepseek_beta_url(self.base_url), self.config.api_key)
+            messages = continuation_messages(messages, prefix)
+        stream = await client.chat.completions.create(
             model=self.config.model,
             messages=messages,
-            max_tokens=self.config.max_tokens,
+            stream=True,
             temperature=self.config.temperature,
-            stream=stream
+            max_tokens=self.config.max_tokens,
+            # 让服务端在最后一个数据块中返回真实用量
+            stream_options={"include_usage": True}
         )
-        return message
-    
-    async def _ollama_chat(self, messages: list[dict], stream: bool):
-        """处理Ollama本地模型调用"""
-        payload = {
+        async with stream:
+            async for chunk in stream:
+                # 最后一个数据块（choices为空）携带用量
+                usage = ServerUsage.from_usage(getattr(chunk, 'usage', None))
+                delta = chunk.choices[0].delta if chunk.choices else None
+                content = getattr(delta, 'content', None) or ""
+                reasoning = getattr(delta, 'reasoning_content', None) or ""
+                if content or reasoning or usage:
+                    yield ChatChunk(content=content, reasoning=reasoning, usage=usage)
+
+    def _gemini_request(self, messages: list[dict]):
+        system, messages = _split_system(messages)
+        model = self.client.GenerativeModel(self.config.model, system_instruction=system or None)
+        contents = [{"role": "model" if m.get("role") == "assistant" else "user", "parts": [m["content"]]}
+                    for m in messages]
+        generation_config = {"temperature": self.config.temperature,
+                             "max_output_tokens": self.config.max_tokens}
+        return model, contents, generation_config
+
+    @staticmethod
+    def _gemini_usage(response) -> Optional[ServerUsage]:
+        metadata = getattr(response, 'usage_metadata', None)
+        if not metadata or not getattr(metadata, 'prompt_token_count', 0):
+            return None
+        return ServerUsage.from_usage({"prompt_tokens": metadata.prompt_token_count,
+                                       "completion_tokens": getattr(metadata, 'candidates_token_count', 0) or 0})
+
+    @staticmethod
+    def _gemini_text(response) -> str:
+        # response.text在没有文本部分时抛出ValueError（如因SAFETY、RECITATION、MAX_TOKENS结束的最后一个数据块），
+        # 直接从首个候选的parts中取文本
+        candidates = getattr(response, 'candidates', None)
+        if not candidates:
+            return ""
+        return "".join(getattr(part, 'text', "") or "" for part in candidates[0].content.parts)
+
+    async def _gemini_chat(self, messages: list[dict]) -> ChatResponse:
+        """处理Gemini API调用"""
+        model, contents, generation_config = self._gemini_request(messages)
+        response = await model.generate_content_async(contents, generation_config=generation_config)
+        return ChatResponse(content=self._gemini_text(response), model=self.config.model,
+                            usage=self._gemini_usage(response))
+
+    async def _gemini_stream(self, messages: list[dict]):
+        model, contents, generation_config = self._gemini_request(messages)
+        response = await model.generate_content_async(contents, generation_config=generation_config, stream=True)
+        usage = None
+        async for chunk in response:
+            usage = self._gemini_usage(chunk) or usage
+            text = self._gemini_text(chunk)
+            if text:
+                yield ChatChunk(content=text)
+        # 每个数据块携带累计用量，结束时上报最后一次
+        if usage:
+            yield ChatChunk(usage=usage)
+
+    def _anthropic_request(self, messages: list[dict]) -> Dict[str, Any]:
+        system, messages = _split_system(messages)
+        # temperature放在请求体中传递，新旧版本的SDK都能接受
+        request = {"model": self.config.model, "messages": messages, "max_tokens": self.config.max_tokens,
+                   "extra_body": {"temperature": self.config.temperature}}
+        if system:
+            request["system"] = system
+        return request
+
+    async def _anthropic_chat(self, messages: list[dict]) -> ChatResponse:
+        """处理Anthropic API调用"""
+        message = await self.client.messages.create(**self._anthropic_request(messages))
+        content = "".join(block.text for block in message.content if block.type == "text")
+        reasoning = "".join(block.thinking for block in message.content if block.type == "thinking")
+        return ChatResponse(content=content, model=message.model, reasoning=reasoning,
+                            usage=ServerUsage.from_usage(message.usage))
+
+    async def _anthropic_stream(self, messages: list[dict]):
+        stream = await self.client.messages.create(stream=True, **self._anthropic_request(messages))
+        usage = None
+        async with stream:
+            async for event in stream:
+                # message_start携带输入用量，message_delta携带输出用量
+                if event.type == "message_start":
+                    usage = ServerUsage.from_usage(event.message.usage)
+                elif event.type == "message_delta":
+                    delta_usage = ServerUsage.from_usage(event.usage)
+                    usage = delta_usage.merge(usage) if delta_usage else usage
+                elif event.type == "content_block_delta":
+                    if event.delta.type == "text_delta":
+                        yield ChatChunk(content=event.delta.text)
+                    elif event.delta.type == "thinking_delta":
+                        yield ChatChunk(reasoning=event.delta.thinking)
+        if usage:
+            yield ChatChunk(usage=usage)
+
+    def _ollama_payload(self, messages: list[dict], stream: bool) -> Dict[str, Any]:
+        return {
             "model": self.config.model,
             "messages": messages,
             "stream": stream,
             "options": {
                 "temperature": self.config.temperature,
-                "max_tokens": self.config.max_tokens
+                "num_predict": self.config.max_tokens
             }
         }
-        response = await self.client.post("/api/chat", json=payload)
-        return response.json()
\ No newline at end of file
+
+    async def _ollama_chat(self, messages: list[dict]) -> ChatResponse:
+        """处理Ollama本地模型调用"""
+        response = await self.client.post(f"{self.base_url}/api/chat",
+                                          json=self._ollama_payload(messages, False))
+        response.raise_for_status()
+        data = response.json()
+        message = data.get("message", {})
+        return ChatResponse(content=message.get("content", ""), model=data.get("model", self.config.model),
+                            reasoning=message.get("thinking", ""), usage=ServerUsage.from_usage(data))
+
+    async def _ollama_stream(self, messages: list[dict]):
+        async with self.client.stream("POST", f"{self.base_url}/api/chat",
+                                      json=self._ollama_payload(messages, True)) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.strip():
+                    continue
+                chunk = json.loads(line)
+                message = chunk.get("message") or {}
+                # 最后一个数据块（done为真）携带prompt_eval_count/eval_count
+                usage = ServerUsage.from_usage(chunk) if chunk.get("done") else None
+                if message.get("content") or message.get("thinking") or usage:
+                    yield ChatChunk(content=message.get("content", ""),
+                                    reasoning=message.get("thinking", ""), usage=usage)
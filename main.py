@@ -7,9 +7,9 @@ import mimetypes
 import base64
 import re
 import hashlib
+import time
+import asyncio
 from datetime import datetime
-from threading import Thread
-from queue import Queue
 import secrets
 from typing import Optional
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
@@ -25,20 +25,43 @@ from PySide6.QtWidgets import (QApplication, QMainWindow, QVBoxLayout, QHBoxLayo
                              QTreeWidgetItem, QHeaderView, QDialog, QDialogButtonBox,
                              QFormLayout, QSpinBox, QDoubleSpinBox, QSystemTrayIcon,
                              QInputDialog, QProgressDialog, QStyle, QStackedWidget)
-from PySide6.QtCore import (Qt, QThread, Signal, QPropertyAnimation, QEasingCurve, 
-                         QTimer, QSize, QPoint, QSettings, QMimeData, QUrl, QDateTime)
+from PySide6.QtCore import (Qt, Signal, QPropertyAnimation, QEasingCurve, 
+                         QTimer, QSize, QPoint, QSettings, QMimeData, QUrl, QDateTime,
+                         QStandardPaths)
 from PySide6.QtGui import (QFont, QPalette, QColor, QTextCharFormat, QSyntaxHighlighter, 
                         QKeySequence, QIcon, QPixmap, QTextCursor, QDrag, QTextDocument,
                         QFontMetrics, QPainter, QPen, QLinearGradient, QAction,
                         QGuiApplication)
 from PySide6.QtWebEngineWidgets import QWebEngineView
 from PySide6.QtWebChannel import QWebChannel
-from openai import OpenAI
+from src.endpoint_router import (get_shared_router, is_endpoint_failure, parse_endpoint_groups,
+                                  format_endpoint_groups)
+from src.llm_adapters import DEFAULT_BASE_URLS, LLMProvider
+from src.hedging import get_shared_hedger, hedged_open
+from src.api_key_test import APIKeyTestJob
+from src.http_pool import get_shared_pool
+from src.rate_limiter import DEFAULT_LIMITS, RateLimit, get_shared_limiter
+from src.request_engine import AsyncJob, get_engine
+from src.request_scheduler import RequestScheduler
+from src.retry_policy import RetryPolicy, continuation_messages, deepseek_beta_url, describe_error
 from src.assistant_dialog import AssistantDialog
+from src.compare_dialog import CompareDialog
 from src.assistant_manager import AssistantManager
+from src.token_calculator import get_shared_calculator
+from src.topic_token_index import TopicTokenIndex
+from src.usage_calibration import AttemptUsage, ServerUsage, UsageCalibrator
+from src.usage_ledger import PriceTable, UsageLedger, format_costs, summarize_messages
+from src.context_budget import ContextBuilder, PrefixCacheStats, input_budget
+from src.input_token_meter import InputTokenMeter
+from src.rolling_summary import RollingSummaryCache, SummaryState, SummaryWorker
+from src.history_retrieval import HistoryRetriever
+from src.prompt_compression import compress_messages
+from src.attachment_chunks import Attachment, INLINE_ATTACHMENT_TOKENS, MAX_ATTACHMENT_SHARE
 
 # API配置
 DEFAULT_BASE_URL = "https://api.deepseek.com"
+# 系统提示保持逐字节不变（不含时间等动态内容），作为所有请求共享的缓存前缀
+SYSTEM_PROMPT = "You are a helpful assistant"
 
 class SecureAPIKeyManager:
     """安全的API密钥管理器 - 使用AES加密存储"""
@@ -242,48 +265,8 @@ class SecureAPIKeyManager:
             return False
 
 # 其余代码保持不变...
-class TokenCalculator:
-    """Token计算器 - 使用近似算法"""
-    
-    def __init__(self):
-        self.token_cache = {}
-        
-    def calculate_tokens(self, text):
-        """计算文本的token数量（近似值）"""
-        if not text:
-            return 0
-            
-        # 使用缓存
-        if text in self.token_cache:
-            return self.token_cache[text]
-        
-        # 近似算法：对于中文，一个汉字约2-3个token，英文单词约1.3个token
-        chinese_chars = len(re.findall(r'[\u4e00-\u9fff]', text))
-        english_words = len(re.findall(r'[a-zA-Z]+', text))
-        other_chars = len(text) - chinese_chars - sum(len(word) for word in re.findall(r'[a-zA-Z]+', text))
-        
-        # 近似计算
-        tokens = chinese_chars * 2.5 + english_words * 1.3 + other_chars * 0.8
-        tokens = int(tokens)
-        
-        self.token_cache[text] = tokens
-        return tokens
-    
-    def calculate_messages_tokens(self, messages):
-        """计算消息列表的总token数"""
-        total_tokens = 0
-        for message in messages:
-            content = message.get('content', '')
-            total_tokens += self.calculate_tokens(content)
-            
-            # 角色信息也占用token
-            role = message.get('role', '')
-            total_tokens += self.calculate_tokens(role)
-            
-        return total_tokens
-
-class APIWorker(QThread):
-    """API调用工作线程"""
+class APIWorker(AsyncJob):
+    """API调用任务，在共享的请求引擎上以协程运行"""
     response_received = Signal(str, dict)
     stream_chunk_received = Signal(str, str)
     error_occurred = Signal(str)
@@ -291,18 +274,39 @@ class APIWorker(QThread):
     progress_updated = Signal(str)
     token_usage_updated = Signal(int, int, int)  # 输入token, 输出token, 总token
     thinking_process_updated = Signal(str)  # 新增：思考过程更新信号
+    retry_scheduled = Signal(int, float, str)  # 第几次重试, 等待秒数, 原因
+    stream_reset = Signal()  # 无法续写时从头重新生成，界面应清空已显示的内容
     
     def __init__(self, api_key, messages, model="deepseek-chat", stream=False, 
                  base_url=DEFAULT_BASE_URL, provider: Optional[str] = None,
-                 custom_api_key: Optional[str] = None, custom_base_url: Optional[str] = None):
+                 custom_api_key: Optional[str] = None, custom_base_url: Optional[str] = None,
+                 input_tokens: Optional[int] = None, usage_calibrator: Optional[UsageCalibrator] = None,
+                 retry_policy: Optional[RetryPolicy] = None, max_output_tokens: int = 2000):
         super().__init__()
+        self.finished.connect(self.finished_signal)
         self.api_key = custom_api_key if custom_api_key else api_key
         self.messages = messages
         self.model = model
         self.stream = stream
-        self.base_url = custom_base_url if custom_base_url else base_url
+        # 同一服务配置了备用端点时，从当前最快的健康端点开始，失败后依次切换
+        self.endpoint_router = get_shared_router()
+        self.endpoints = self.endpoint_router.ordered(custom_base_url if custom_base_url else base_url)
+        self.base_url = self.endpoints[0]
+        self.failed_endpoints = []
         self.start_time = None
-        self.token_calculator = TokenCalculator()
+        self.request_started = None
+        self.token_calculator = get_shared_calculator()
+        self.input_tokens = input_tokens
+        self.usage_calibrator = usage_calibrator
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.retries = 0
+        self.http_pool = get_shared_pool()
+        self.rate_limiter = get_shared_limiter()
+        self.max_output_tokens = max_output_tokens
+        self.reservation = None
+        self.hedger = get_shared_hedger()
+        self.hedge = None
+        self.hedge_reservation = None
         self.is_reasoner_model = "reasoner" in model.lower()
         
         # 确定LLM提供商
@@ -319,70 +323,318 @@ class APIWorker(QThread):
         else:
             self.provider = "openai"  # 默认
         
-    def run(self):
+    async def run(self):
         try:
             self.start_time = datetime.now()
-            client = OpenAI(
-                api_key=self.api_key,
-                base_url=self.base_url
-            )
+            self.request_started = time.monotonic()
+            self.http_pool.begin_request()
             
             if self.stream:
-                self.stream_response(client)
+                self.hedger.on_request()
+                await self.stream_response()
             else:
-                self.normal_response(client)
+                await self.normal_response()
                 
         except Exception as e:
             self.error_occurred.emit(f"API调用错误: {str(e)}")
-        finally:
-            self.finished_signal.emit()
     
-    def normal_response(self, client):
+    def _count_input_tokens(self):
+        """输入token数，调用方已通过话题索引算好时直接使用"""
+        if self.input_tokens is not None:
+            return self.input_tokens
+        return self.token_calculator.calculate_messages_tokens(self.messages)
+    
+    def _finalize_usage(self, metadata, input_tokens, output_tokens, server_usage, reasoning_tokens=0,
+                        source="server"):
+        """写入用量信息：优先使用服务端返回的真实用量（多次尝试合计时source可为mixed），否则使用校准后的估算值"""
+        metadata["provider"] = self.provider
+        metadata["estimated_usage"] = {
+            "model": self.model,
+            "prompt_tokens": input_tokens,
+            "completion_tokens": output_tokens,
+            "message_count": len(self.messages)
+        }
+        
+        if server_usage is not None:
+            usage = server_usage.to_dict()
+            metadata["usage_source"] = source
+        else:
+            if self.usage_calibrator:
+                input_tokens = self.usage_calibrator.calibrate(self.model, "prompt", input_tokens, len(self.messages))
+                output_tokens = self.usage_calibrator.calibrate(self.model, "completion", output_tokens)
+            usage = {
+                "prompt_tokens": input_tokens,
+                "completion_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens,
+                "reasoning_tokens": reasoning_tokens
+            }
+            metadata["usage_source"] = "estimate"
+        
+        metadata["usage"] = usage
+        return usage
+    
+    def _unsent_usage(self, metadata):
+        """停止时请求还在排队等待额度或等待重试，没有发出：不产生用量，也不记账"""
+        metadata["provider"] = self.provider
+        metadata["not_sent"] = True
+        usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "reasoning_tokens": 0}
+        metadata["usage"] = usage
+        return usage
+    
+    def _client(self):
+        """当前端点的客户端；共用按端点保持的长连接，省去每轮对话的TCP/TLS握手"""
+        return self.http_pool.async_client(self.base_url, self.api_key)
+    
+    async def normal_response(self):
         """正常响应模式"""
         self.progress_updated.emit("正在与AI对话...")
-        response = client.chat.completions.create(
-            model=self.model,
-            messages=self.messages,
-            stream=False
-        )
+        in_flight = False
+        try:
+            while True:
+                await self._admit()
+                in_flight = True
+                try:
+                    response = await self._client().chat.completions.create(
+                        model=self.model,
+                        messages=self.messages,
+                        stream=False
+                    )
+                    break
+                except Exception as e:
+                    in_flight = False
+                    # 失败的请求没有产生用量，退还占用的速率限制额度
+                    self.reservation.settle(0)
+                    await self._wait_for_retry(e)
+        except asyncio.CancelledError:
+            metadata = {"model": self.model, "created": int(datetime.now().timestamp()), "cancelled": True}
+            if in_flight:
+                # 请求已发出，输入部分按估算记账；没有回答内容
+                usage = self._finalize_usage(metadata, self._count_input_tokens(), 0, None)
+            else:
+                usage = self._unsent_usage(metadata)
+            self.response_received.emit("", metadata)
+            self.token_usage_updated.emit(usage["prompt_tokens"], usage["completion_tokens"], usage["total_tokens"])
+            return
+        
+        content = response.choices[0].message.content
+        reasoning_content = getattr(response.choices[0].message, 'reasoning_content', None) or ""
         
         # 计算token使用量
-        input_tokens = self.token_calculator.calculate_messages_tokens(self.messages)
-        output_tokens = self.token_calculator.calculate_tokens(response.choices[0].message.content)
-        total_tokens = input_tokens + output_tokens
+        input_tokens = self._count_input_tokens()
+        reasoning_tokens = self.token_calculator.calculate_tokens(reasoning_content)
+        output_tokens = self.token_calculator.calculate_tokens(content) + reasoning_tokens
         
         metadata = {
             "model": response.model,
-            "usage": {
-                "prompt_tokens": input_tokens,
-                "completion_tokens": output_tokens,
-                "total_tokens": total_tokens
-            },
-            "created": response.created
+            "created": response.created,
+            "latency": round(time.monotonic() - self.request_started, 3)
         }
+        usage = self._finalize_usage(metadata, input_tokens, output_tokens,
+                                     ServerUsage.from_usage(getattr(response, 'usage', None)),
+                                     reasoning_tokens)
+        if reasoning_content:
+            metadata["thinking_content"] = reasoning_content
+        if self.retries:
+            metadata["retries"] = self.retries
+        self._record_connection(metadata)
+        self._settle_rate_limit(metadata, usage["total_tokens"] if metadata["usage_source"] == "server" else None)
         
-        content = response.choices[0].message.content
         self.response_received.emit(content, metadata)
-        self.token_usage_updated.emit(input_tokens, output_tokens, total_tokens)
+        self.token_usage_updated.emit(usage["prompt_tokens"], usage["completion_tokens"], usage["total_tokens"])
     
-    def stream_response(self, client):
+    async def stream_response(self):
         """流式响应模式"""
         self.progress_updated.emit("开始流式响应...")
-        response = client.chat.completions.create(
-            model=self.model,
-            messages=self.messages,
-            stream=True
-        )
+        extra_args = {}
+        if self.provider in ("deepseek", "openai"):
+            # 让服务端在最后一个数据块中返回真实用量
+            extra_args["stream_options"] = {"include_usage": True}
         
-        full_content = ""
-        thinking_content = ""  # 用于累积思考过程
-        chunk_count = 0
-        is_thinking = False  # 标记是否在思考过程中
+        self.full_content = ""
+        self.thinking_content = ""  # 用于累积思考过程
+        self.chunk_count = 0
+        self.server_usage = None
         
         # 计算输入token
-        input_tokens = self.token_calculator.calculate_messages_tokens(self.messages)
+        input_tokens = self._count_input_tokens()
+        
+        # 输出token随数据块增量统计，无需在结束后重新分词
+        stream_counter = self.token_calculator.create_stream_counter()
+        attempt_usage = AttemptUsage()
+        
+        cancelled = False
+        failure = None
+        resumed = False
+        in_flight = False  # 停止时是否有请求已发出
+        try:
+            while True:
+                request_client, messages = self._client(), self.messages
+                if self.full_content and self.provider == "deepseek":
+                    # 流中途断开：把已收到的回答作为前缀续写，不从头生成
+                    request_client = self.http_pool.async_client(deepseek_beta_url(self.base_url), self.api_key)
+                    messages = continuation_messages(self.messages, self.full_content)
+                    resumed = True
+                elif self.chunk_count:
+                    # 不支持前缀续写，从头重新生成
+                    self.full_content = ""
+                    self.thinking_content = ""
+                    self.chunk_count = 0
+                    stream_counter = self.token_calculator.create_stream_counter()
+                    self.stream_reset.emit()
+                await self._admit()
+                in_flight = True
+                self.server_usage = None
+                attempt_tokens = stream_counter.tokens
+                attempt_reasoning = stream_counter.channel_tokens("reasoning")
+                succeeded = False
+                try:
+                    # 首token迟迟不来时向另一端点发出相同的请求，先出首token的一方胜出；续写请求不对冲
+                    delay = self.hedger.delay(self.model)
+                    opened = await hedged_open(
+                        lambda: request_client.chat.completions.create(
+                            model=self.model,
+                            messages=messages,
+                            stream=True,
+                            **extra_args
+                        ),
+                        self._hedge_starter(delay, extra_args) if messages is self.messages else None,
+                        delay, self._has_stream_content)
+                    response = opened.stream
+                    if opened.winner:
+                        self.hedger.record_win()
+                        self.hedge["won"] = True
+                        self.base_url = self.hedge["endpoint"]
+                        # 原请求没有产生输出，额度全部退还；之后按对冲请求的实际用量结算
+                        self.reservation.settle(0)
+                        self.reservation, self.hedge_reservation = self.hedge_reservation, None
+                    try:
+                        await self._consume_stream(opened.chunks(), stream_counter)
+                    finally:
+                        # 停止时立即关闭HTTP流，服务端随之停止生成
+                        await response.close()
+                    succeeded = True
+                    break
+                except Exception as e:
+                    in_flight = False
+                    await self._wait_for_retry(e)
+                finally:
+                    # 服务端用量只覆盖本次尝试；中途断开、没有用量的尝试按本次输入和已收到的输出估算
+                    consumed = attempt_usage.add(self.server_usage,
+                                                 input_tokens if messages is self.messages
+                                                 else self.token_calculator.calculate_messages_tokens(messages),
+                                                 stream_counter.tokens - attempt_tokens,
+                                                 stream_counter.channel_tokens("reasoning") - attempt_reasoning)
+                    if not succeeded:
+                        # 失败或停止的尝试按实际消耗结算，其余额度退还给排队的请求
+                        self.reservation.settle(consumed)
+                    if self.hedge_reservation is not None:
+                        # 落败或未完成的对冲请求在首token前被取消，没有产生输出
+                        self.hedge_reservation.settle(0)
+                        self.hedge_reservation = None
+        except asyncio.CancelledError:
+            cancelled = True
+        except Exception as e:
+            # 重试用尽：已收到的部分回答照常保存，再报告错误
+            if not self.full_content:
+                raise
+            failure = f"API调用错误: {str(e)}"
+        
+        # 输出token（包括思考过程和最终回答）
+        output_tokens = stream_counter.tokens
+        server_usage, usage_source = attempt_usage.total()
         
-        for chunk in response:
+        metadata = {
+            "model": self.model,
+            "stream": True,
+            "created": int(datetime.now().timestamp()),
+            "chunks_received": self.chunk_count,
+            "tokens_per_second": round(stream_counter.tokens_per_second, 1),
+            "ttft": self._ttft(stream_counter),
+            "thinking_content": self.thinking_content  # 包含思考过程
+        }
+        if cancelled:
+            # 已生成的部分同样计费，没有服务端用量时按已接收的内容估算
+            metadata["cancelled"] = True
+        if self.retries:
+            metadata["retries"] = self.retries
+        if resumed:
+            metadata["resumed"] = True
+        if attempt_usage.attempts > 1:
+            # 用量为各次尝试的合计，不能用于校准单次请求的估算
+            metadata["attempts"] = attempt_usage.attempts
+        if failure:
+            metadata["interrupted"] = failure
+        if self.hedge:
+            metadata["hedge"] = self.hedge
+        if not resumed:
+            self.hedger.record(self.model, metadata["ttft"])
+        if cancelled and not in_flight and not attempt_usage.attempts:
+            usage = self._unsent_usage(metadata)
+        else:
+            usage = self._finalize_usage(metadata, input_tokens, output_tokens, server_usage,
+                                         stream_counter.channel_tokens("reasoning"), usage_source or "server")
+        self._record_connection(metadata)
+        # 此前的尝试已各自结算，这里只结算最后一次
+        self._settle_rate_limit(metadata, self.server_usage.total_tokens if self.server_usage else None)
+        
+        self.response_received.emit(self.full_content, metadata)
+        self.token_usage_updated.emit(usage["prompt_tokens"], usage["completion_tokens"], usage["total_tokens"])
+        if failure:
+            self.error_occurred.emit(failure)
+    
+    async def _wait_for_retry(self, error):
+        """暂时性错误按重试策略等待后返回，否则重新抛出"""
+        delay = self.retry_policy.next_delay(self.retries, error)
+        if delay is None:
+            raise error
+        self.retries += 1
+        if is_endpoint_failure(error):
+            self.endpoint_router.record_failure(self.base_url)
+            fallback = self._next_endpoint()
+            if fallback:
+                # 端点故障时立即改用备用端点，无需退避等待；流式响应在新端点上照常续写
+                self.failed_endpoints.append(self.base_url)
+                self.base_url = fallback
+                self.progress_updated.emit(f"{describe_error(error)}，切换到备用端点 {fallback}")
+                self.http_pool.begin_request()
+                return
+        if getattr(error, "status_code", None) == 429:
+            # 本地额度估计偏高，让同一额度下排队的请求一起等待
+            self.rate_limiter.penalize(self.provider, self.api_key, self.model, delay)
+        reason = describe_error(error)
+        self.retry_scheduled.emit(self.retries, delay, reason)
+        self.progress_updated.emit(f"{reason}，{delay:.1f}秒后第{self.retries}次重试...")
+        await asyncio.sleep(delay)
+        self.http_pool.begin_request()
+    
+    async def _admit(self):
+        """按预估的token数（输入 + 最大输出）申请速率限制额度，额度不足时排队等待"""
+        tokens = self._count_input_tokens() + self.max_output_tokens
+        if self.rate_limiter.would_wait(self.provider, self.api_key, self.model, tokens):
+            queued = self.rate_limiter.waiting(self.provider, self.api_key, self.model)
+            self.progress_updated.emit(f"等待速率限制额度（前面还有{queued}个请求）..." if queued
+                                       else "等待速率限制额度...")
+        self.reservation = await self.rate_limiter.acquire(self.provider, self.api_key, self.model, tokens)
+        if self.reservation.waited:
+            # 排队时间不计入首token延迟
+            self.request_started += self.reservation.waited
+    
+    def _settle_rate_limit(self, metadata, actual_tokens):
+        """用本次请求的服务端用量修正限流额度（没有时保留预估值），并按响应头中的限额校正本地估计"""
+        if self.reservation is None:
+            return
+        self.reservation.settle(actual_tokens)
+        self.rate_limiter.observe(self.provider, self.api_key, self.model, self.http_pool.rate_limit_headers())
+        if self.reservation.waited >= 0.1:
+            metadata["rate_limit_wait"] = round(self.reservation.waited, 2)
+    
+    async def _consume_stream(self, response, stream_counter):
+        """读取流式响应，累积回答、思考过程和用量"""
+        async for chunk in response:
+            # 最后一个数据块（choices为空）携带用量
+            if getattr(chunk, 'usage', None):
+                self.server_usage = ServerUsage.from_usage(chunk.usage)
+            
             if chunk.choices and chunk.choices[0].delta:
                 delta = chunk.choices[0].delta
                 
@@ -391,8 +643,9 @@ class APIWorker(QThread):
                     # 检查是否有reasoning_content（思考过程）
                     if hasattr(delta, 'reasoning_content') and delta.reasoning_content:
                         thinking_chunk = delta.reasoning_content
-                        thinking_content += thinking_chunk
-                        chunk_count += 1
+                        self.thinking_content += thinking_chunk
+                        self.chunk_count += 1
+                        stream_counter.feed(thinking_chunk, "reasoning")
                         
                         # 发射思考过程更新信号
                         self.thinking_process_updated.emit(thinking_chunk)
@@ -401,8 +654,8 @@ class APIWorker(QThread):
                         time_diff = current_time - self.start_time
                         timestamp = f"{time_diff.seconds}.{time_diff.microseconds // 100000:01d}"
                         
-                        if chunk_count % 5 == 0:
-                            self.progress_updated.emit(f"已接收 {chunk_count} 个思考数据块...")
+                        if self.chunk_count % 5 == 0:
+                            self.progress_updated.emit(self._format_stream_progress(self.chunk_count, stream_counter, "思考数据块"))
                         
                         # 发送思考过程块
                         self.stream_chunk_received.emit(f"[思考] {thinking_chunk}", timestamp)
@@ -411,46 +664,100 @@ class APIWorker(QThread):
                 # 处理普通内容
                 if hasattr(delta, 'content') and delta.content:
                     content_chunk = delta.content
-                    full_content += content_chunk
-                    chunk_count += 1
+                    self.full_content += content_chunk
+                    self.chunk_count += 1
+                    stream_counter.feed(content_chunk)
                     
                     current_time = datetime.now()
                     time_diff = current_time - self.start_time
                     timestamp = f"{time_diff.seconds}.{time_diff.microseconds // 100000:01d}"
                     
-                    if chunk_count % 5 == 0:
-                        self.progress_updated.emit(f"已接收 {chunk_count} 个数据块...")
+                    if self.chunk_count % 5 == 0:
+                        self.progress_updated.emit(self._format_stream_progress(self.chunk_count, stream_counter))
                     
                     self.stream_chunk_received.emit(content_chunk, timestamp)
-        
-        # 计算输出token（包括思考过程和最终回答）
-        output_tokens = self.token_calculator.calculate_tokens(full_content + thinking_content)
-        total_tokens = input_tokens + output_tokens
-        
-        metadata = {
-            "model": self.model,
-            "stream": True,
-            "created": int(datetime.now().timestamp()),
-            "chunks_received": chunk_count,
-            "usage": {
-                "prompt_tokens": input_tokens,
-                "completion_tokens": output_tokens,
-                "total_tokens": total_tokens
-            },
-            "thinking_content": thinking_content  # 包含思考过程
-        }
-        
-        self.response_received.emit(full_content, metadata)
-        self.token_usage_updated.emit(input_tokens, output_tokens, total_tokens)
+    
+    @staticmethod
+    def _has_stream_content(chunk):
+        """数据块是否带有回答或思考内容（只有角色或用量的数据块不算首token）"""
+        if not chunk.choices or not chunk.choices[0].delta:
+            return False
+        delta = chunk.choices[0].delta
+        return bool(getattr(delta, 'content', None) or getattr(delta, 'reasoning_content', None))
+    
+    def _hedge_starter(self, delay, extra_args):
+        """超过阈值仍无首token时调用：预算允许时向另一端点（没有备用端点时为同一端点的新请求）发出副本"""
+        def start():
+            tokens = self._count_input_tokens() + self.max_output_tokens
+            # 对冲请求不排队，也不挤占其他请求的速率限制额度
+            if self.rate_limiter.would_wait(self.provider, self.api_key, self.model, tokens):
+                return None
+            if not self.hedger.try_spend():
+                return None
+            target = self._next_endpoint() or self.base_url
+            self.hedge = {"endpoint": target, "delay": round(delay, 2), "won": False}
+            self.progress_updated.emit(f"{delay:.1f}秒内未收到首token，向 {target} 发出对冲请求...")
+            client = self.http_pool.async_client(target, self.api_key)
+            
+            async def open_hedge():
+                self.hedge_reservation = await self.rate_limiter.acquire(self.provider, self.api_key,
+                                                                         self.model, tokens)
+                return await client.chat.completions.create(
+                    model=self.model,
+                    messages=self.messages,
+                    stream=True,
+                    **extra_args
+                )
+            return open_hedge
+        return start
+    
+    def _ttft(self, stream_counter):
+        """首token延迟（秒），从发起请求到收到第一个内容数据块"""
+        if stream_counter.first_chunk_time is None or self.request_started is None:
+            return None
+        return round(stream_counter.first_chunk_time - self.request_started, 3)
+    
+    def _next_endpoint(self):
+        """本次请求尚未失败过的下一个端点，按当前优先顺序"""
+        for url in self.endpoint_router.ordered(self.base_url):
+            if url != self.base_url and url not in self.failed_endpoints:
+                return url
+        return None
+    
+    def _record_connection(self, metadata):
+        """记录本次请求是否复用了已有连接，并按连接冷热分别统计首token延迟"""
+        info = self.http_pool.connection_info()
+        metadata["connection"] = info["connection"]
+        metadata["http_version"] = info["http_version"]
+        self.http_pool.record_ttft(self.base_url, info["connection"], metadata.get("ttft"))
+        
+        # 被动记录端点延迟，供后续请求选择最快的端点
+        latency = metadata.get("ttft") if metadata.get("stream") else metadata.get("latency")
+        if not metadata.get("interrupted") and (latency is not None or not metadata.get("cancelled")):
+            self.endpoint_router.record_success(self.base_url, latency)
+        if len(self.endpoints) > 1:
+            metadata["endpoint"] = self.base_url
+        if self.failed_endpoints:
+            metadata["failover"] = self.failed_endpoints + [self.base_url]
+    
+    def _format_stream_progress(self, chunk_count, stream_counter, label="数据块"):
+        """生成包含实时输出token数和速度的进度信息"""
+        return (f"已接收 {chunk_count} 个{label}，输出 {stream_counter.tokens} tokens"
+                f"（{stream_counter.tokens_per_second:.1f} tokens/s）")
 
 class StreamDisplayManager:
-    """流式显示管理器"""
+    """流式显示管理器
     
-    def __init__(self, raw_text_edit, chat_history_widget, markdown_view, thinking_text_edit=None):
+    每个进行中的请求各有一个管理器，内容始终累积在管理器中；只有所属话题正在显示时（active）
+    才写入界面控件，切换回该话题时把已收到的部分重新显示出来。
+    """
+    
+    def __init__(self, raw_text_edit, chat_history_widget, markdown_view, thinking_text_edit=None, active=True):
         self.raw_text_edit = raw_text_edit
         self.chat_history_widget = chat_history_widget
         self.markdown_view = markdown_view
         self.thinking_text_edit = thinking_text_edit  # 新增：思考过程显示控件
+        self.active = active
         self.current_stream_content = ""
         self.current_thinking_content = ""  # 新增：当前思考过程内容
         self.stream_start_time = None
@@ -461,6 +768,18 @@ class StreamDisplayManager:
         """设置是否为reasoner模型"""
         self.is_reasoner_model = is_reasoner
         
+    def set_active(self, active):
+        """切换所属话题是否正在显示；切回时补上后台期间收到的内容"""
+        if active == self.active:
+            return
+        self.active = active
+        if active and self.stream_start_time:
+            self._write_header(self.stream_start_time.strftime("%H:%M:%S"))
+            self._insert_text(self.raw_text_edit, self.current_stream_content)
+            if self.thinking_text_edit and self.current_thinking_content:
+                self._insert_text(self.thinking_text_edit, self.current_thinking_content)
+            self.update_markdown_preview()
+        
     def start_stream(self):
         """开始新的流式输出"""
         self.current_stream_content = ""
@@ -468,13 +787,25 @@ class StreamDisplayManager:
         self.stream_start_time = datetime.now()
         self.chunk_count = 0
         
+        if self.active:
+            self._write_header(self.get_current_time())
+    
+    def _write_header(self, time_text):
         if self.is_reasoner_model:
-            self.raw_text_edit.append(f"\n🤖 AI响应 (推理模式) [{self.get_current_time()}]:\n")
+            self.raw_text_edit.append(f"\n🤖 AI响应 (推理模式) [{time_text}]:\n")
             # 初始化思考过程显示
             if self.thinking_text_edit:
-                self.thinking_text_edit.append(f"\n💭 思考过程 [{self.get_current_time()}]:\n")
+                self.thinking_text_edit.append(f"\n💭 思考过程 [{time_text}]:\n")
         else:
-            self.raw_text_edit.append(f"\n🤖 AI响应 [{self.get_current_time()}]:\n")
+            self.raw_text_edit.append(f"\n🤖 AI响应 [{time_text}]:\n")
+    
+    @staticmethod
+    def _insert_text(text_edit, text):
+        cursor = text_edit.textCursor()
+        cursor.movePosition(QTextCursor.MoveOperation.End)
+        cursor.insertText(text)
+        text_edit.setTextCursor(cursor)
+        text_edit.ensureCursorVisible()
         
     def add_chunk(self, chunk, timestamp=None):
         """添加流式块"""
@@ -485,14 +816,12 @@ class StreamDisplayManager:
             # 提取纯思考内容
             thinking_chunk = chunk[4:]  # 移除"[思考] "前缀
             self.current_thinking_content += thinking_chunk
+            if not self.active:
+                return
             
             # 更新思考过程显示
             if self.thinking_text_edit:
-                cursor = self.thinking_text_edit.textCursor()
-                cursor.movePosition(QTextCursor.MoveOperation.End)
-                cursor.insertText(thinking_chunk)
-                self.thinking_text_edit.setTextCursor(cursor)
-                self.thinking_text_edit.ensureCursorVisible()
+                self._insert_text(self.thinking_text_edit, thinking_chunk)
             
             # 在原始文本中显示思考标记
             cursor = self.raw_text_edit.textCursor()
@@ -503,12 +832,9 @@ class StreamDisplayManager:
         else:
             # 普通内容
             self.current_stream_content += chunk
-            
-            cursor = self.raw_text_edit.textCursor()
-            cursor.movePosition(QTextCursor.MoveOperation.End)
-            cursor.insertText(chunk)
-            self.raw_text_edit.setTextCursor(cursor)
-            self.raw_text_edit.ensureCursorVisible()
+            if not self.active:
+                return
+            self._insert_text(self.raw_text_edit, chunk)
         
         if timestamp and self.chunk_count % 10 == 0:
             time_info = f"\n⏱️ [{timestamp}s]"
@@ -525,12 +851,10 @@ class StreamDisplayManager:
             return
             
         self.current_thinking_content += thinking_chunk
+        if not self.active:
+            return
         
-        cursor = self.thinking_text_edit.textCursor()
-        cursor.movePosition(QTextCursor.MoveOperation.End)
-        cursor.insertText(thinking_chunk)
-        self.thinking_text_edit.setTextCursor(cursor)
-        self.thinking_text_edit.ensureCursorVisible()
+        self._insert_text(self.thinking_text_edit, thinking_chunk)
         
         # 在原始文本中显示思考标记
         cursor = self.raw_text_edit.textCursor()
@@ -542,7 +866,7 @@ class StreamDisplayManager:
         """完成流式输出"""
         self.update_markdown_preview()
         
-        if self.stream_start_time:
+        if self.stream_start_time and self.active:
             end_time = datetime.now()
             duration = end_time - self.stream_start_time
             time_info = f"\n\n✅ 响应完成 - 耗时: {duration.total_seconds():.2f}s, 共{self.chunk_count}个数据块"
@@ -556,7 +880,7 @@ class StreamDisplayManager:
     
     def update_markdown_preview(self):
         """更新Markdown预览"""
-        if self.current_stream_content:
+        if self.current_stream_content and self.active:
             try:
                 theme = "dark"
                 self.markdown_view.render_markdown(self.current_stream_content, theme)
@@ -709,6 +1033,21 @@ class ModernSettingsDialog(QDialog):
         self.base_url_edit.setPlaceholderText(DEFAULT_BASE_URL)
         api_base_layout.addRow("API Base URL:", self.base_url_edit)
         
+        self.fallback_urls_edit = QTextEdit()
+        self.fallback_urls_edit.setAcceptRichText(False)
+        self.fallback_urls_edit.setFixedHeight(60)
+        self.fallback_urls_edit.setPlaceholderText("每行一个，与Base URL等价的镜像或代理地址（可选）")
+        self.fallback_urls_edit.setToolTip("请求发往当前最快的可用端点，端点连接失败、超时或返回5xx时自动切换到下一个")
+        api_base_layout.addRow("备用端点:", self.fallback_urls_edit)
+        
+        self.endpoint_groups_edit = QTextEdit()
+        self.endpoint_groups_edit.setAcceptRichText(False)
+        self.endpoint_groups_edit.setFixedHeight(60)
+        self.endpoint_groups_edit.setPlaceholderText("每行一组：主地址或提供商名称（如openai），后跟空格分隔的备用地址（可选）")
+        self.endpoint_groups_edit.setToolTip("用于助手的自定义Base URL和其他提供商，主地址也可写提供商名称，"
+                                             "表示该提供商的默认地址")
+        api_base_layout.addRow("其他端点组:", self.endpoint_groups_edit)
+        
         # API密钥输入
         api_key_layout = QHBoxLayout()
         self.api_key_edit = QLineEdit()
@@ -798,12 +1137,54 @@ class ModernSettingsDialog(QDialog):
         self.enable_token_calc.setChecked(True)
         token_layout.addWidget(self.enable_token_calc)
         
-        token_info = QLabel("Token计算使用近似算法，用于估算API使用成本")
+        token_info = QLabel("Token计算优先使用离线BPE分词器精确计数，缺少词表时使用近似算法")
         token_info.setStyleSheet("color: #64748b; font-size: 12px;")
         token_layout.addWidget(token_info)
         
         layout.addWidget(token_group)
         
+        # 速率限制
+        rate_group = QGroupBox("速率限制与并发")
+        rate_layout = QFormLayout(rate_group)
+        
+        self.rate_rpm_spin = QSpinBox()
+        self.rate_rpm_spin.setRange(0, 100000)
+        self.rate_rpm_spin.setSpecialValueText("默认")
+        rate_layout.addRow("每分钟请求数:", self.rate_rpm_spin)
+        
+        self.rate_tpm_spin = QSpinBox()
+        self.rate_tpm_spin.setRange(0, 100000000)
+        self.rate_tpm_spin.setSingleStep(1000)
+        self.rate_tpm_spin.setSpecialValueText("默认")
+        rate_layout.addRow("每分钟Token数:", self.rate_tpm_spin)
+        
+        self.max_concurrent_spin = QSpinBox()
+        self.max_concurrent_spin.setRange(1, 32)
+        rate_layout.addRow("同时进行的请求:", self.max_concurrent_spin)
+        
+        self.max_per_endpoint_spin = QSpinBox()
+        self.max_per_endpoint_spin.setRange(1, 32)
+        rate_layout.addRow("同一端点的请求:", self.max_per_endpoint_spin)
+        
+        self.hedge_enabled = QCheckBox("首token过慢时发出对冲请求")
+        self.hedge_enabled.setToolTip("流式请求超过近期首token延迟的p90仍无输出时，向备用端点发出相同的请求，"
+                                      "先返回的一方胜出，另一个立即取消")
+        rate_layout.addRow(self.hedge_enabled)
+        
+        self.hedge_budget_spin = QSpinBox()
+        self.hedge_budget_spin.setRange(1, 20)
+        self.hedge_budget_spin.setSuffix("%")
+        rate_layout.addRow("对冲预算（占请求数）:", self.hedge_budget_spin)
+        
+        rate_info = QLabel("按提供商、密钥和模型分别计算，超出额度的请求在本地排队，不会被服务端拒绝；"
+                           "默认使用各提供商最低档位的限额（DeepSeek不限制），并根据响应头自动校正。"
+                           "不同话题的请求可以同时进行，超出并发上限的请求排队等待")
+        rate_info.setWordWrap(True)
+        rate_info.setStyleSheet("color: #64748b; font-size: 12px;")
+        rate_layout.addRow(rate_info)
+        
+        layout.addWidget(rate_group)
+        
         layout.addStretch()
         return tab
     
@@ -833,58 +1214,31 @@ class ModernSettingsDialog(QDialog):
             QMessageBox.warning(self, "测试失败", "请输入API密钥进行测试")
             return
         
-        # 显示测试进度
-        progress_dialog = QProgressDialog("正在测试API密钥...", "取消", 0, 0, self)
-        progress_dialog.setWindowTitle("测试API密钥")
-        progress_dialog.setWindowModality(Qt.WindowModality.WindowModal)
-        progress_dialog.show()
-        
-        try:
-            # 使用线程测试API密钥
-            result_queue = Queue()
-            
-            def test_key():
-                try:
-                    client = OpenAI(api_key=api_key, base_url=self.base_url_edit.text() or DEFAULT_BASE_URL)
-                    response = client.chat.completions.create(
-                        model="deepseek-chat",
-                        messages=[{"role": "user", "content": "测试消息，请回复'连接成功'"}],
-                        max_tokens=10
-                    )
-                    result_queue.put(("success", response.choices[0].message.content))
-                except Exception as e:
-                    result_queue.put(("error", str(e)))
-            
-            thread = Thread(target=test_key)
-            thread.daemon = True
-            thread.start()
-            
-            # 等待结果
-            thread.join(timeout=10)
-            
-            if thread.is_alive():
-                progress_dialog.close()
-                QMessageBox.warning(self, "测试超时", "API测试超时，请检查网络连接")
-                return
-            
-            progress_dialog.close()
-            
-            if not result_queue.empty():
-                result_type, result_data = result_queue.get()
-                if result_type == "success":
-                    QMessageBox.information(self, "测试成功", f"API密钥有效！\n\nAI回复: {result_data}")
-                    self.key_status_label.setText("✅ 密钥测试通过（有效）")
-                    self.key_status_label.setStyleSheet("color: #10b981; font-weight: bold;")
-                else:
-                    QMessageBox.critical(self, "测试失败", f"API密钥无效或网络错误:\n\n{result_data}")
-                    self.key_status_label.setText("❌ 密钥测试失败")
-                    self.key_status_label.setStyleSheet("color: #ef4444; font-weight: bold;")
-            else:
-                QMessageBox.warning(self, "测试失败", "无法获取测试结果")
-                
-        except Exception as e:
-            progress_dialog.close()
-            QMessageBox.critical(self, "测试错误", f"测试过程中发生错误:\n\n{str(e)}")
+        # 在请求引擎上测试，结果经信号送回，等待期间界面保持响应，可随时取消
+        self.key_test_job = APIKeyTestJob(api_key, self.base_url_edit.text() or DEFAULT_BASE_URL)
+        self.key_test_progress = QProgressDialog("正在测试API密钥...", "取消", 0, 0, self)
+        self.key_test_progress.setWindowTitle("测试API密钥")
+        self.key_test_progress.setWindowModality(Qt.WindowModality.WindowModal)
+        self.key_test_progress.canceled.connect(self.key_test_job.cancel)
+        self.key_test_job.result_ready.connect(self.handle_key_test_result)
+        self.key_test_job.finished.connect(self.key_test_progress.reset)
+        self.test_key_btn.setEnabled(False)
+        self.key_test_job.finished.connect(lambda: self.test_key_btn.setEnabled(True))
+        self.key_test_progress.show()
+        self.key_test_job.start()
+    
+    def handle_key_test_result(self, result_type, result_data):
+        """显示API密钥测试结果"""
+        if result_type == "success":
+            QMessageBox.information(self, "测试成功", f"API密钥有效！\n\nAI回复: {result_data}")
+            self.key_status_label.setText("✅ 密钥测试通过（有效）")
+            self.key_status_label.setStyleSheet("color: #10b981; font-weight: bold;")
+        elif result_type == "timeout":
+            QMessageBox.warning(self, "测试超时", "API测试超时，请检查网络连接")
+        else:
+            QMessageBox.critical(self, "测试失败", f"API密钥无效或网络错误:\n\n{result_data}")
+            self.key_status_label.setText("❌ 密钥测试失败")
+            self.key_status_label.setStyleSheet("color: #ef4444; font-weight: bold;")
     
     def clear_api_key(self):
         """清除API密钥"""
@@ -998,11 +1352,23 @@ class ModernSettingsDialog(QDialog):
         
         # API设置
         self.base_url_edit.setText(settings.value("base_url", DEFAULT_BASE_URL))
+        self.fallback_urls_edit.setPlainText(settings.value("fallback_base_urls", ""))
+        try:
+            endpoint_groups = json.loads(settings.value("endpoint_groups", "") or "{}")
+        except ValueError:
+            endpoint_groups = {}
+        self.endpoint_groups_edit.setPlainText(format_endpoint_groups(endpoint_groups))
         if self.parent and self.parent.api_key_manager:
             # 不直接显示加密的API密钥，只显示状态
             self.update_key_status()
         
         self.enable_token_calc.setChecked(settings.value("enable_token_calc", True, type=bool))
+        self.rate_rpm_spin.setValue(settings.value("rate_limit_rpm", 0, type=int))
+        self.rate_tpm_spin.setValue(settings.value("rate_limit_tpm", 0, type=int))
+        self.max_concurrent_spin.setValue(settings.value("max_concurrent_requests", 4, type=int))
+        self.max_per_endpoint_spin.setValue(settings.value("max_requests_per_endpoint", 2, type=int))
+        self.hedge_enabled.setChecked(settings.value("hedge_requests", False, type=bool))
+        self.hedge_budget_spin.setValue(settings.value("hedge_budget_percent", 5, type=int))
         
         # 模型设置
         self.model_combo.setCurrentText(settings.value("model", "deepseek-chat"))
@@ -1022,12 +1388,21 @@ class ModernSettingsDialog(QDialog):
         
         # API设置
         settings.setValue("base_url", self.base_url_edit.text())
+        settings.setValue("fallback_base_urls", self.fallback_urls_edit.toPlainText().strip())
+        settings.setValue("endpoint_groups", json.dumps(
+            parse_endpoint_groups(self.endpoint_groups_edit.toPlainText()), ensure_ascii=False))
         api_key = self.api_key_edit.text().strip()
         if api_key and self.parent and self.parent.api_key_manager:
             if self.parent.api_key_manager.store_api_key(api_key):
                 self.update_key_status()
         
         settings.setValue("enable_token_calc", self.enable_token_calc.isChecked())
+        settings.setValue("rate_limit_rpm", self.rate_rpm_spin.value())
+        settings.setValue("rate_limit_tpm", self.rate_tpm_spin.value())
+        settings.setValue("max_concurrent_requests", self.max_concurrent_spin.value())
+        settings.setValue("max_requests_per_endpoint", self.max_per_endpoint_spin.value())
+        settings.setValue("hedge_requests", self.hedge_enabled.isChecked())
+        settings.setValue("hedge_budget_percent", self.hedge_budget_spin.value())
         
         # 模型设置
         settings.setValue("model", self.model_combo.currentText())
@@ -1053,23 +1428,42 @@ class DeepSeekClient(QMainWindow):
         # 初始化组件
         self.api_key_manager = SecureAPIKeyManager()
         self.api_key = self.api_key_manager.get_api_key()
-        self.token_calculator = TokenCalculator()
+        self.token_calculator = get_shared_calculator()
+        self.token_index = TopicTokenIndex(self.token_calculator)
+        self.history_retriever = HistoryRetriever()
+        self.context_builder = ContextBuilder(self.token_calculator, self.token_index,
+                                              retriever=self.history_retriever)
+        self.summary_cache = RollingSummaryCache()
+        self.summary_workers = {}
+        self.prefix_cache_stats = PrefixCacheStats()
+        self.pending_attachments = []  # 等待随下一条消息发送的大附件
+        self.usage_calibrator = UsageCalibrator()
+        # 各话题进行中的对话请求；不同话题的请求并发执行，回复各自写回所属话题
+        self.request_scheduler = RequestScheduler(parent=self)
+        self.request_scheduler.queued.connect(self.handle_request_queued)
+        self.request_scheduler.started.connect(self.handle_request_started)
+        self.request_scheduler.finished.connect(self.handle_request_done)
+        self.api_workers = {}  # 话题ID -> APIWorker
+        self.last_api_messages = {}  # 话题ID -> (消息, 输入token)，供出错后重试
         
         self.current_topic = None
         self.topics = {}
         self.conversations = {}
         self.settings = QSettings("DeepSeek", "AI Client")
         
-        # Token统计
+        # Token统计（本次运行的累计值；持久化的逐请求记录见用量账本）
         self.total_input_tokens = 0
         self.total_output_tokens = 0
         self.total_tokens = 0
+        self.usage_ledger = self.create_usage_ledger()
         
         # API配置
         self.base_url = self.settings.value("base_url", DEFAULT_BASE_URL)
         self.current_model = self.settings.value("model", "deepseek-chat")
         self.temperature = self.settings.value("temperature", 0.7, type=float)
         self.max_tokens = self.settings.value("max_tokens", 2000, type=int)
+        self.apply_rate_limits()
+        self.apply_endpoint_group()
         
         # 初始化UI
         self.init_ui()
@@ -1102,14 +1496,7 @@ class DeepSeekClient(QMainWindow):
         
         # 应用样式
         self.apply_modern_style()
-        
-        # 初始化流式显示管理器
-        self.stream_display_manager = StreamDisplayManager(
-            self.raw_text_edit, 
-            self.chat_history_widget, 
-            self.markdown_view,
-            self.thinking_text_edit
-        )
+
     
     def create_sidebar(self, main_layout):
         """创建侧边栏"""
@@ -1218,6 +1605,7 @@ class DeepSeekClient(QMainWindow):
         self.token_stats = QLabel("输入: 0\n输出: 0\n总计: 0")
         self.token_stats.setStyleSheet("font-family: monospace; background: #f8fafc; padding: 10px; border-radius: 5px;")
         token_layout.addWidget(self.token_stats)
+        self.update_token_stats()
         
         sidebar_layout.addWidget(token_group)
         
@@ -1422,13 +1810,33 @@ class DeepSeekClient(QMainWindow):
         """)
         toolbar_layout.addWidget(self.stream_checkbox)
         
+        # 发送前压缩提示（折叠空白、重复行和重复段落，代码块保持原样）
+        self.compression_checkbox = QCheckBox("压缩提示")
+        self.compression_checkbox.setChecked(self.settings.value("prompt_compression", False, type=bool))
+        self.compression_checkbox.setToolTip("发送前折叠多余空白、重复的日志行和重复段落，代码块保持原样")
+        self.compression_checkbox.setStyleSheet(self.stream_checkbox.styleSheet())
+        self.compression_checkbox.toggled.connect(
+            lambda checked: self.settings.setValue("prompt_compression", checked))
+        toolbar_layout.addWidget(self.compression_checkbox)
+        
         # 流式状态指示器
         self.stream_status_label = QLabel("就绪")
         self.stream_status_label.setStyleSheet("color: #94a3b8; font-size: 12px;")
         toolbar_layout.addWidget(self.stream_status_label)
         
+        # 待发送的大附件
+        self.attachment_label = QLabel("")
+        self.attachment_label.setStyleSheet("color: #667eea; font-size: 12px;")
+        toolbar_layout.addWidget(self.attachment_label)
+        
         toolbar_layout.addStretch()
         
+        # 上下文预算指示：草稿 + 将要发送的历史 占 (上下文长度 - max_tokens) 的比例
+        self.context_gauge = QProgressBar()
+        self.context_gauge.setFixedWidth(260)
+        self.context_gauge.setTextVisible(True)
+        toolbar_layout.addWidget(self.context_gauge)
+        
         input_layout.addLayout(toolbar_layout)
         
         # 输入框和发送按钮
@@ -1453,6 +1861,18 @@ class DeepSeekClient(QMainWindow):
         """)
         input_area_layout.addWidget(self.message_input)
         
+        # 草稿token数在后台线程计算，输入停顿后再提交，避免影响打字和粘贴
+        self.draft_tokens = 0
+        self.input_meter_serial = 0
+        self.input_meter = InputTokenMeter(self.token_calculator, self)
+        self.input_meter.counted.connect(self.handle_input_counted)
+        self.input_meter.start()
+        self.input_meter_timer = QTimer(self)
+        self.input_meter_timer.setSingleShot(True)
+        self.input_meter_timer.setInterval(150)
+        self.input_meter_timer.timeout.connect(self.submit_input_count)
+        self.message_input.textChanged.connect(self.input_meter_timer.start)
+        
         self.send_btn = QPushButton("发送")
         self.send_btn.setFixedSize(80, 80)
         self.send_btn.clicked.connect(self.send_message)
@@ -1477,12 +1897,80 @@ class DeepSeekClient(QMainWindow):
         """)
         input_area_layout.addWidget(self.send_btn)
         
+        # 停止按钮：请求进行中时替换发送按钮，Esc键同样可以停止
+        self.stop_btn = QPushButton("停止")
+        self.stop_btn.setFixedSize(80, 80)
+        self.stop_btn.setToolTip("停止生成（Esc），保留已接收的部分回答")
+        self.stop_btn.clicked.connect(self.cancel_request)
+        self.stop_btn.setStyleSheet("""
+            QPushButton {
+                background: #ef4444;
+                color: white;
+                border: none;
+                border-radius: 15px;
+                font-weight: bold;
+                font-size: 16px;
+            }
+            QPushButton:hover {
+                background: #dc2626;
+            }
+        """)
+        self.stop_btn.hide()
+        input_area_layout.addWidget(self.stop_btn)
+        stop_action = QAction(self)
+        stop_action.setShortcut(QKeySequence("Esc"))
+        stop_action.triggered.connect(self.cancel_request)
+        self.addAction(stop_action)
+        
         input_layout.addLayout(input_area_layout)
         
         main_content_layout.addWidget(input_container)
         
         main_layout.addWidget(main_content, 1)
     
+    def submit_input_count(self):
+        """把当前草稿提交给后台计数线程"""
+        self.input_meter_serial = self.input_meter.submit(self.message_input.toPlainText())
+
+    def handle_input_counted(self, serial, tokens):
+        """后台计数完成，过期的结果直接丢弃"""
+        if serial != self.input_meter_serial:
+            return
+        self.draft_tokens = tokens
+        self.refresh_context_gauge()
+
+    def refresh_context_gauge(self):
+        """按当前话题、模型和草稿刷新上下文预算指示"""
+        if not hasattr(self, 'context_gauge'):
+            return
+        history = self.conversations.get(self.current_topic, []) if self.current_topic else []
+        context_tokens = self.context_builder.preview_tokens(
+            self.current_topic, history, {"role": "system", "content": SYSTEM_PROMPT},
+            self.current_model, self.max_tokens, self.draft_tokens,
+            summary=self.current_summary(self.current_topic))
+        if self.pending_attachments:
+            context_tokens += min(sum(a.total_tokens for a in self.pending_attachments),
+                                  self.attachment_budget(self.draft_tokens))
+        
+        budget = input_budget(self.current_model, self.max_tokens)
+        ratio = context_tokens / budget if budget else 1.0
+        if ratio >= 1.0:
+            color = "#dc2626"
+        elif ratio >= 0.8:
+            color = "#f59e0b"
+        else:
+            color = "#10b981"
+        self.context_gauge.setRange(0, max(budget, 1))
+        self.context_gauge.setValue(min(context_tokens, max(budget, 1)))
+        self.context_gauge.setFormat(f"输入 {self.draft_tokens} · 上下文 {context_tokens}/{budget}")
+        self.context_gauge.setToolTip(f"{self.current_model}: 上下文预算为上下文长度减去最大输出token数（{self.max_tokens}）"
+                                      + ("\n已超出预算，较早的消息或本条输入可能被截断" if ratio >= 1.0 else ""))
+        self.context_gauge.setStyleSheet(f"""
+            QProgressBar {{ border: 1px solid #e2e8f0; border-radius: 6px; text-align: center;
+                           font-size: 12px; background: white; height: 18px; }}
+            QProgressBar::chunk {{ background: {color}; border-radius: 5px; }}
+        """)
+
     def update_model_info_label(self):
         """更新模型说明标签"""
         model = self.model_combo.currentText()
@@ -1516,6 +2004,11 @@ class DeepSeekClient(QMainWindow):
         self.stream_indicator.setStyleSheet("color: #64748b; padding: 5px;")
         self.statusBar().addPermanentWidget(self.stream_indicator)
         
+        # 所有话题进行中/排队中的请求数
+        self.requests_indicator = QLabel("")
+        self.requests_indicator.setStyleSheet("color: #6366f1; padding: 5px;")
+        self.statusBar().addPermanentWidget(self.requests_indicator)
+        
         # 添加思考过程状态指示器
         self.thinking_indicator = QLabel("")
         self.thinking_indicator.setStyleSheet("color: #dc2626; padding: 5px;")
@@ -1552,6 +2045,10 @@ class DeepSeekClient(QMainWindow):
         export_action.triggered.connect(self.export_conversation)
         file_menu.addAction(export_action)
         
+        compare_action = QAction('⚖️ 多模型对比', self)
+        compare_action.triggered.connect(self.show_compare_dialog)
+        file_menu.addAction(compare_action)
+        
         file_menu.addSeparator()
         
         exit_action = QAction('🚪 退出', self)
@@ -1604,13 +2101,51 @@ class DeepSeekClient(QMainWindow):
         self.current_model = self.settings.value("model", "deepseek-chat")
         self.temperature = self.settings.value("temperature", 0.7, type=float)
         self.max_tokens = self.settings.value("max_tokens", 2000, type=int)
+        self.apply_rate_limits()
+        self.apply_endpoint_group()
         
         # 更新UI
         self.model_combo.setCurrentText(self.current_model)
         self.model_label.setText(f"Model: {self.current_model}")
+        self.refresh_context_gauge()
         
         # 更新API密钥
         self.api_key = self.api_key_manager.get_api_key()
+    
+    def apply_rate_limits(self):
+        """应用并发上限，并把设置中的速率限制应用到所有提供商，未设置的一项使用该提供商的默认值"""
+        self.request_scheduler.set_limits(self.settings.value("max_concurrent_requests", 4, type=int),
+                                          self.settings.value("max_requests_per_endpoint", 2, type=int))
+        rpm = self.settings.value("rate_limit_rpm", 0, type=int)
+        tpm = self.settings.value("rate_limit_tpm", 0, type=int)
+        limiter = get_shared_limiter()
+        for provider in ("deepseek", "openai", "anthropic", "gemini"):
+            default = DEFAULT_LIMITS.get(provider, RateLimit())
+            limiter.configure(provider, RateLimit(rpm or default.rpm, tpm or default.tpm)
+                              if rpm or tpm else None)
+    
+    def apply_endpoint_group(self):
+        """按设置登记各服务的等价端点组，并应用对冲请求设置
+        
+        Base URL与备用端点为一组；其他端点组以助手的自定义Base URL或提供商名称（对应其默认地址）为主地址
+        """
+        fallbacks = self.settings.value("fallback_base_urls", "") or ""
+        groups = [[self.base_url] + fallbacks.split()]
+        try:
+            endpoint_groups = json.loads(self.settings.value("endpoint_groups", "") or "{}")
+        except ValueError as e:
+            print(f"读取端点组设置失败: {e}")
+            endpoint_groups = {}
+        for primary, urls in endpoint_groups.items():
+            try:
+                primary = DEFAULT_BASE_URLS.get(LLMProvider(primary.lower()), primary)
+            except ValueError:
+                pass
+            groups.append([primary] + urls)
+        get_shared_router().set_groups(groups)
+        get_shared_hedger().configure(self.settings.value("hedge_requests", False, type=bool),
+                                      self.settings.value("hedge_budget_percent", 5, type=int) / 100)
+    
     def select_assistant(self):
         """选择助手"""
         dialog = AssistantDialog(self)
@@ -1627,11 +2162,8 @@ class DeepSeekClient(QMainWindow):
             self.model_combo.setCurrentText(assistant.model)
             self.model_label.setText(f"Model: {assistant.model}")
             
-            # 更新流式显示管理器的模型状态
-            is_reasoner = "reasoner" in assistant.model.lower()
-            self.stream_display_manager.set_reasoner_model(is_reasoner)
-            
             # 更新状态栏指示器
+            is_reasoner = "reasoner" in assistant.model.lower()
             if is_reasoner:
                 self.thinking_indicator.setText("🧠 推理模式")
             else:
@@ -1647,12 +2179,10 @@ class DeepSeekClient(QMainWindow):
         self.current_model = model
         self.settings.setValue("model", model)
         self.model_label.setText(f"Model: {model}")
-        
-        # 更新流式显示管理器的模型状态
-        is_reasoner = "reasoner" in model.lower()
-        self.stream_display_manager.set_reasoner_model(is_reasoner)
+        self.refresh_context_gauge()
         
         # 更新状态栏指示器
+        is_reasoner = "reasoner" in model.lower()
         if is_reasoner:
             self.thinking_indicator.setText("🧠 推理模式")
         else:
@@ -1757,6 +2287,8 @@ class DeepSeekClient(QMainWindow):
         
         if self.current_topic:
             self.update_conversation_display()
+            self.refresh_stream_displays()
+        self.update_request_controls()
 
     def search_content(self, text):
         """搜索内容"""
@@ -1795,25 +2327,46 @@ class DeepSeekClient(QMainWindow):
             QMessageBox.warning(self, "错误", "请先选择或创建一个话题")
             return
         
+        if self.request_scheduler.is_busy(self.current_topic):
+            self.statusBar().showMessage("本话题的上一条回复尚未完成，可以先切换到其他话题提问", 3000)
+            return
+        
         message = self.message_input.toPlainText().strip()
-        if not message:
+        if not message and not self.pending_attachments:
             return
         
         # 添加到对话历史
         if self.current_topic not in self.conversations:
             self.conversations[self.current_topic] = []
         
+        content = message
+        if self.pending_attachments:
+            content = self.compose_attachments(message)
+        
         user_message = {
             "role": "user",
-            "content": message,
+            "content": content,
             "timestamp": datetime.now().isoformat()
         }
         self.conversations[self.current_topic].append(user_message)
         
-        # 构建消息列表
-        messages = [{"role": "system", "content": "You are a helpful assistant"}]
-        for conv in self.conversations[self.current_topic][-10:]:  # 只发送最近10条消息
-            messages.append({"role": conv["role"], "content": conv["content"]})
+        # 按模型的上下文预算从最新消息向前填充历史，输入token由话题前缀和直接求出
+        system_message = {"role": "system", "content": SYSTEM_PROMPT}
+        history = self.conversations[self.current_topic]
+        window = self.context_builder.build(self.current_topic, history, system_message,
+                                            self.current_model, self.max_tokens,
+                                            summary=self.current_summary(self.current_topic),
+                                            query=message if self.settings.value("history_retrieval", True, type=bool) else None)
+        messages = window.messages
+        input_tokens = window.input_tokens
+        compression = None
+        if self.compression_checkbox.isChecked():
+            messages, report = compress_messages(messages, self.token_calculator)
+            input_tokens -= report.tokens_saved
+            compression = report.to_dict()
+        # 按压缩后实际发送的token数判断是否超出预算
+        if input_tokens > window.budget:
+            self.statusBar().showMessage(f"⚠️ 本条消息超出上下文预算（{input_tokens}/{window.budget}），可能被截断", 5000)
         
         # 清空输入框
         self.message_input.clear()
@@ -1821,26 +2374,26 @@ class DeepSeekClient(QMainWindow):
         # 显示用户消息
         self.update_conversation_display()
         
-        # 设置流式显示管理器的模型状态
-        is_reasoner = "reasoner" in self.current_model.lower()
-        self.stream_display_manager.set_reasoner_model(is_reasoner)
-        
-        # 初始化流式显示
-        if self.stream_display_manager:
-            self.stream_display_manager.start_stream()
-        
         # 调用API
-        self.call_api(messages)
+        self.call_api(messages, input_tokens, compression=compression)
+        if compression and compression['tokens_saved'] > 0:
+            self.statusBar().showMessage(f"正在与AI对话...（压缩节省约 {compression['tokens_saved']} tokens）")
 
-    def call_api(self, messages):
-        """调用API"""
+    def handle_retry_scheduled(self, attempt, delay, reason):
+        """暂时性错误后等待自动重试"""
+        if self.sender().topic_id == self.current_topic:
+            self.stream_status_label.setText(f"⏳ {reason}，{delay:.0f}秒后第{attempt}次重试")
+
+    def call_api(self, messages, input_tokens=None, topic_id=None, compression=None):
+        """为话题发起API请求，由请求调度器按并发上限启动"""
+        topic_id = topic_id or self.current_topic
         stream = self.stream_checkbox.isChecked()
         
         # 获取当前助手配置
         manager = AssistantManager()
         assistant = manager.get_assistant(self.current_assistant_id) if hasattr(self, 'current_assistant_id') else None
         
-        self.api_worker = APIWorker(
+        worker = APIWorker(
             api_key=self.api_key,
             messages=messages,
             model=self.current_model,
@@ -1848,56 +2401,142 @@ class DeepSeekClient(QMainWindow):
             base_url=self.base_url,
             provider=assistant.provider if assistant and hasattr(assistant, 'provider') else None,
             custom_api_key=assistant.custom_api_key if assistant and hasattr(assistant, 'custom_api_key') else None,
-            custom_base_url=assistant.custom_base_url if assistant and hasattr(assistant, 'custom_base_url') else None
+            custom_base_url=assistant.custom_base_url if assistant and hasattr(assistant, 'custom_base_url') else None,
+            input_tokens=input_tokens,
+            usage_calibrator=self.usage_calibrator,
+            max_output_tokens=self.max_tokens
         )
+        # 请求所属的话题和界面状态随任务保存，信号处理时通过sender()取回，不受切换话题影响
+        worker.topic_id = topic_id
+        worker.assistant_id = getattr(self, 'current_assistant_id', "") or ""
+        worker.compression = compression
+        worker.cancel_requested = False
+        worker.display = None
         
         if stream:
-            self.api_worker.stream_chunk_received.connect(self.handle_stream_chunk)
-            self.api_worker.progress_updated.connect(self.handle_stream_progress)
+            worker.display = StreamDisplayManager(self.raw_text_edit, self.chat_history_widget,
+                                                  self.markdown_view, self.thinking_text_edit,
+                                                  active=topic_id == self.current_topic)
+            worker.display.set_reasoner_model("reasoner" in self.current_model.lower())
+            worker.display.start_stream()
+            worker.stream_chunk_received.connect(self.handle_stream_chunk)
+            worker.progress_updated.connect(self.handle_stream_progress)
             # 连接思考过程信号
-            self.api_worker.thinking_process_updated.connect(self.handle_thinking_process)
+            worker.thinking_process_updated.connect(self.handle_thinking_process)
+            worker.stream_reset.connect(self.handle_stream_reset)
         
-        self.api_worker.response_received.connect(self.handle_api_response)
-        self.api_worker.error_occurred.connect(self.handle_api_error)
-        self.api_worker.finished_signal.connect(self.handle_api_finished)
-        self.api_worker.token_usage_updated.connect(self.handle_token_usage)
+        worker.response_received.connect(self.handle_api_response)
+        worker.error_occurred.connect(self.handle_api_error)
+        worker.finished_signal.connect(self.handle_api_finished)
+        worker.token_usage_updated.connect(self.handle_token_usage)
+        worker.retry_scheduled.connect(self.handle_retry_scheduled)
+        self.last_api_messages[topic_id] = (messages, input_tokens)
+        self.api_workers[topic_id] = worker
         
         self.statusBar().showMessage("正在与AI对话...")
-        self.stream_status_label.setText("🔄 请求中...")
-        self.stream_indicator.setText("🔄 流式传输")
-        
-        # 更新思考过程状态
-        if "reasoner" in self.current_model.lower():
-            self.thinking_indicator.setText("🧠 思考中...")
-        
-        self.api_worker.start()
+        self.request_scheduler.submit(topic_id, worker)
+
+    def handle_request_queued(self, topic_id):
+        """并发名额已满，请求排队等待"""
+        self.update_request_controls()
+
+    def handle_request_started(self, topic_id):
+        """请求开始执行"""
+        self.update_request_controls()
+
+    def handle_request_done(self, topic_id):
+        """请求结束，释放并发名额；排队中被取消的请求在这里清理"""
+        worker = self.api_workers.get(topic_id)
+        if worker is not None and worker.future is None:
+            self.api_workers.pop(topic_id, None)
+            worker.deleteLater()
+            if topic_id == self.current_topic:
+                self.statusBar().showMessage("已取消排队中的请求", 5000)
+        self.update_request_controls()
+
+    def update_request_controls(self):
+        """按当前话题是否有进行中的请求切换发送/停止按钮和状态指示"""
+        worker = self.request_scheduler.job(self.current_topic)
+        self.send_btn.setVisible(worker is None)
+        self.stop_btn.setVisible(worker is not None)
+        if worker is None:
+            self.stream_indicator.setText("")
+            self.thinking_indicator.setText("")
+        elif self.request_scheduler.is_queued(self.current_topic):
+            self.stream_status_label.setText("⏳ 排队中...")
+        elif not worker.cancel_requested:
+            self.stream_status_label.setText("🔄 请求中...")
+            self.stream_indicator.setText("🔄 流式传输" if worker.stream else "")
+            # 更新思考过程状态
+            if worker.is_reasoner_model:
+                self.thinking_indicator.setText("🧠 思考中...")
+        
+        topics = self.request_scheduler.active_topics()
+        queued = sum(1 for topic_id in topics if self.request_scheduler.is_queued(topic_id))
+        if len(topics) > 1 or queued:
+            text = f"⚡ 进行中 {len(topics) - queued}"
+            if queued:
+                text += f" · 排队 {queued}"
+            self.requests_indicator.setText(text)
+            self.requests_indicator.setToolTip("\n".join(self.topics.get(t, {}).get("name", t) for t in topics))
+        else:
+            self.requests_indicator.setText("")
+
+    def refresh_stream_displays(self):
+        """只让当前话题的流式输出写入界面控件"""
+        workers = [w for w in self.api_workers.values() if w.display is not None]
+        for worker in workers:
+            worker.display.set_active(False)
+        for worker in workers:
+            if worker.topic_id == self.current_topic:
+                worker.display.set_active(True)
+
+    def cancel_request(self):
+        """停止当前话题的请求：立即关闭HTTP流，已接收的部分回答照常保存并记账"""
+        worker = self.request_scheduler.job(self.current_topic)
+        if worker is None:
+            return
+        worker.cancel_requested = True
+        self.request_scheduler.cancel(self.current_topic)
+        self.stream_status_label.setText("⏹ 正在停止...")
 
     def handle_thinking_process(self, thinking_chunk):
         """处理思考过程更新"""
-        self.stream_display_manager.add_thinking_chunk(thinking_chunk)
+        self.sender().display.add_thinking_chunk(thinking_chunk)
 
     def handle_stream_chunk(self, chunk, timestamp):
         """处理流式响应块"""
-        # 更新流式显示管理器
-        if self.stream_display_manager:
-            self.stream_display_manager.add_chunk(chunk, timestamp)
+        worker = self.sender()
+        # 更新该请求的流式显示，话题不在前台时只累积内容
+        worker.display.add_chunk(chunk, timestamp)
         
         # 更新状态显示
-        current_time = datetime.now().strftime("%H:%M:%S")
-        self.stream_status_label.setText(f"📡 接收中... {timestamp}s")
+        if worker.topic_id == self.current_topic:
+            self.stream_status_label.setText(f"📡 接收中... {timestamp}s")
+
+    def handle_stream_reset(self):
+        """无法续写时从头重新生成，重新开始流式显示"""
+        self.sender().display.start_stream()
 
     def handle_stream_progress(self, progress_message):
         """处理流式进度更新"""
-        self.statusBar().showMessage(progress_message)
+        if self.sender().topic_id == self.current_topic:
+            self.statusBar().showMessage(progress_message)
 
     def handle_api_response(self, content, metadata):
-        """处理API响应"""
+        """处理API响应，写回发起请求的话题"""
+        worker = self.sender()
+        topic_id = worker.topic_id
+        is_current = topic_id == self.current_topic
+        if worker.compression:
+            metadata['compression'] = worker.compression
+        
         # 完成流式显示
-        if self.stream_display_manager:
-            final_content, thinking_content = self.stream_display_manager.complete_stream()
+        if worker.display:
+            final_content, thinking_content = worker.display.complete_stream()
         else:
             final_content = content
-            thinking_content = ""
+            thinking_content = metadata.get('thinking_content', "")
         
         # 保存AI响应
         ai_message = {
@@ -1911,16 +2550,50 @@ class DeepSeekClient(QMainWindow):
         if thinking_content:
             ai_message["thinking_content"] = thinking_content
         
-        if self.current_topic in self.conversations:
-            self.conversations[self.current_topic].append(ai_message)
+        # 停止时还没有收到任何内容则不保存空回答，用量仍然记账
+        if topic_id in self.conversations and (final_content or thinking_content or not metadata.get('cancelled')):
+            self.conversations[topic_id].append(ai_message)
         
         # 更新显示
-        self.update_conversation_display()
+        if is_current:
+            self.update_conversation_display()
+        
+        # 用服务端真实用量校准该模型的估算系数
+        estimated = metadata.get('estimated_usage')
+        if (metadata.get('usage_source') == 'server' and estimated and not metadata.get('resumed')
+                and not metadata.get('attempts')):
+            self.usage_calibrator.update(estimated['model'], estimated, ServerUsage(**metadata['usage']))
+        
+        # 话题级上下文缓存命中统计（仅服务端真实用量）
+        if metadata.get('usage_source') == 'server' and topic_id:
+            self.prefix_cache_stats.record(topic_id, metadata.get('model', self.current_model),
+                                           metadata['usage'], metadata.get('ttft'))
+        
+        # 写入用量账本
+        usage_record = ServerUsage.from_usage(metadata.get('usage'))
+        if usage_record is not None and self.usage_ledger is not None and not metadata.get('not_sent'):
+            try:
+                record = self.usage_ledger.record(
+                    metadata.get('model', self.current_model), usage_record,
+                    source=metadata.get('usage_source', 'estimate'),
+                    topic_id=topic_id or "",
+                    assistant_id=worker.assistant_id,
+                    provider=metadata.get('provider', ""))
+                metadata['cost'] = {"amount": record["cost"], "currency": record["currency"]}
+            except Exception as e:
+                print(f"写入用量账本失败: {e}")
+            self.update_token_stats()
+        
+        if not is_current:
+            self.statusBar().showMessage(f"话题「{self.topics.get(topic_id, {}).get('name', topic_id)}」的回复已完成", 5000)
+            return
         
         # 更新状态栏
         if 'usage' in metadata:
-            tokens = metadata['usage'].get('total_tokens', 0)
+            usage = metadata['usage']
+            tokens = usage.get('total_tokens', 0)
             self.token_label.setText(f"Tokens: {tokens}")
+            self.token_label.setToolTip(self.format_usage_tooltip(metadata))
         
         self.model_label.setText(f"Model: {metadata.get('model', 'unknown')}")
         
@@ -1932,6 +2605,66 @@ class DeepSeekClient(QMainWindow):
                 status_msg += f"，包含思考过程"
             self.statusBar().showMessage(status_msg)
 
+    def format_usage_tooltip(self, metadata):
+        """生成用量详情提示（真实用量/估算、缓存命中、推理token及校准漂移）"""
+        usage = metadata.get('usage', {})
+        source = {"server": "服务端用量", "mixed": "服务端用量+中断部分估算"}.get(metadata.get('usage_source'), "本地估算")
+        if metadata.get('attempts'):
+            source += f"（{metadata['attempts']}次尝试合计）"
+        if metadata.get('cancelled'):
+            source += "（已手动停止）"
+        if metadata.get('not_sent'):
+            source = "请求未发出（已手动停止）"
+        lines = [
+            f"来源: {source}",
+            f"输入: {usage.get('prompt_tokens', 0)}",
+            f"输出: {usage.get('completion_tokens', 0)}"
+        ]
+        if usage.get('prompt_cache_hit_tokens') or usage.get('prompt_cache_miss_tokens'):
+            lines.append(f"缓存命中: {usage.get('prompt_cache_hit_tokens', 0)} / "
+                         f"未命中: {usage.get('prompt_cache_miss_tokens', 0)}")
+        if usage.get('reasoning_tokens'):
+            lines.append(f"推理token: {usage['reasoning_tokens']}")
+        if metadata.get('cost'):
+            cost = metadata['cost']
+            lines.append(f"费用: {format_costs({cost['currency']: cost['amount']})}")
+        if metadata.get('ttft') is not None:
+            connection = {"warm": "，复用连接", "cold": "，新建连接"}.get(metadata.get('connection'), "")
+            lines.append(f"首token延迟: {metadata['ttft']:.2f}s{connection}")
+            ttft_stats = get_shared_pool().ttft_stats(metadata.get('endpoint', self.base_url))
+            if ttft_stats:
+                lines.append("本端点平均首token延迟: " + " / ".join(
+                    f"{label} {ttft_stats[kind][1]:.2f}s（{ttft_stats[kind][0]}次）"
+                    for kind, label in (("warm", "复用连接"), ("cold", "新建连接")) if kind in ttft_stats))
+        if metadata.get('http_version'):
+            lines.append(f"协议: {metadata['http_version']}")
+        if metadata.get('failover'):
+            lines.append("端点故障转移: " + " → ".join(metadata['failover']))
+        elif metadata.get('endpoint'):
+            lines.append(f"端点: {metadata['endpoint']}")
+        if metadata.get('rate_limit_wait'):
+            lines.append(f"速率限制排队: {metadata['rate_limit_wait']:.1f}s")
+        if metadata.get('hedge'):
+            hedge = metadata['hedge']
+            lines.append(f"对冲请求: {hedge['delay']:.1f}s未收到首token，向 {hedge['endpoint']} 发出副本，"
+                         + ("副本先返回" if hedge['won'] else "原请求先返回"))
+            lines.append(get_shared_hedger().describe())
+        if metadata.get('compression'):
+            compression = metadata['compression']
+            before = compression['tokens_before']
+            lines.append(f"提示压缩: 节省 {compression['tokens_saved']} tokens"
+                         f"（{compression['tokens_saved'] / before:.1%}）" if before else "提示压缩: 未生效")
+        if self.current_topic:
+            cache = self.prefix_cache_stats.topic_stats(self.current_topic)
+            if cache['requests']:
+                lines.append(f"本话题缓存命中率: {cache['hit_rate']:.1%}（{cache['requests']}次请求），"
+                             f"估计节省首token延迟 {cache['saved_seconds']:.1f}s")
+        
+        model = metadata.get('estimated_usage', {}).get('model', self.current_model)
+        lines.append("")
+        lines.append(self.usage_calibrator.describe(model))
+        return "\n".join(lines)
+
     def handle_token_usage(self, input_tokens, output_tokens, total_tokens):
         """处理token使用量"""
         # 更新总统计
@@ -1940,13 +2673,39 @@ class DeepSeekClient(QMainWindow):
         self.total_tokens += total_tokens
         
         # 更新侧边栏显示
-        self.token_stats.setText(f"输入: {self.total_input_tokens}\n输出: {self.total_output_tokens}\n总计: {self.total_tokens}")
+        self.update_token_stats()
         
         # 更新状态栏
         self.token_label.setText(f"Tokens: {total_tokens}")
 
+    def create_usage_ledger(self):
+        """打开应用数据目录下的用量账本，价格可通过设置项model_prices（JSON）覆盖"""
+        data_dir = QStandardPaths.writableLocation(QStandardPaths.AppDataLocation)
+        try:
+            overrides = json.loads(self.settings.value("model_prices", "") or "{}")
+            return UsageLedger(os.path.join(data_dir, "usage_ledger.db"), PriceTable(overrides))
+        except Exception as e:
+            print(f"打开用量账本失败: {e}")
+            return None
+
+    def update_token_stats(self):
+        """刷新侧边栏：本次运行的累计值和本月费用（从账本汇总表读取）"""
+        text = f"输入: {self.total_input_tokens}\n输出: {self.total_output_tokens}\n总计: {self.total_tokens}"
+        if self.usage_ledger is not None:
+            month = self.usage_ledger.month_summary()
+            text += (f"\n\n本月请求: {month['requests']}\n"
+                     f"本月token: {month['prompt_tokens'] + month['completion_tokens']}\n"
+                     f"本月费用: {format_costs(month['costs'])}")
+        if self.current_topic:
+            cache = self.prefix_cache_stats.topic_stats(self.current_topic)
+            if cache['requests']:
+                text += f"\n\n话题缓存命中: {cache['hit_rate']:.0%}"
+        self.token_stats.setText(text)
+
     def handle_api_error(self, error_message):
         """处理API错误"""
+        worker = self.sender()
+        topic_id = worker.topic_id
         # 解析常见错误类型
         if "ConnectionError" in error_message:
             detailed_msg = "无法连接到API服务器，请检查网络连接和Base URL设置"
@@ -1959,27 +2718,38 @@ class DeepSeekClient(QMainWindow):
         else:
             detailed_msg = error_message
         
-        # 显示详细错误信息
+        retries = worker.retries
+        if topic_id != self.current_topic:
+            detailed_msg = f"话题「{self.topics.get(topic_id, {}).get('name', topic_id)}」: {detailed_msg}"
+        if retries:
+            detailed_msg += f"\n\n已自动重试 {retries} 次"
+        
+        # 暂时性错误已在后台按退避策略自动重试，这里只报告最终失败；提示框不阻塞界面
         error_dialog = QMessageBox(self)
         error_dialog.setIcon(QMessageBox.Icon.Critical)
         error_dialog.setWindowTitle("API错误")
         error_dialog.setText("API调用失败")
         error_dialog.setInformativeText(detailed_msg)
+        error_dialog.setModal(False)
+        error_dialog.setAttribute(Qt.WidgetAttribute.WA_DeleteOnClose)
         
         # 添加帮助按钮
         help_button = error_dialog.addButton("获取帮助", QMessageBox.ButtonRole.ActionRole)
         retry_button = error_dialog.addButton("重试", QMessageBox.ButtonRole.ActionRole)
         error_dialog.addButton(QMessageBox.StandardButton.Ok)
         
-        # 显示对话框并处理响应
-        error_dialog.exec()
+        def handle_button(button):
+            if button is help_button:
+                self.show_api_help()
+            elif button is retry_button:
+                self.retry_last_request(topic_id)
         
-        if error_dialog.clickedButton() == help_button:
-            self.show_api_help()
-        elif error_dialog.clickedButton() == retry_button:
-            self.retry_last_request()
+        error_dialog.buttonClicked.connect(handle_button)
+        error_dialog.show()
         
         # 更新状态显示
+        if topic_id != self.current_topic:
+            return
         self.statusBar().showMessage("API调用失败")
         self.stream_status_label.setText("❌ 错误")
         self.stream_indicator.setText("")
@@ -2000,21 +2770,80 @@ class DeepSeekClient(QMainWindow):
         """
         QMessageBox.information(self, "API帮助", help_text)
     
-    def retry_last_request(self):
-        """重试上次请求"""
-        if hasattr(self, 'last_api_messages'):
-            self.call_api(self.last_api_messages)
+    def retry_last_request(self, topic_id=None):
+        """重试话题的上次请求"""
+        topic_id = topic_id or self.current_topic
+        if topic_id in self.last_api_messages and not self.request_scheduler.is_busy(topic_id):
+            messages, input_tokens = self.last_api_messages[topic_id]
+            self.call_api(messages, input_tokens, topic_id=topic_id)
 
     def handle_api_finished(self):
         """API调用完成"""
-        self.statusBar().showMessage("就绪")
-        self.stream_status_label.setText("就绪")
-        self.stream_indicator.setText("")
-        self.thinking_indicator.setText("")
+        worker = self.sender()
+        topic_id = worker.topic_id
+        if self.api_workers.get(topic_id) is worker:
+            del self.api_workers[topic_id]
+        worker.deleteLater()
+        if topic_id == self.current_topic:
+            if worker.cancel_requested:
+                self.statusBar().showMessage("已停止生成，保留了已接收的部分回答", 5000)
+                self.stream_status_label.setText("⏹ 已停止")
+            elif self.stream_status_label.text() != "❌ 错误":
+                self.statusBar().showMessage("就绪")
+                self.stream_status_label.setText("就绪")
         self.save_data()
+        self.schedule_summary(topic_id)
+
+    def current_summary(self, topic_id):
+        """与话题当前历史匹配的滚动摘要，未启用或尚未生成时返回None"""
+        if not topic_id or not self.settings.value("rolling_summary", True, type=bool):
+            return None
+        return self.summary_cache.lookup(topic_id, self.conversations.get(topic_id, []))
+
+    def schedule_summary(self, topic_id):
+        """较早的消息累积到一定数量时，在后台把它们合并进话题摘要"""
+        if not topic_id or topic_id in self.summary_workers or not self.api_key:
+            return
+        if not self.settings.value("rolling_summary", True, type=bool):
+            return
+        history = self.conversations.get(topic_id, [])
+        pending = self.summary_cache.pending_range(topic_id, history)
+        if pending is None:
+            return
+        
+        start, end = pending
+        worker = SummaryWorker(topic_id, history, start, end,
+                               self.summary_cache.lookup(topic_id, history),
+                               self.api_key, get_shared_router().best(self.base_url),
+                               model=self.settings.value("summary_model", "deepseek-chat"))
+        worker.summary_ready.connect(self.handle_summary_ready)
+        worker.error_occurred.connect(self.handle_summary_error)
+        worker.finished.connect(lambda: self.summary_workers.pop(topic_id, None))
+        worker.finished.connect(worker.deleteLater)
+        self.summary_workers[topic_id] = worker
+        worker.start()
+
+    def handle_summary_ready(self, topic_id, state, usage):
+        """保存新摘要并记录摘要请求的用量"""
+        self.summary_cache.store(topic_id, SummaryState(**state))
+        usage_record = ServerUsage.from_usage(usage)
+        if usage_record is not None and self.usage_ledger is not None:
+            try:
+                self.usage_ledger.record(state["model"], usage_record, topic_id=topic_id,
+                                         assistant_id="rolling_summary")
+            except Exception as e:
+                print(f"写入用量账本失败: {e}")
+            self.update_token_stats()
+        if topic_id == self.current_topic:
+            self.refresh_context_gauge()
+
+    def handle_summary_error(self, topic_id, error_message):
+        """摘要失败不影响对话，下次响应完成后重试"""
+        print(f"生成话题摘要失败: {error_message}")
 
     def update_conversation_display(self):
         """更新对话显示"""
+        self.refresh_context_gauge()
         if not self.current_topic or self.current_topic not in self.conversations:
             return
         
@@ -2045,6 +2874,10 @@ class DeepSeekClient(QMainWindow):
             # 如果有思考过程，显示在思考过程标签页
             if ai_responses[-1].get("thinking_content"):
                 self.thinking_text_edit.setPlainText(ai_responses[-1]["thinking_content"])
+        else:
+            # 不保留上一个话题的回复，其他话题进行中的流式输出也不会写到这里
+            self.raw_text_edit.clear()
+            self.thinking_text_edit.clear()
 
     def upload_file(self):
         """上传文件"""
@@ -2064,6 +2897,15 @@ class DeepSeekClient(QMainWindow):
             with open(file_path, 'r', encoding='utf-8') as f:
                 content = f.read()
             
+            # 大文件分段建立索引，发送时只选取与问题相关的片段
+            if self.token_calculator.estimate_tokens(content) > INLINE_ATTACHMENT_TOKENS:
+                attachment = Attachment.from_text(os.path.basename(file_path), content, self.token_calculator)
+                self.pending_attachments.append(attachment)
+                self.update_attachment_label()
+                self.statusBar().showMessage(f"文件较大（约{attachment.total_tokens} tokens，{len(attachment.chunks)}段），"
+                                             f"发送时将按与问题的相关性选取片段")
+                return
+            
             # 将文件内容添加到输入框
             current_text = self.message_input.toPlainText()
             if current_text:
@@ -2075,9 +2917,43 @@ class DeepSeekClient(QMainWindow):
         except Exception as e:
             QMessageBox.critical(self, "文件处理错误", f"无法读取文件: {str(e)}")
 
+    def update_attachment_label(self):
+        """刷新待发送附件提示"""
+        if self.pending_attachments:
+            names = "、".join(a.name for a in self.pending_attachments)
+            tokens = sum(a.total_tokens for a in self.pending_attachments)
+            self.attachment_label.setText(f"📎 {names}（约{tokens} tokens）")
+        else:
+            self.attachment_label.setText("")
+        self.refresh_context_gauge()
+
+    def attachment_budget(self, draft_tokens=0):
+        """附件片段可用的token数：当前上下文占用之后的剩余预算，且不超过预算的MAX_ATTACHMENT_SHARE"""
+        history = self.conversations.get(self.current_topic, [])
+        used = self.context_builder.preview_tokens(
+            self.current_topic, history, {"role": "system", "content": SYSTEM_PROMPT},
+            self.current_model, self.max_tokens, draft_tokens,
+            summary=self.current_summary(self.current_topic))
+        budget = input_budget(self.current_model, self.max_tokens)
+        return max(min(budget - used, int(budget * MAX_ATTACHMENT_SHARE)), 0)
+
+    def compose_attachments(self, message):
+        """把待发送附件中与问题最相关的片段附加到消息后，并清空待发送列表"""
+        remaining = self.attachment_budget(self.token_calculator.calculate_tokens(message))
+        share = remaining // len(self.pending_attachments)
+        parts = [message] if message else []
+        for attachment in self.pending_attachments:
+            excerpt, _ = attachment.select(message, share)
+            parts.append(excerpt)
+        self.pending_attachments = []
+        self.update_attachment_label()
+        return "\n\n".join(parts)
+
     def clear_input(self):
         """清空输入"""
         self.message_input.clear()
+        self.pending_attachments = []
+        self.update_attachment_label()
 
     def clear_conversation_display(self):
         """清空对话显示"""
@@ -2115,7 +2991,9 @@ class DeepSeekClient(QMainWindow):
             topic_name = self.topics[self.current_topic]["name"]
             f.write(f"# {topic_name}\n\n")
             f.write(f"导出时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n")
-            f.write(f"总Token使用量: 输入{self.total_input_tokens} + 输出{self.total_output_tokens} = {self.total_tokens}\n\n")
+            usage = summarize_messages(self.conversations[self.current_topic], self.usage_ledger_prices())
+            f.write(f"话题Token使用量: 输入{usage['prompt_tokens']} + 输出{usage['completion_tokens']} = {usage['total_tokens']}"
+                    f"（{usage['requests']}次请求，费用{format_costs(usage['costs'])}）\n\n")
             
             for conv in self.conversations[self.current_topic]:
                 role = "用户" if conv["role"] == "user" else "AI"
@@ -2128,16 +3006,16 @@ class DeepSeekClient(QMainWindow):
                     f.write(f"### {role}思考过程\n\n")
                     f.write(conv["thinking_content"] + "\n\n")
 
+    def usage_ledger_prices(self):
+        """账本使用的价格表，账本不可用时使用内置价格"""
+        return self.usage_ledger.prices if self.usage_ledger is not None else PriceTable()
+
     def export_json(self, file_path):
         """导出为JSON格式"""
         export_data = {
             "topic": self.topics[self.current_topic],
             "conversations": self.conversations[self.current_topic],
-            "token_usage": {
-                "input_tokens": self.total_input_tokens,
-                "output_tokens": self.total_output_tokens,
-                "total_tokens": self.total_tokens
-            },
+            "token_usage": summarize_messages(self.conversations[self.current_topic], self.usage_ledger_prices()),
             "export_time": datetime.now().isoformat()
         }
         
@@ -2148,6 +3026,17 @@ class DeepSeekClient(QMainWindow):
         """显示设置对话框"""
         dialog = ModernSettingsDialog(self)
         dialog.exec()
+    
+    def show_compare_dialog(self):
+        """多模型对比：以输入框中的内容为提示，每次对比的结果追加保存到应用数据目录"""
+        data_dir = QStandardPaths.writableLocation(QStandardPaths.AppDataLocation)
+        dialog = CompareDialog(self.api_key, self.base_url, self.message_input.toPlainText().strip(),
+                               ledger=self.usage_ledger, usage_calibrator=self.usage_calibrator,
+                               results_path=os.path.join(data_dir, "model_compare.jsonl"), parent=self)
+        # 对比请求已计入用量账本，刷新本月费用
+        dialog.compare_finished.connect(lambda result: self.update_token_stats())
+        dialog.setAttribute(Qt.WA_DeleteOnClose)
+        dialog.show()
 
     def show_about(self):
         """显示关于信息"""
@@ -2187,6 +3076,34 @@ class DeepSeekClient(QMainWindow):
             self.conversations = json.loads(conversations_data)
         else:
             self.conversations = {topic_id: [] for topic_id in self.topics.keys()}
+        self.token_index.invalidate()
+        self.history_retriever.invalidate()
+        
+        # 加载滚动摘要
+        summaries_data = self.settings.value("topic_summaries")
+        if summaries_data:
+            try:
+                self.summary_cache = RollingSummaryCache.from_dict(json.loads(summaries_data))
+            except (ValueError, TypeError):
+                self.summary_cache = RollingSummaryCache()
+        self.summary_cache.reset_history()
+        self.context_builder.reset()
+        
+        # 加载上下文缓存命中统计
+        cache_stats_data = self.settings.value("prompt_cache_stats")
+        if cache_stats_data:
+            try:
+                self.prefix_cache_stats = PrefixCacheStats.from_dict(json.loads(cache_stats_data))
+            except (ValueError, TypeError):
+                self.prefix_cache_stats = PrefixCacheStats()
+        
+        # 加载token估算校准数据
+        calibration_data = self.settings.value("usage_calibration")
+        if calibration_data:
+            try:
+                self.usage_calibrator = UsageCalibrator.from_dict(json.loads(calibration_data))
+            except (ValueError, TypeError):
+                self.usage_calibrator = UsageCalibrator()
         
         self.update_topic_list()
         if self.topic_list.count() > 0:
@@ -2197,11 +3114,20 @@ class DeepSeekClient(QMainWindow):
         """保存数据"""
         self.settings.setValue("topics", json.dumps(self.topics))
         self.settings.setValue("conversations", json.dumps(self.conversations))
+        self.settings.setValue("usage_calibration", json.dumps(self.usage_calibrator.to_dict()))
+        self.settings.setValue("topic_summaries", json.dumps(self.summary_cache.to_dict()))
+        self.settings.setValue("prompt_cache_stats", json.dumps(self.prefix_cache_stats.to_dict()))
         self.settings.sync()
 
     def closeEvent(self, event):
         """关闭事件"""
+        self.input_meter.stop()
+        for worker in list(self.summary_workers.values()):
+            worker.wait(3000)
         self.save_data()
+        # 取消仍在进行的请求，关闭引擎线程上的异步连接
+        get_engine().stop(before_close=get_shared_pool().aclose())
+        get_shared_pool().close()
         event.accept()
 
 def main():
@@ -1,11 +1,16 @@
 # -*- mode: python ; coding: utf-8 -*-
+import os
 
+# 离线BPE词表由 python -m src.fetch_tokenizer 获取并校验；缺失时拒绝打包，避免发布只能近似计数的版本
+TOKENIZER_JSON = os.path.join('tokenizers', 'deepseek', 'tokenizer.json')
+if not os.path.exists(TOKENIZER_JSON):
+    raise SystemExit(f'缺少离线词表 {TOKENIZER_JSON}，请先运行 python -m src.fetch_tokenizer')
 
 a = Analysis(
     ['main.py'],
     pathex=[],
     binaries=[],
-    datas=[('dist/DeepSeek-Desktop', 'DeepSeek-Desktop')],
+    datas=[('dist/DeepSeek-Desktop', 'DeepSeek-Desktop'), (TOKENIZER_JSON, 'src/tokenizers/deepseek')],
     hiddenimports=[],
     hookspath=[],
     hooksconfig={},
@@ -0,0 +1,195 @@
+import json
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from PySide6.QtCore import QObject, Signal
+
+from .api_worker import APIWorker
+from .llm_adapters import DEFAULT_BASE_URLS, LLMProvider
+from .usage_calibration import ServerUsage, UsageCalibrator
+from .usage_ledger import PriceTable, UsageLedger
+
+
+@dataclass
+class CompareTarget:
+    """参与对比的一个模型或助手"""
+    label: str
+    model: str
+    provider: str
+    api_key: str
+    base_url: str
+    system_prompt: str = ""
+    assistant_id: str = ""
+
+    @classmethod
+    def from_assistant(cls, assistant, api_key: str, base_url: str) -> "CompareTarget":
+        """助手使用自己的API配置；未配置时DeepSeek沿用当前地址，其他提供商使用默认地址"""
+        if assistant.custom_api and assistant.custom_base_url:
+            base_url = assistant.custom_base_url
+        elif assistant.provider != "deepseek":
+            try:
+                base_url = DEFAULT_BASE_URLS.get(LLMProvider(assistant.provider), base_url)
+            except ValueError:
+                pass
+        return cls(label=assistant.name, model=assistant.model, provider=assistant.provider,
+                   api_key=(assistant.custom_api and assistant.custom_api_key) or api_key,
+                   base_url=base_url, system_prompt=assistant.system_prompt, assistant_id=assistant.id)
+
+
+@dataclass
+class CompareEntry:
+    """一个对比对象的回答和指标"""
+    target: CompareTarget
+    content: str = ""
+    thinking: str = ""
+    metadata: dict = field(default_factory=dict)
+    error: str = ""
+    elapsed: Optional[float] = None  # 从发出请求到回答结束的秒数
+    cost: float = 0.0
+    currency: str = ""
+    done: bool = False
+
+    def to_dict(self) -> dict:
+        usage = self.metadata.get("usage", {})
+        return {
+            "label": self.target.label,
+            "model": self.target.model,
+            "provider": self.target.provider,
+            "ttft": self.metadata.get("ttft"),
+            "tokens_per_second": self.metadata.get("tokens_per_second"),
+            "elapsed": self.elapsed,
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "completion_tokens": usage.get("completion_tokens", 0),
+            "reasoning_tokens": usage.get("reasoning_tokens", 0),
+            "usage_source": self.metadata.get("usage_source"),
+            "cost": self.cost,
+            "currency": self.currency,
+            "cancelled": bool(self.metadata.get("cancelled")),
+            "error": self.error,
+            "content": self.content,
+        }
+
+
+class CompareSession(QObject):
+    """把同一个提示并发发给多个模型或助手，分别流式接收，结束后汇总为一份对比结果
+
+    每个对比对象各用一个请求任务，全部同时在请求引擎上运行，不经过按话题排队的请求调度；
+    速率限制仍按提供商、密钥和模型分别生效。只在界面线程中使用。
+    """
+    chunk_received = Signal(int, str)  # 对比对象序号, 回答内容块
+    thinking_received = Signal(int, str)  # 对比对象序号, 思考过程块
+    entry_finished = Signal(int)  # 对比对象序号：回答结束（完成、失败或停止）
+    finished = Signal()  # 所有对比对象都已结束
+
+    def __init__(self, prompt: str, targets: List[CompareTarget], ledger: Optional[UsageLedger] = None,
+                 usage_calibrator: Optional[UsageCalibrator] = None, parent: Optional[QObject] = None):
+        super().__init__(parent)
+        self.prompt = prompt
+        self.entries = [CompareEntry(target) for target in targets]
+        self.ledger = ledger
+        self.prices = ledger.prices if ledger is not None else PriceTable()
+        self.usage_calibrator = usage_calibrator
+        self.created = datetime.now()
+        self._workers: List[APIWorker] = []
+        self._started = 0.0
+
+    def messages_for(self, target: CompareTarget) -> List[Dict[str, str]]:
+        messages = [{"role": "system", "content": target.system_prompt}] if target.system_prompt else []
+        return messages + [{"role": "user", "content": self.prompt}]
+
+    def start(self):
+        self._started = time.monotonic()
+        for entry in self.entries:
+            target = entry.target
+            worker = APIWorker(target.api_key, self.messages_for(target), model=target.model, stream=True,
+                               base_url=target.base_url, provider=target.provider,
+                               usage_calibrator=self.usage_calibrator)
+            # 连接到本对象的方法，引擎线程发出的信号排队到界面线程处理
+            worker.stream_chunk_received.connect(self._on_chunk)
+            worker.thinking_process_updated.connect(self._on_thinking)
+            worker.response_received.connect(self._on_response)
+            worker.error_occurred.connect(self._on_error)
+            worker.finished_signal.connect(self._on_finished)
+            self._workers.append(worker)
+        for worker in self._workers:
+            worker.start()
+
+    def cancel(self):
+        for worker, entry in zip(self._workers, self.entries):
+            if not entry.done:
+                worker.cancel()
+
+    def is_running(self) -> bool:
+        return bool(self._workers) and not all(entry.done for entry in self.entries)
+
+    def _index(self) -> int:
+        sender = self.sender()
+        return next((i for i, worker in enumerate(self._workers) if worker is sender), -1)
+
+    def _on_chunk(self, chunk, timestamp):
+        index = self._index()
+        # 思考过程另由thinking_process_updated送达
+        if index >= 0 and not chunk.startswith("[思考] "):
+            self.chunk_received.emit(index, chunk)
+
+    def _on_thinking(self, chunk):
+        index = self._index()
+        if index >= 0:
+            self.entries[index].thinking += chunk
+            self.thinking_received.emit(index, chunk)
+
+    def _on_response(self, content, metadata):
+        index = self._index()
+        if index < 0:
+            return
+        entry = self.entries[index]
+        entry.content = content
+        entry.metadata = metadata
+        entry.elapsed = round(time.monotonic() - self._started, 3)
+        usage = ServerUsage.from_usage(metadata.get("usage"))
+        if usage is None or metadata.get("not_sent"):
+            return
+        # 对比请求同样计入用量账本
+        if self.ledger is not None:
+            try:
+                record = self.ledger.record(entry.target.model, usage, source=metadata.get("usage_source", "estimate"),
+                                            assistant_id=entry.target.assistant_id,
+                                            provider=metadata.get("provider", entry.target.provider))
+                entry.cost, entry.currency = record["cost"], record["currency"]
+                return
+            except Exception as e:
+                print(f"写入用量账本失败: {e}")
+        entry.cost, entry.currency = self.prices.cost(entry.target.model, usage)
+
+    def _on_error(self, error_message):
+        index = self._index()
+        if index >= 0:
+            self.entries[index].error = error_message
+
+    def _on_finished(self):
+        index = self._index()
+        if index < 0 or self.entries[index].done:
+            return
+        self.entries[index].done = True
+        self.entry_finished.emit(index)
+        if all(entry.done for entry in self.entries):
+            self.finished.emit()
+
+    def result(self) -> dict:
+        """一次对比的完整结果：提示和每个对比对象的回答、首token延迟、速度、用量与费用"""
+        return {
+            "prompt": self.prompt,
+            "created": self.created.isoformat(timespec="seconds"),
+            "entries": [entry.to_dict() for entry in self.entries],
+        }
+
+
+def append_result(path, result: dict):
+    """把对比结果追加到JSON Lines文件"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(result, ensure_ascii=False) + "\n")
@@ -0,0 +1,170 @@
+import re
+from dataclasses import dataclass
+from typing import List, Tuple
+
+_FENCE = re.compile(r'^ {0,3}(`{3,}|~{3,})')
+_ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;?]*[A-Za-z]|\x1b\][^\x07]*\x07')
+_INVISIBLE = re.compile(r'[\u200b\u200c\u200d\u2060\ufeff]')
+_INNER_WHITESPACE = re.compile(r'(?<=\S)[ \t]{2,}')
+# 日志行开头的时间戳，去掉后内容相同的连续行视为重复日志
+_LOG_TIMESTAMP = re.compile(
+    r'^\[?(?:\d{4}[-/]\d{2}[-/]\d{2}[ T])?\d{2}:\d{2}:\d{2}(?:[.,]\d+)?(?:Z|[+-]\d{2}:?\d{2})?\]?\s*')
+
+# 重复段落至少达到该长度才替换为引用，避免标记本身比原文更长
+MIN_DUPLICATE_BLOCK_CHARS = 120
+
+
+@dataclass
+class CompressionReport:
+    """一次请求的压缩效果"""
+    tokens_before: int = 0
+    tokens_after: int = 0
+    messages_changed: int = 0
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_before - self.tokens_after
+
+    @property
+    def ratio(self) -> float:
+        return self.tokens_saved / self.tokens_before if self.tokens_before else 0.0
+
+    def to_dict(self) -> dict:
+        return {"tokens_before": self.tokens_before, "tokens_after": self.tokens_after,
+                "tokens_saved": self.tokens_saved, "messages_changed": self.messages_changed}
+
+
+def _split_code_blocks(text: str) -> List[Tuple[bool, List[str]]]:
+    """按围栏代码块切分为(是否代码, 行列表)，行保留原始换行符；未闭合的围栏视为代码直到结尾
+
+    与CommonMark一致：围栏只由不少于开头围栏长度的同种字符组成的行关闭，
+    因此四个反引号包裹的代码块里可以出现三个反引号的行。
+    """
+    segments: List[Tuple[bool, List[str]]] = []
+    fence = None
+    for line in text.splitlines(keepends=True):
+        match = _FENCE.match(line)
+        if fence is None and match:
+            fence = match.group(1)
+            segments.append((True, [line]))
+            continue
+        if fence is not None:
+            segments[-1][1].append(line)
+            if (match and match.group(1)[0] == fence[0] and len(match.group(1)) >= len(fence)
+                    and not line[match.end():].strip()):
+                fence = None
+            continue
+        if not segments or segments[-1][0]:
+            segments.append((False, []))
+        segments[-1][1].append(line)
+    return segments
+
+
+def _compress_lines(lines: List[str]) -> List[str]:
+    """清理单段非代码文本：去除控制序列和多余空白，折叠连续重复的行"""
+    cleaned = []
+    for line in lines:
+        line = _ANSI_ESCAPE.sub("", line)
+        line = _INVISIBLE.sub("", line).replace("\r", "").replace("\xa0", " ")
+        line = _INNER_WHITESPACE.sub(" ", line.rstrip())
+        cleaned.append(line)
+
+    result = []
+    i = 0
+    while i < len(cleaned):
+        line = cleaned[i]
+        if not line:
+            # 多个空行只保留一个
+            if result and result[-1] == "":
+                i += 1
+                continue
+            result.append(line)
+            i += 1
+            continue
+
+        key = _LOG_TIMESTAMP.sub("", line)
+        j = i + 1
+        while j < len(cleaned) and cleaned[j] and _LOG_TIMESTAMP.sub("", cleaned[j]) == key:
+            j += 1
+        repeats = j - i - 1
+        if repeats >= 2:
+            if all(cleaned[k] == line for k in range(i, j)):
+                result.extend([line, f"…[上一行又重复了{repeats}次]"])
+            else:
+                # 仅时间戳不同：保留首尾两行
+                result.extend([line, f"…[省略{repeats - 1}行仅时间戳不同的重复日志]", cleaned[j - 1]])
+        else:
+            result.extend(cleaned[i:j])
+        i = j
+    return result
+
+
+def _dedupe_blocks(lines: List[str], seen: set) -> List[str]:
+    """空行分隔的段落在本条消息中已出现过时替换为引用"""
+    result, block = [], []
+
+    def flush():
+        text = "\n".join(block)
+        if len(text) >= MIN_DUPLICATE_BLOCK_CHARS and text in seen:
+            result.append(f"…[与前文重复的段落（{len(block)}行），已省略]")
+        else:
+            if len(text) >= MIN_DUPLICATE_BLOCK_CHARS:
+                seen.add(text)
+            result.extend(block)
+
+    for line in lines:
+        if line:
+            block.append(line)
+            continue
+        if block:
+            flush()
+            block = []
+        result.append(line)
+    if block:
+        flush()
+    return result
+
+
+def compress_text(text: str) -> str:
+    """压缩一条消息的文本；围栏代码块逐字节保留，结果只取决于文本本身"""
+    if not text:
+        return text
+    parts = []
+    seen = set()
+    segments = _split_code_blocks(text)
+    for index, (is_code, lines) in enumerate(segments):
+        if is_code:
+            parts.append("".join(lines))
+            continue
+        compressed = _dedupe_blocks(_compress_lines(lines), seen)
+        chunk = "\n".join(compressed)
+        # 与下一段代码块之间保留换行
+        if index + 1 < len(segments) or lines[-1].endswith("\n"):
+            chunk += "\n"
+        parts.append(chunk)
+    return "".join(parts)
+
+
+def compress_messages(messages: List[dict], calculator) -> Tuple[List[dict], CompressionReport]:
+    """压缩除系统提示外的消息内容并统计节省的token
+
+    每条消息独立压缩、结果确定，同一条历史消息每轮得到相同文本，不影响上下文缓存命中。
+    """
+    report = CompressionReport()
+    compressed = []
+    for message in messages:
+        content = message.get("content")
+        before = calculator.calculate_messages_tokens([message])
+        report.tokens_before += before
+        if message.get("role") == "system" or not isinstance(content, str):
+            compressed.append(message)
+            report.tokens_after += before
+            continue
+
+        new_content = compress_text(content)
+        if new_content != content:
+            message = dict(message, content=new_content)
+            report.messages_changed += 1
+        compressed.append(message)
+        report.tokens_after += calculator.calculate_messages_tokens([message])
+    return compressed, report
@@ -0,0 +1,255 @@
+import asyncio
+import hashlib
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Mapping, Optional, Tuple
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    """每分钟请求数和每分钟token数，None表示不限制"""
+    rpm: Optional[int] = None
+    tpm: Optional[int] = None
+
+
+# 各提供商最低档位账号的默认限额；服务端在响应头中返回实际限额后以其为准
+DEFAULT_LIMITS: Dict[str, RateLimit] = {
+    "openai": RateLimit(rpm=500, tpm=30000),
+    "anthropic": RateLimit(rpm=50, tpm=30000),
+    "gemini": RateLimit(rpm=15, tpm=1000000),
+}
+
+# OpenAI兼容接口和Anthropic返回限额的响应头
+_LIMIT_HEADERS = {
+    "requests": ("x-ratelimit-limit-requests", "anthropic-ratelimit-requests-limit"),
+    "tokens": ("x-ratelimit-limit-tokens", "anthropic-ratelimit-tokens-limit"),
+}
+_REMAINING_HEADERS = {
+    "requests": ("x-ratelimit-remaining-requests", "anthropic-ratelimit-requests-remaining"),
+    "tokens": ("x-ratelimit-remaining-tokens", "anthropic-ratelimit-tokens-remaining"),
+}
+
+
+def _header_int(headers: Mapping[str, str], names) -> Optional[int]:
+    for name in names:
+        value = headers.get(name)
+        if value:
+            match = re.match(r"\s*(\d+)", value)
+            if match:
+                return int(match.group(1))
+    return None
+
+
+class TokenBucket:
+    """令牌桶：容量为每分钟的限额，按容量/60每秒匀速补充
+
+    允许短时间内用完整分钟的额度，之后按平均速率放行。
+    """
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / 60.0
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay_for(self, amount: float, now: float) -> float:
+        """还需等待多少秒才能取出amount个令牌；超过容量的请求按取满整桶计算"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float):
+        # 允许透支：结算时实际用量超出预估的部分从后续额度中扣除
+        self.tokens -= min(amount, self.capacity)
+
+    def refund(self, amount: float):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def resize(self, per_minute: int):
+        if per_minute > 0 and per_minute != self.capacity:
+            self.tokens = self.tokens * per_minute / self.capacity
+            self.capacity = float(per_minute)
+
+    def clamp(self, remaining: int, now: float):
+        """按服务端报告的剩余额度修正本地估计"""
+        self._refill(now)
+        self.tokens = min(self.tokens, float(remaining))
+
+    def drain(self, seconds: float, now: float):
+        """被限流后清空令牌桶，seconds秒内不再放行"""
+        self._refill(now)
+        self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+
+class _Lane:
+    """同一提供商、密钥和模型共享的限额"""
+
+    def __init__(self, limit: RateLimit):
+        self.requests = TokenBucket(limit.rpm) if limit.rpm else None
+        self.tokens = TokenBucket(limit.tpm) if limit.tpm else None
+        # asyncio.Lock按到达顺序唤醒等待者，排队的请求先到先得，大请求不会被小请求饿死
+        self.queue = asyncio.Lock()
+        # 有额度退还时唤醒队首，不必睡满按预估计算的等待时间
+        self.refunded = asyncio.Event()
+        self.waiting = 0
+
+    def delay_for(self, tokens: int, now: float) -> float:
+        delay = 0.0
+        if self.requests:
+            delay = max(delay, self.requests.delay_for(1, now))
+        if self.tokens:
+            delay = max(delay, self.tokens.delay_for(tokens, now))
+        return delay
+
+    def consume(self, tokens: int):
+        if self.requests:
+            self.requests.consume(1)
+        if self.tokens:
+            self.tokens.consume(tokens)
+
+
+class Reservation:
+    """一次已放行的请求；拿到实际用量后调用settle修正token额度"""
+
+    def __init__(self, lane: Optional[_Lane], estimated_tokens: int, waited: float):
+        self.lane = lane
+        self.estimated_tokens = estimated_tokens
+        self.waited = waited
+        self._settled = False
+
+    def settle(self, actual_tokens: Optional[int]):
+        """多退少补；没有实际用量时保留预估值"""
+        if self._settled or actual_tokens is None or self.lane is None or self.lane.tokens is None:
+            return
+        self._settled = True
+        difference = self.estimated_tokens - actual_tokens
+        if difference > 0:
+            self.lane.tokens.refund(difference)
+            self.lane.refunded.set()
+        elif difference < 0:
+            self.lane.tokens.consume(-difference)
+
+
+class RateLimiter:
+    """客户端限流：按(提供商, 密钥, 模型)分别限制每分钟请求数和token数
+
+    请求在发出前用预估的token数（输入token + 预计输出）申请额度，额度不足时排队等待，
+    而不是发出后被服务端以429拒绝。所有请求都运行在请求引擎的事件循环中，acquire只能在其中调用。
+    """
+
+    def __init__(self, limits: Optional[Dict[str, RateLimit]] = None):
+        self.limits: Dict[str, RateLimit] = dict(DEFAULT_LIMITS if limits is None else limits)
+        self._lanes: Dict[Tuple[str, str, str], _Lane] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(provider: str, api_key: str, model: str) -> Tuple[str, str, str]:
+        return (provider, hashlib.sha256(api_key.encode("utf-8")).hexdigest(), model)
+
+    def configure(self, provider: str, limit: Optional[RateLimit]):
+        """设置提供商的限额，None恢复默认；已有的队列按新限额重建"""
+        with self._lock:
+            if limit is None:
+                self.limits.pop(provider, None)
+                if provider in DEFAULT_LIMITS:
+                    self.limits[provider] = DEFAULT_LIMITS[provider]
+            else:
+                self.limits[provider] = limit
+            self._lanes = {k: v for k, v in self._lanes.items() if k[0] != provider or v.waiting}
+
+    def _lane(self, provider: str, api_key: str, model: str) -> Optional[_Lane]:
+        key = self._key(provider, api_key, model)
+        with self._lock:
+            lane = self._lanes.get(key)
+            if lane is None:
+                limit = self.limits.get(provider)
+                if limit is None or not (limit.rpm or limit.tpm):
+                    return None
+                lane = self._lanes[key] = _Lane(limit)
+            return lane
+
+    def waiting(self, provider: str, api_key: str, model: str) -> int:
+        """正在排队的请求数"""
+        with self._lock:
+            lane = self._lanes.get(self._key(provider, api_key, model))
+            return lane.waiting if lane else 0
+
+    def would_wait(self, provider: str, api_key: str, model: str, tokens: int) -> bool:
+        """当前申请是否需要排队，用于提示用户"""
+        lane = self._lane(provider, api_key, model)
+        return lane is not None and (lane.queue.locked() or lane.delay_for(tokens, time.monotonic()) > 0)
+
+    async def acquire(self, provider: str, api_key: str, model: str, tokens: int) -> Reservation:
+        """等待额度并占用一次请求和tokens个token"""
+        lane = self._lane(provider, api_key, model)
+        if lane is None:
+            return Reservation(None, tokens, 0.0)
+        started = time.monotonic()
+        lane.waiting += 1
+        try:
+            async with lane.queue:
+                while True:
+                    delay = lane.delay_for(tokens, time.monotonic())
+                    if delay <= 0:
+                        break
+                    lane.refunded.clear()
+                    try:
+                        await asyncio.wait_for(lane.refunded.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                lane.consume(tokens)
+        finally:
+            lane.waiting -= 1
+        return Reservation(lane, tokens, time.monotonic() - started)
+
+    def penalize(self, provider: str, api_key: str, model: str, seconds: float):
+        """服务端返回429后，同一额度下排队的请求一起等待seconds秒"""
+        lane = self._lane(provider, api_key, model)
+        if lane is None:
+            return
+        now = time.monotonic()
+        for bucket in (lane.requests, lane.tokens):
+            if bucket:
+                bucket.drain(seconds, now)
+
+    def observe(self, provider: str, api_key: str, model: str, headers: Mapping[str, str]):
+        """根据响应头中的实际限额和剩余额度校正本地令牌桶"""
+        lane = self._lane(provider, api_key, model)
+        if lane is None or not headers:
+            return
+        now = time.monotonic()
+        for kind, bucket in (("requests", lane.requests), ("tokens", lane.tokens)):
+            if bucket is None:
+                continue
+            limit = _header_int(headers, _LIMIT_HEADERS[kind])
+            if limit:
+                bucket.resize(limit)
+            remaining = _header_int(headers, _REMAINING_HEADERS[kind])
+            if remaining is not None:
+                bucket.clamp(remaining, now)
+
+
+_shared_limiter = None
+_shared_limiter_lock = threading.Lock()
+
+
+def get_shared_limiter() -> RateLimiter:
+    """获取进程内共享的限流器"""
+    global _shared_limiter
+    if _shared_limiter is None:
+        with _shared_limiter_lock:
+            if _shared_limiter is None:
+                _shared_limiter = RateLimiter()
+    return _shared_limiter
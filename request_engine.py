@@ -0,0 +1,144 @@
+import abc
+import asyncio
+import concurrent.futures
+import threading
+from typing import Awaitable, Optional
+
+from PySide6.QtCore import QObject, Signal
+
+
+class RequestEngine:
+    """运行在单个后台线程上的asyncio事件循环
+
+    所有对话请求、流式响应和后台任务（滚动摘要、密钥测试）都作为协程在这里并发执行，
+    不再为每次请求创建线程。任务通过AsyncJob的Qt信号把结果送回界面线程。
+    """
+
+    def __init__(self, name: str = "request-engine"):
+        self.name = name
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        self._ensure_started()
+        return self._loop
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            ready = threading.Event()
+
+            def run():
+                self._loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(self._loop)
+                ready.set()
+                self._loop.run_forever()
+                self._loop.run_until_complete(self._loop.shutdown_asyncgens())
+                self._loop.close()
+
+            self._thread = threading.Thread(target=run, name=self.name, daemon=True)
+            self._thread.start()
+            ready.wait()
+
+    def submit(self, coro: Awaitable) -> concurrent.futures.Future:
+        """在引擎线程中调度协程，可在任意线程调用"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stop(self, timeout: float = 5.0, before_close: Optional[Awaitable] = None):
+        """取消仍在运行的任务并停止事件循环；before_close在循环停止前执行（如关闭异步客户端）"""
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._thread = None
+        if thread is None or not thread.is_alive():
+            if before_close is not None:
+                before_close.close()
+            return
+
+        async def shutdown():
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if before_close is not None:
+                await before_close
+
+        try:
+            asyncio.run_coroutine_threadsafe(shutdown(), loop).result(timeout)
+        except (concurrent.futures.TimeoutError, RuntimeError):
+            pass
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout)
+
+
+_shared_engine = None
+_shared_engine_lock = threading.Lock()
+
+
+def get_engine() -> RequestEngine:
+    """获取进程内共享的请求引擎"""
+    global _shared_engine
+    if _shared_engine is None:
+        with _shared_engine_lock:
+            if _shared_engine is None:
+                _shared_engine = RequestEngine()
+    return _shared_engine
+
+
+class _AsyncJobMeta(abc.ABCMeta, type(QObject)):
+    """QObject与abc兼容的元类；shiboken创建对象时不经过object.__new__的抽象方法检查，在这里补上"""
+
+    def __call__(cls, *args, **kwargs):
+        if cls.__abstractmethods__:
+            raise TypeError(f"Can't instantiate abstract class {cls.__name__} with abstract methods "
+                            + ", ".join(sorted(cls.__abstractmethods__)))
+        return super().__call__(*args, **kwargs)
+
+
+class AsyncJob(QObject, metaclass=_AsyncJobMeta):
+    """在请求引擎上运行的任务（抽象类）
+
+    子类必须实现协程run()，否则创建时即抛出TypeError；在run()中发射的信号由Qt自动排队投递到
+    界面线程的接收者，接收者无需关心任务运行在哪个线程。
+    """
+    finished = Signal()
+
+    def __init__(self, engine: Optional[RequestEngine] = None):
+        super().__init__()
+        self.engine = engine or get_engine()
+        self.future: Optional[concurrent.futures.Future] = None
+
+    @abc.abstractmethod
+    async def run(self):
+        """任务主体"""
+
+    async def _run(self):
+        try:
+            await self.run()
+        finally:
+            self.finished.emit()
+
+    def start(self):
+        self.future = self.engine.submit(self._run())
+
+    def cancel(self):
+        """取消任务：协程在当前的await处收到CancelledError，可在其中完成收尾"""
+        if self.future is not None:
+            self.future.cancel()
+
+    def isRunning(self) -> bool:
+        return self.future is not None and not self.future.done()
+
+    def wait(self, msecs: int = -1) -> bool:
+        """等待任务结束，与QThread.wait的用法一致"""
+        if self.future is None:
+            return True
+        try:
+            self.future.result(None if msecs < 0 else msecs / 1000)
+        except concurrent.futures.TimeoutError:
+            return False
+        except BaseException:
+            pass
+        return True
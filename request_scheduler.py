@@ -0,0 +1,100 @@
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+from PySide6.QtCore import QObject, Signal
+
+from .http_pool import endpoint_key
+from .request_engine import AsyncJob
+
+
+class RequestScheduler(QObject):
+    """按话题跟踪进行中的对话请求
+
+    每个话题同时最多一个请求，不同话题的请求并发执行。同时进行的请求总数和同一端点的请求数
+    各有上限，超出的请求按提交顺序排队，有请求结束时依次启动。只在界面线程中使用。
+    """
+    queued = Signal(str)  # 话题ID：请求进入队列等待并发名额
+    started = Signal(str)  # 话题ID：请求开始执行
+    finished = Signal(str)  # 话题ID：请求结束（完成、失败、取消或在队列中被移除）
+
+    def __init__(self, max_concurrent: int = 4, max_per_endpoint: int = 2, parent: Optional[QObject] = None):
+        super().__init__(parent)
+        self.max_concurrent = max_concurrent
+        self.max_per_endpoint = max_per_endpoint
+        self._running: Dict[str, AsyncJob] = {}
+        self._waiting: Deque[str] = deque()
+        self._jobs: Dict[str, AsyncJob] = {}
+
+    def set_limits(self, max_concurrent: int, max_per_endpoint: int):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_per_endpoint = max(1, max_per_endpoint)
+        self._dispatch()
+
+    def submit(self, topic_id: str, job: AsyncJob) -> bool:
+        """提交话题的请求；该话题已有请求时返回False。job需有base_url属性，用于按端点限制并发"""
+        if topic_id in self._jobs:
+            return False
+        self._jobs[topic_id] = job
+        # 连接到本对象的方法，引擎线程发出的finished排队到界面线程处理
+        job.finished.connect(self._on_finished)
+        self._waiting.append(topic_id)
+        self._dispatch()
+        if topic_id in self._waiting:
+            self.queued.emit(topic_id)
+        return True
+
+    def job(self, topic_id: Optional[str]) -> Optional[AsyncJob]:
+        return self._jobs.get(topic_id) if topic_id else None
+
+    def is_busy(self, topic_id: Optional[str]) -> bool:
+        return bool(topic_id) and topic_id in self._jobs
+
+    def is_queued(self, topic_id: Optional[str]) -> bool:
+        return bool(topic_id) and topic_id in self._waiting
+
+    def active_topics(self) -> List[str]:
+        """有请求进行中或排队中的话题"""
+        return list(self._jobs)
+
+    def cancel(self, topic_id: str) -> bool:
+        """停止话题的请求：执行中的请求收到取消，排队中的直接移出队列"""
+        job = self._jobs.get(topic_id)
+        if job is None:
+            return False
+        if topic_id in self._waiting:
+            self._waiting.remove(topic_id)
+            del self._jobs[topic_id]
+            self.finished.emit(topic_id)
+        else:
+            job.cancel()
+        return True
+
+    def cancel_all(self):
+        for topic_id in list(self._jobs):
+            self.cancel(topic_id)
+
+    def _endpoint_load(self, key: str) -> int:
+        return sum(1 for job in self._running.values() if endpoint_key(job.base_url) == key)
+
+    def _dispatch(self):
+        """在并发上限内按排队顺序启动请求；某个端点已满时跳过它，不阻塞其他端点的请求"""
+        for topic_id in list(self._waiting):
+            if len(self._running) >= self.max_concurrent:
+                break
+            job = self._jobs[topic_id]
+            if self._endpoint_load(endpoint_key(job.base_url)) >= self.max_per_endpoint:
+                continue
+            self._waiting.remove(topic_id)
+            self._running[topic_id] = job
+            job.start()
+            self.started.emit(topic_id)
+
+    def _on_finished(self):
+        job = self.sender()
+        topic_id = next((t for t, running in self._running.items() if running is job), None)
+        if topic_id is None:
+            return
+        del self._running[topic_id]
+        del self._jobs[topic_id]
+        self.finished.emit(topic_id)
+        self._dispatch()
@@ -0,0 +1,101 @@
+import asyncio
+import random
+import time
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import List, Optional
+
+import httpx
+
+# 可以重试的HTTP状态码：超时、冲突、限流、服务端错误和过载（Anthropic的529）
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+
+
+def retry_after_seconds(exc: BaseException) -> Optional[float]:
+    """从错误响应的Retry-After（秒数或HTTP日期）或retry-after-ms头中读取建议的等待时间"""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return max(float(value) / 1000, 0.0)
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_transient(exc: BaseException) -> bool:
+    """限流、服务端错误、连接中断和超时视为暂时性错误"""
+    status = getattr(exc, "status_code", None)
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUS
+    # SDK把底层的网络错误包装为APIConnectionError/APITimeoutError，沿异常链查找
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        if isinstance(exc, (httpx.TransportError, ConnectionError, TimeoutError, asyncio.TimeoutError)):
+            return True
+        if type(exc).__name__ in ("APIConnectionError", "APITimeoutError"):
+            return True
+        exc = exc.__cause__ or exc.__context__
+    return False
+
+
+@dataclass
+class RetryPolicy:
+    """带抖动的指数退避
+
+    第n次重试前等待 min(max_delay, base_delay * 2^n) 的一半到全部之间的随机时间，
+    多个客户端同时被限流时不会同步重试。服务端给出Retry-After时按其等待，
+    超过max_retry_after则不再重试。
+    """
+    max_retries: int = 4
+    base_delay: float = 1.0
+    max_delay: float = 30.0
+    max_retry_after: float = 120.0
+
+    def next_delay(self, attempt: int, exc: BaseException) -> Optional[float]:
+        """第attempt次重试（从0开始）前应等待的秒数；不应重试时返回None"""
+        if attempt >= self.max_retries or not is_transient(exc):
+            return None
+        retry_after = retry_after_seconds(exc)
+        if retry_after is not None:
+            if retry_after > self.max_retry_after:
+                return None
+            # 在服务端要求的时间之后再加少量抖动
+            return retry_after + random.uniform(0, self.base_delay / 2)
+        cap = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return cap / 2 + random.uniform(0, cap / 2)
+
+
+def describe_error(exc: BaseException) -> str:
+    status = getattr(exc, "status_code", None)
+    return f"HTTP {status}" if status else type(exc).__name__
+
+
+# DeepSeek的对话前缀续写需要使用beta地址
+DEEPSEEK_BETA_PATH = "/beta"
+
+
+def deepseek_beta_url(base_url: str) -> str:
+    base_url = base_url.rstrip("/")
+    if base_url.endswith("/v1"):
+        base_url = base_url[:-3]
+    return base_url if base_url.endswith(DEEPSEEK_BETA_PATH) else base_url + DEEPSEEK_BETA_PATH
+
+
+def continuation_messages(messages: List[dict], partial: str) -> List[dict]:
+    """把中断前已收到的回答作为assistant前缀，让模型从断点继续生成（DeepSeek对话前缀续写）"""
+    return messages + [{"role": "assistant", "content": partial, "prefix": True}]
@@ -0,0 +1,204 @@
+import asyncio
+import hashlib
+from dataclasses import dataclass, asdict
+from typing import Dict, List, Optional
+
+from PySide6.QtCore import Signal
+
+from .rate_limiter import get_shared_limiter
+from .request_engine import AsyncJob
+from .retry_policy import RetryPolicy
+
+SUMMARY_PROMPT = (
+    "你负责维护一段对话的滚动摘要。请把“新增对话”整合进“已有摘要”，输出新的完整摘要。\n"
+    "要求：保留关键事实、用户的目标与偏好、已做出的决定、涉及的代码/文件/命令名称和尚未解决的问题；"
+    "删除寒暄和重复内容；使用简洁的要点列表，不超过{max_chars}字；只输出摘要本身。"
+)
+
+SUMMARY_MESSAGE_PREFIX = "以下是本话题较早对话的摘要，供参考：\n"
+
+
+def _feed(digest, message: dict):
+    digest.update(message.get("role", "").encode("utf-8"))
+    digest.update(b"\x00")
+    digest.update(message.get("content", "").encode("utf-8", "surrogatepass"))
+    digest.update(b"\x01")
+
+
+def fingerprint(messages: List[dict]) -> str:
+    """消息序列的指纹；消息被删除、重试或修改后指纹不同，对应不同的对话分支"""
+    digest = hashlib.blake2b(digest_size=16)
+    for message in messages:
+        _feed(digest, message)
+    return digest.hexdigest()
+
+
+@dataclass
+class SummaryState:
+    """话题前covered条消息的摘要"""
+    covered: int
+    fingerprint: str
+    summary: str
+    model: str = ""
+
+    def to_message(self) -> dict:
+        return {"role": "system", "content": SUMMARY_MESSAGE_PREFIX + self.summary}
+
+
+class RollingSummaryCache:
+    """按话题和分支缓存滚动摘要
+
+    最近keep_recent条消息始终原文发送；更早的消息每累积chunk条才增量合并进摘要一次，
+    摘要内容在两次合并之间保持不变。每个话题保留最近几个分支的摘要，切回旧分支时可直接复用。
+    """
+
+    MAX_BRANCHES = 3
+
+    def __init__(self, keep_recent: int = 10, chunk: int = 10):
+        self.keep_recent = keep_recent
+        self.chunk = chunk
+        self.states: Dict[str, List[SummaryState]] = {}
+        # 话题ID -> (累加中的哈希, [前0条、前1条……消息的指纹])；与话题Token索引一样只处理新追加的消息
+        self._prefixes: Dict[str, tuple] = {}
+
+    def prefix_fingerprint(self, topic_id: str, history: List[dict], count: int) -> str:
+        """history前count条消息的指纹，结果与fingerprint(history[:count])相同"""
+        entry = self._prefixes.get(topic_id)
+        if entry is None or len(entry[1]) - 1 > len(history):
+            # 首次访问或消息被删除时重建
+            digest = hashlib.blake2b(digest_size=16)
+            entry = self._prefixes[topic_id] = (digest, [digest.hexdigest()])
+        digest, digests = entry
+        for message in history[len(digests) - 1:]:
+            _feed(digest, message)
+            digests.append(digest.hexdigest())
+        return digests[count]
+
+    def lookup(self, topic_id: str, history: List[dict]) -> Optional[SummaryState]:
+        """返回与当前历史匹配（覆盖的消息未被改动）且覆盖最多的摘要"""
+        best = None
+        for state in self.states.get(topic_id, []):
+            if state.covered > len(history) or (best and state.covered <= best.covered):
+                continue
+            if self.prefix_fingerprint(topic_id, history, state.covered) == state.fingerprint:
+                best = state
+        return best
+
+    def pending_range(self, topic_id: str, history: List[dict]):
+        """需要合并进摘要的消息区间(start, end)，尚不需要刷新时返回None"""
+        target = len(history) - self.keep_recent
+        current = self.lookup(topic_id, history)
+        covered = current.covered if current else 0
+        if target - covered < self.chunk:
+            return None
+        # 按chunk的整数倍推进，摘要的覆盖边界稳定
+        end = covered + (target - covered) // self.chunk * self.chunk
+        return covered, end
+
+    def store(self, topic_id: str, state: SummaryState):
+        states = [s for s in self.states.get(topic_id, []) if s.fingerprint != state.fingerprint]
+        states.insert(0, state)
+        self.states[topic_id] = states[:self.MAX_BRANCHES]
+
+    def invalidate(self, topic_id: str = None):
+        if topic_id is None:
+            self.states.clear()
+        else:
+            self.states.pop(topic_id, None)
+        self.reset_history(topic_id)
+
+    def reset_history(self, topic_id: str = None):
+        """丢弃话题（或全部话题）的消息指纹，消息被原地修改或重新加载后调用"""
+        if topic_id is None:
+            self._prefixes.clear()
+        else:
+            self._prefixes.pop(topic_id, None)
+
+    def to_dict(self) -> dict:
+        return {topic: [asdict(s) for s in states] for topic, states in self.states.items()}
+
+    @classmethod
+    def from_dict(cls, data: dict, **kwargs) -> "RollingSummaryCache":
+        cache = cls(**kwargs)
+        for topic, states in (data or {}).items():
+            cache.states[topic] = [SummaryState(**s) for s in states]
+        return cache
+
+
+def build_summary_request(previous: Optional[SummaryState], messages: List[dict],
+                          max_chars: int = 800) -> List[dict]:
+    """构造摘要请求：已有摘要 + 新增对话"""
+    transcript = "\n\n".join(
+        f"{'用户' if m.get('role') == 'user' else 'AI'}: {m.get('content', '')}" for m in messages)
+    existing = previous.summary if previous else "（无）"
+    return [
+        {"role": "system", "content": SUMMARY_PROMPT.format(max_chars=max_chars)},
+        {"role": "user", "content": f"已有摘要：\n{existing}\n\n新增对话：\n{transcript}"}
+    ]
+
+
+class SummaryWorker(AsyncJob):
+    """在请求引擎上调用低成本模型，把一段较早的对话合并进话题摘要"""
+    summary_ready = Signal(str, dict, dict)  # 话题ID, SummaryState, 用量
+    error_occurred = Signal(str, str)  # 话题ID, 错误信息
+
+    def __init__(self, topic_id: str, history: List[dict], start: int, end: int,
+                 previous: Optional[SummaryState], api_key: str, base_url: str,
+                 model: str = "deepseek-chat", max_tokens: int = 1024, provider: str = "deepseek"):
+        super().__init__()
+        self.topic_id = topic_id
+        # 复制需要的消息，引擎线程不访问界面线程持有的对话列表
+        self.covered_messages = [{"role": m.get("role", ""), "content": m.get("content", "")}
+                                 for m in history[:end]]
+        self.start_index = start
+        self.previous = previous
+        self.api_key = api_key
+        self.base_url = base_url
+        self.model = model
+        self.max_tokens = max_tokens
+        self.provider = provider
+        # 摘要不急，少量重试即可，失败后下次对话结束时会再次尝试
+        self.retry_policy = RetryPolicy(max_retries=2)
+
+    async def run(self):
+        try:
+            from .http_pool import get_shared_pool
+            from .token_calculator import get_shared_calculator
+            client = get_shared_pool().async_client(self.base_url, self.api_key)
+            limiter = get_shared_limiter()
+            messages = build_summary_request(self.previous, self.covered_messages[self.start_index:])
+            # 与对话请求共用速率限制额度，额度不足时排队，不挤占前台请求的重试
+            estimated = get_shared_calculator().calculate_messages_tokens(messages) + self.max_tokens
+            attempt = 0
+            while True:
+                reservation = await limiter.acquire(self.provider, self.api_key, self.model, estimated)
+                try:
+                    response = await client.chat.completions.create(
+                        model=self.model,
+                        messages=messages,
+                        max_tokens=self.max_tokens,
+                        temperature=0.3,
+                        stream=False
+                    )
+                    break
+                except Exception as e:
+                    # 失败的请求没有产生用量，退还占用的速率限制额度
+                    reservation.settle(0)
+                    delay = self.retry_policy.next_delay(attempt, e)
+                    if delay is None:
+                        raise
+                    if getattr(e, "status_code", None) == 429:
+                        limiter.penalize(self.provider, self.api_key, self.model, delay)
+                    attempt += 1
+                    await asyncio.sleep(delay)
+            summary = (response.choices[0].message.content or "").strip()
+            if not summary:
+                raise ValueError("摘要为空")
+            state = SummaryState(covered=len(self.covered_messages),
+                                 fingerprint=fingerprint(self.covered_messages),
+                                 summary=summary, model=self.model)
+            usage = response.usage.model_dump() if getattr(response, "usage", None) else {}
+            reservation.settle(usage.get("total_tokens"))
+            self.summary_ready.emit(self.topic_id, asdict(state), usage)
+        except Exception as e:
+            self.error_occurred.emit(self.topic_id, str(e))
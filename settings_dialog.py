@@ -3,11 +3,9 @@ from PySide6.QtWidgets import (QDialog, QVBoxLayout, QTabWidget, QWidget, QGroup
                              QDoubleSpinBox, QSpinBox, QSlider, QHBoxLayout, QPushButton,
                              QMessageBox, QProgressDialog)
 from PySide6.QtCore import Qt
-from threading import Thread
-from queue import Queue
-from openai import OpenAI
 
 from .api_key_manager import DEFAULT_BASE_URL, DEFAULT_API_KEY
+from .api_key_test import APIKeyTestJob
 
 class ModernSettingsDialog(QDialog):
     """现代设置对话框"""
@@ -177,7 +175,7 @@ class ModernSettingsDialog(QDialog):
         self.enable_token_calc.setChecked(True)
         token_layout.addWidget(self.enable_token_calc)
         
-        token_info = QLabel("Token计算使用近似算法，用于估算API使用成本")
+        token_info = QLabel("Token计算优先使用离线BPE分词器精确计数，缺少词表时使用近似算法")
         token_info.setStyleSheet("color: #64748b; font-size: 12px;")
         token_layout.addWidget(token_info)
         
@@ -212,58 +210,31 @@ class ModernSettingsDialog(QDialog):
             QMessageBox.warning(self, "测试失败", "请输入API密钥进行测试")
             return
         
-        # 显示测试进度
-        progress_dialog = QProgressDialog("正在测试API密钥...", "取消", 0, 0, self)
-        progress_dialog.setWindowTitle("测试API密钥")
-        progress_dialog.setWindowModality(Qt.WindowModality.WindowModal)
-        progress_dialog.show()
-        
-        try:
-            # 使用线程测试API密钥
-            result_queue = Queue()
-            
-            def test_key():
-                try:
-                    client = OpenAI(api_key=api_key, base_url=self.base_url_edit.text() or DEFAULT_BASE_URL)
-                    response = client.chat.completions.create(
-                        model="deepseek-chat",
-                        messages=[{"role": "user", "content": "测试消息，请回复'连接成功'"}],
-                        max_tokens=10
-                    )
-                    result_queue.put(("success", response.choices[0].message.content))
-                except Exception as e:
-                    result_queue.put(("error", str(e)))
-            
-            thread = Thread(target=test_key)
-            thread.daemon = True
-            thread.start()
-            
-            # 等待结果
-            thread.join(timeout=10)
-            
-            if thread.is_alive():
-                progress_dialog.close()
-                QMessageBox.warning(self, "测试超时", "API测试超时，请检查网络连接")
-                return
-            
-            progress_dialog.close()
-            
-            if not result_queue.empty():
-                result_type, result_data = result_queue.get()
-                if result_type == "success":
-                    QMessageBox.information(self, "测试成功", f"API密钥有效！\n\nAI回复: {result_data}")
-                    self.key_status_label.setText("✅ 密钥测试通过（有效）")
-                    self.key_status_label.setStyleSheet("color: #10b981; font-weight: bold;")
-                else:
-                    QMessageBox.critical(self, "测试失败", f"API密钥无效或网络错误:\n\n{result_data}")
-                    self.key_status_label.setText("❌ 密钥测试失败")
-                    self.key_status_label.setStyleSheet("color: #ef4444; font-weight: bold;")
-            else:
-                QMessageBox.warning(self, "测试失败", "无法获取测试结果")
-                
-        except Exception as e:
-            progress_dialog.close()
-            QMessageBox.critical(self, "测试错误", f"测试过程中发生错误:\n\n{str(e)}")
+        # 在请求引擎上测试，结果经信号送回，等待期间界面保持响应，可随时取消
+        self.key_test_job = APIKeyTestJob(api_key, self.base_url_edit.text() or DEFAULT_BASE_URL)
+        self.key_test_progress = QProgressDialog("正在测试API密钥...", "取消", 0, 0, self)
+        self.key_test_progress.setWindowTitle("测试API密钥")
+        self.key_test_progress.setWindowModality(Qt.WindowModality.WindowModal)
+        self.key_test_progress.canceled.connect(self.key_test_job.cancel)
+        self.key_test_job.result_ready.connect(self.handle_key_test_result)
+        self.key_test_job.finished.connect(self.key_test_progress.reset)
+        self.test_key_btn.setEnabled(False)
+        self.key_test_job.finished.connect(lambda: self.test_key_btn.setEnabled(True))
+        self.key_test_progress.show()
+        self.key_test_job.start()
+    
+    def handle_key_test_result(self, result_type, result_data):
+        """显示API密钥测试结果"""
+        if result_type == "success":
+            QMessageBox.information(self, "测试成功", f"API密钥有效！\n\nAI回复: {result_data}")
+            self.key_status_label.setText("✅ 密钥测试通过（有效）")
+            self.key_status_label.setStyleSheet("color: #10b981; font-weight: bold;")
+        elif result_type == "timeout":
+            QMessageBox.warning(self, "测试超时", "API测试超时，请检查网络连接")
+        else:
+            QMessageBox.critical(self, "测试失败", f"API密钥无效或网络错误:\n\n{result_data}")
+            self.key_status_label.setText("❌ 密钥测试失败")
+            self.key_status_label.setStyleSheet("color: #ef4444; font-weight: bold;")
     
     def clear_api_key(self):
         """清除API密钥"""
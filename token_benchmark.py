@@ -0,0 +1,125 @@
+"""
+Token计数基准测试 - 对比离线BPE分词器与近似算法的准确度和速度
+
+用法: python -m src.token_benchmark [--tokenizer tokenizer.json] [--repeat 20] [--batch 100000]
+"""
+
+import argparse
+import random
+import time
+
+from .bpe_tokenizer import BPETokenizer, load_default_tokenizer
+from .token_calculator import TokenCalculator, np
+
+# 覆盖常见对话内容的样本：中文、英文、代码、Markdown、日志和JSON
+SAMPLE_TEXTS = [
+    "你好，请帮我解释一下什么是Transformer模型中的注意力机制，并举一个简单的例子。",
+    "深度学习模型的训练通常需要大量的数据和计算资源。为了降低成本，可以使用混合精度训练、梯度累积以及模型蒸馏等技术。",
+    "The quick brown fox jumps over the lazy dog. Tokenizers split text into sub-word units "
+    "so that rare words can still be represented by a small, fixed vocabulary.",
+    "Please summarize the following paragraph in three bullet points and keep the original terminology.",
+    "def fibonacci(n: int) -> int:\n    if n < 2:\n        return n\n    return fibonacci(n - 1) + fibonacci(n - 2)\n",
+    "for (let i = 0; i < items.length; i++) {\n  console.log(`item ${i}: ${items[i].name}`);\n}\n",
+    "## 安装步骤\n\n1. 克隆仓库 `git clone https://github.com/example/repo.git`\n2. 安装依赖 `pip install -r requirements.txt`\n3. 运行 `python main.py`\n",
+    "| 模型 | 上下文长度 | 价格 |\n|------|-----------|------|\n| deepseek-chat | 64K | ¥2/M |\n| deepseek-reasoner | 64K | ¥4/M |\n",
+    "2024-05-01 12:00:01,234 ERROR [worker-3] Connection reset by peer (errno=104) while reading response body\n"
+    "2024-05-01 12:00:02,567 WARN  [worker-3] retrying request id=8f3a2c attempt=2/5\n",
+    '{"id": "chatcmpl-123", "object": "chat.completion", "usage": {"prompt_tokens": 56, "completion_tokens": 31}}',
+    "混合内容 mixed content：使用 asyncio.gather() 并发请求 3 个模型，然后比较 TTFT（首token延迟）和 tokens/sec。",
+    "数字和符号测试：3.1415926535, 1,000,000, 2^10 = 1024, 100% ✓ → ✗ 😀",
+]
+
+
+def benchmark_accuracy(tokenizer, texts):
+    """以BPE分词结果为准，统计近似算法的误差"""
+    calculator = TokenCalculator(tokenizer)
+    rows = []
+    for text in texts:
+        exact = tokenizer.count_tokens(text)
+        estimate = calculator.estimate_tokens(text)
+        error = (estimate - exact) / exact if exact else 0.0
+        rows.append((text, exact, estimate, error))
+    return rows
+
+
+def benchmark_speed(count_fn, texts, repeat):
+    """测量计数函数的吞吐量（字符/秒）"""
+    total_chars = sum(len(t) for t in texts) * repeat
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text in texts:
+            count_fn(text)
+    elapsed = time.perf_counter() - start
+    return total_chars / elapsed if elapsed > 0 else float("inf"), elapsed
+
+
+def make_messages(count, seed=0):
+    """由样本随机拼接生成模拟对话消息，长度从一句到十几句不等"""
+    rng = random.Random(seed)
+    return ["\n".join(rng.choices(SAMPLE_TEXTS, k=rng.randint(1, 12))) for _ in range(count)]
+
+
+def benchmark_batch(calculator, messages):
+    """对比逐条估算与向量化批量估算，返回(逐条耗时, 批量耗时, 结果是否一致)"""
+    start = time.perf_counter()
+    expected = [calculator.estimate_tokens(m) for m in messages]
+    loop_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = calculator.estimate_tokens_batch(messages)
+    batch_elapsed = time.perf_counter() - start
+    return loop_elapsed, batch_elapsed, actual == expected
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Token计数准确度与速度基准测试")
+    parser.add_argument("--tokenizer", help="tokenizer.json路径（默认使用随程序打包的词表）")
+    parser.add_argument("--repeat", type=int, default=20, help="速度测试重复次数")
+    parser.add_argument("--batch", type=int, default=100000, help="批量估算测试的消息条数（0为跳过）")
+    args = parser.parse_args()
+
+    if args.tokenizer:
+        tokenizer = BPETokenizer.from_tokenizer_json(args.tokenizer)
+    else:
+        tokenizer = load_default_tokenizer()
+
+    calculator = TokenCalculator(tokenizer)
+    # 大文本用于速度测试，避免单条样本过短时测量噪声过大
+    texts = SAMPLE_TEXTS + ["\n".join(SAMPLE_TEXTS) * 50]
+
+    if tokenizer is None:
+        print("未找到离线词表（运行 python -m src.fetch_tokenizer 获取），仅测试近似算法速度")
+    else:
+        if not tokenizer.exact_pretokenizer:
+            print("提示: 未安装regex库，预分词使用标准库近似规则")
+        print(f"{'精确':>8} {'估算':>8} {'误差':>8}  样本")
+        rows = benchmark_accuracy(tokenizer, SAMPLE_TEXTS)
+        for text, exact, estimate, error in rows:
+            preview = text.replace("\n", " ")[:40]
+            print(f"{exact:>8} {estimate:>8} {error:>+8.1%}  {preview}")
+        errors = [abs(r[3]) for r in rows]
+        print(f"平均绝对误差: {sum(errors) / len(errors):.1%}，最大误差: {max(errors):.1%}")
+
+        # 清空缓存后测量冷启动的BPE速度
+        tokenizer.cache.clear()
+        speed, elapsed = benchmark_speed(tokenizer.count_tokens, texts, 1)
+        print(f"BPE（冷缓存）: {speed / 1e6:.2f} M字符/秒 ({elapsed * 1000:.1f} ms)")
+        speed, elapsed = benchmark_speed(tokenizer.count_tokens, texts, args.repeat)
+        print(f"BPE（热缓存）: {speed / 1e6:.2f} M字符/秒 ({elapsed * 1000:.1f} ms)")
+
+    speed, elapsed = benchmark_speed(calculator.estimate_tokens, texts, args.repeat)
+    print(f"近似算法: {speed / 1e6:.2f} M字符/秒 ({elapsed * 1000:.1f} ms)")
+
+    if args.batch > 0:
+        messages = make_messages(args.batch)
+        if np is None:
+            print("提示: 未安装NumPy，批量估算回退为逐条计算")
+        loop_elapsed, batch_elapsed, consistent = benchmark_batch(calculator, messages)
+        chars = sum(len(m) for m in messages)
+        print(f"批量估算（{len(messages)}条消息，{chars / 1e6:.1f} M字符）: "
+              f"逐条 {loop_elapsed * 1000:.0f} ms，批量 {batch_elapsed * 1000:.0f} ms，"
+              f"加速 {loop_elapsed / batch_elapsed:.1f}x，结果{'一致' if consistent else '不一致'}")
+
+
+if __name__ == "__main__":
+    main()
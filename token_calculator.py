@@ -1,36 +1,240 @@
 import re
+import sys
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from .bpe_tokenizer import default_tokenizer_error, load_default_tokenizer
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# OrderedDict节点和值元组的大致额外开销（字节）
+_ENTRY_OVERHEAD = 160
+
+# 批量估算时每批处理的最大码点数，限制临时数组的内存占用
+_BATCH_CODE_POINTS = 8 * 1024 * 1024
+
+_CHINESE_PATTERN = re.compile(r'[\u4e00-\u9fff]')
+_ENGLISH_WORD_PATTERN = re.compile(r'[a-zA-Z]+')
+
+_weight_table = None
+_letter_table = None
+_heuristic_warned = False
+
+def _classification_tables():
+    """BMP码点查找表：字符权重（以0.1 token为单位）和是否为英文字母；BMP以外的码点映射到0xFFFF（其他字符）"""
+    global _weight_table, _letter_table
+    if _weight_table is None:
+        weights = np.full(0x10000, 8, dtype=np.uint8)
+        weights[0x4e00:0xa000] = 25
+        letters = np.zeros(0x10000, dtype=bool)
+        letters[ord('A'):ord('Z') + 1] = True
+        letters[ord('a'):ord('z') + 1] = True
+        weights[letters] = 0
+        _weight_table, _letter_table = weights, letters
+    return _weight_table, _letter_table
+
+class TokenCache:
+    """按内容哈希索引、按字节预算淘汰的LRU缓存（线程安全）"""
+    
+    def __init__(self, max_bytes=4 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # 哈希 -> (token数, 占用字节)
+        self._lock = threading.Lock()
+        
+    @staticmethod
+    def make_key(text):
+        """计算文本的内容哈希，缓存中不保留原文"""
+        return hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+    
+    def get(self, text):
+        """查询缓存，命中时移动到最近使用位置"""
+        key = self.make_key(text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+    
+    def put(self, text, tokens):
+        """写入缓存，超出字节预算时淘汰最久未使用的条目"""
+        key = self.make_key(text)
+        size = sys.getsizeof(key) + sys.getsizeof(tokens) + _ENTRY_OVERHEAD
+        
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+            
+            self._entries[key] = (tokens, size)
+            self.current_bytes += size
+            
+            while self.current_bytes > self.max_bytes and self._entries:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+    
+    def clear(self):
+        """清空缓存（保留统计计数）"""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+    
+    def stats(self):
+        """返回缓存统计信息，用于调整缓存大小"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+    
+    def __len__(self):
+        return len(self._entries)
+
+def _warn_heuristic():
+    """没有离线词表时提示一次，避免打包遗漏词表而不自知"""
+    global _heuristic_warned
+    if not _heuristic_warned:
+        _heuristic_warned = True
+        print(f"未加载离线BPE词表（{default_tokenizer_error() or '未知原因'}），Token数使用近似算法估算；"
+              f"打包前请运行 python -m src.fetch_tokenizer")
 
 class TokenCalculator:
-    """Token计算器 - 使用近似算法"""
+    """Token计算器 - 优先使用离线BPE分词器，词表缺失时回退到近似算法
     
-    def __init__(self):
-        self.token_cache = {}
+    界面、工作线程和后台任务应通过get_shared_calculator()共用同一实例和缓存。
+    """
+    
+    def __init__(self, tokenizer=None, cache_bytes=4 * 1024 * 1024):
+        self.token_cache = TokenCache(cache_bytes)
+        self.tokenizer = tokenizer if tokenizer is not None else load_default_tokenizer()
+        if self.tokenizer is None:
+            _warn_heuristic()
+        
+    @property
+    def is_exact(self):
+        """是否使用精确分词器计算"""
+        return self.tokenizer is not None
         
     def calculate_tokens(self, text):
-        """计算文本的token数量（近似值）"""
+        """计算文本的token数量（有词表时为精确值，否则为近似值）"""
         if not text:
             return 0
             
         # 使用缓存
-        if text in self.token_cache:
-            return self.token_cache[text]
+        cached = self.token_cache.get(text)
+        if cached is not None:
+            return cached
+        
+        if self.tokenizer is not None:
+            tokens = self.tokenizer.count_tokens(text)
+        else:
+            tokens = self.estimate_tokens(text)
         
+        self.token_cache.put(text, tokens)
+        return tokens
+    
+    def estimate_tokens(self, text):
+        """近似估算token数量（不使用词表）"""
+        if not text:
+            return 0
+        return self.estimate_weight(text) // 10
+    
+    def estimate_weight(self, text):
+        """近似算法的权重（以0.1 token为单位的整数），可在不切断英文单词的位置分段累加"""
         # 近似算法：对于中文，一个汉字约2-3个token，英文单词约1.3个token
-        chinese_chars = len(re.findall(r'[\u4e00-\u9fff]', text))
-        english_words = len(re.findall(r'[a-zA-Z]+', text))
-        other_chars = len(text) - chinese_chars - sum(len(word) for word in re.findall(r'[a-zA-Z]+', text))
+        chinese_chars = len(_CHINESE_PATTERN.findall(text))
+        words = _ENGLISH_WORD_PATTERN.findall(text)
+        english_words = len(words)
+        other_chars = len(text) - chinese_chars - sum(len(word) for word in words)
         
         # 近似计算
-        tokens = chinese_chars * 2.5 + english_words * 1.3 + other_chars * 0.8
-        tokens = int(tokens)
+        return chinese_chars * 25 + english_words * 13 + other_chars * 8
+    
+    def estimate_tokens_batch(self, texts):
+        """批量近似估算，结果与逐条调用estimate_tokens一致
         
-        self.token_cache[text] = tokens
-        return tokens
+        安装了NumPy时把所有文本拼接为一个码点数组，一次向量化分类
+        （汉字、英文字母、单词起点、其他字符）后按文本边界求和；否则逐条计算。
+        """
+        texts = [text or "" for text in texts]
+        if np is None:
+            return [self.estimate_tokens(text) for text in texts]
+        
+        lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+        ends = np.cumsum(lengths)
+        weights = np.zeros(len(texts), dtype=np.int64)
+        start = 0
+        while start < len(texts):
+            # 按码点数分批，单条超长文本单独成批
+            offset = ends[start - 1] if start else 0
+            stop = max(int(np.searchsorted(ends, offset + _BATCH_CODE_POINTS, side='right')), start + 1)
+            weights[start:stop] = self._estimate_weights_vectorized(texts[start:stop], lengths[start:stop])
+            start = stop
+        return (weights // 10).tolist()
+    
+    def _estimate_weights_vectorized(self, texts, lengths):
+        """对一批文本做一次向量化分类，返回每条文本的权重"""
+        weights = np.zeros(len(texts), dtype=np.int64)
+        nonempty = np.flatnonzero(lengths)
+        if not nonempty.size:
+            return weights
+        starts = (np.cumsum(lengths) - lengths)[nonempty]
+        
+        code_points = np.frombuffer("".join(texts).encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+        index = np.minimum(code_points, 0xFFFF).astype(np.uint16)
+        
+        weight_table, letter_table = _classification_tables()
+        char_weights = weight_table[index]
+        is_letter = letter_table[index]
+        
+        # 单词起点：当前是字母且前一个码点不是字母（每条文本开头视为边界）
+        word_start = is_letter.copy()
+        word_start[1:] &= ~is_letter[:-1]
+        word_start[starts] = is_letter[starts]
+        char_weights += word_start.view(np.uint8) * np.uint8(13)
+        
+        # 空文本不占码点，只对非空文本按起点分段求和
+        weights[nonempty] = np.add.reduceat(char_weights, starts, dtype=np.int64)
+        return weights
+    
+    def calculate_tokens_batch(self, texts):
+        """批量计算token数量，有词表时逐条精确计算，否则使用向量化估算"""
+        texts = list(texts)
+        if self.tokenizer is not None:
+            return [self.calculate_tokens(text) for text in texts]
+        return self.estimate_tokens_batch(texts)
+    
+    def create_stream_counter(self):
+        """创建流式增量token计数器"""
+        return StreamingTokenCounter(self)
     
     def calculate_messages_tokens(self, messages):
         """计算消息列表的总token数"""
         total_tokens = 0
         for message in messages:
+            # 已缓存token数的消息（见TopicTokenIndex）无需重新计算
+            if 'token_count' in message and message.get('token_count_exact') == self.is_exact:
+                total_tokens += message['token_count']
+                continue
+            
             content = message.get('content', '')
             total_tokens += self.calculate_tokens(content)
             
@@ -38,4 +242,74 @@ class TokenCalculator:
             role = message.get('role', '')
             total_tokens += self.calculate_tokens(role)
             
-        return total_tokens
\ No newline at end of file
+        return total_tokens
+
+_shared_calculator = None
+_shared_calculator_lock = threading.Lock()
+
+def get_shared_calculator():
+    """获取进程内共享的Token计算器，缓存跨请求保持预热"""
+    global _shared_calculator
+    if _shared_calculator is None:
+        with _shared_calculator_lock:
+            if _shared_calculator is None:
+                _shared_calculator = TokenCalculator()
+    return _shared_calculator
+
+class StreamingTokenCounter:
+    """流式响应的增量token计数器
+    
+    每个通道（正文、思考过程）保留最后一个可能被后续数据块延长的片段，
+    只对已确定边界的部分计数，因此数据块在token中间切断时结果与整体计算一致。
+    """
+    
+    def __init__(self, calculator):
+        self.calculator = calculator
+        self.tokenizer = calculator.tokenizer
+        self.committed = {}  # 通道 -> 已确定的token数（近似模式下为权重）
+        self.pending = {}  # 通道 -> 尚未确定边界的尾部文本
+        self.first_chunk_time = None
+        self.last_chunk_time = None
+        
+    def feed(self, text, channel="content"):
+        """输入一个数据块"""
+        if not text:
+            return
+        
+        now = time.monotonic()
+        if self.first_chunk_time is None:
+            self.first_chunk_time = now
+        self.last_chunk_time = now
+        
+        buffer = self.pending.get(channel, "") + text
+        if self.tokenizer is not None:
+            pieces = self.tokenizer.pretokenize(buffer)
+            done = self.tokenizer.count_pieces(pieces[:-1])
+            self.pending[channel] = pieces[-1] if pieces else ""
+        else:
+            # 在最后一个非字母字符之后切分，避免英文单词被拆成两段
+            match = re.search(r'[a-zA-Z]*$', buffer)
+            done = self.calculator.estimate_weight(buffer[:match.start()])
+            self.pending[channel] = buffer[match.start():]
+        self.committed[channel] = self.committed.get(channel, 0) + done
+        
+    def channel_tokens(self, channel="content"):
+        """单个通道当前的token数"""
+        pending = self.pending.get(channel, "")
+        if self.tokenizer is not None:
+            return self.committed.get(channel, 0) + self.tokenizer.count_pieces([pending] if pending else [])
+        return (self.committed.get(channel, 0) + self.calculator.estimate_weight(pending)) // 10
+    
+    @property
+    def tokens(self):
+        """所有通道当前的token总数"""
+        channels = set(self.committed) | set(self.pending)
+        return sum(self.channel_tokens(channel) for channel in channels)
+    
+    @property
+    def tokens_per_second(self):
+        """从首个数据块开始计算的输出速度"""
+        if self.first_chunk_time is None:
+            return 0.0
+        elapsed = time.monotonic() - self.first_chunk_time
+        return self.tokens / elapsed if elapsed > 0 else 0.0
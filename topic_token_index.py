@@ -0,0 +1,64 @@
+from bisect import bisect_left
+from typing import Dict, List
+
+
+class TopicTokenIndex:
+    """话题消息token数的前缀和索引
+
+    每条消息的token数只计算一次并保存在消息的token_count字段中（随对话一起持久化），
+    每个话题维护前缀和数组，区间求和为O(1)，“最近多少条消息能放进N个token”为O(log n)。
+    """
+
+    def __init__(self, calculator):
+        self.calculator = calculator
+        self.prefix: Dict[str, List[int]] = {}  # 话题ID -> [0, s1, s2, ...]
+
+    def message_tokens(self, message: dict) -> int:
+        """获取消息的token数（内容 + 角色），首次访问时计算并写回消息"""
+        exact = self.calculator.is_exact
+        if "token_count" in message and message.get("token_count_exact") == exact:
+            return message["token_count"]
+
+        tokens = (self.calculator.calculate_tokens(message.get("content", ""))
+                  + self.calculator.calculate_tokens(message.get("role", "")))
+        message["token_count"] = tokens
+        message["token_count_exact"] = exact
+        return tokens
+
+    def sync(self, topic_id: str, messages: List[dict]) -> List[int]:
+        """使前缀和与消息列表同步，只处理新追加的消息"""
+        prefix = self.prefix.get(topic_id)
+        if prefix is None or len(prefix) - 1 > len(messages):
+            # 首次访问或消息被删除时重建
+            prefix = [0]
+            self.prefix[topic_id] = prefix
+
+        for message in messages[len(prefix) - 1:]:
+            prefix.append(prefix[-1] + self.message_tokens(message))
+        return prefix
+
+    def invalidate(self, topic_id: str = None):
+        """丢弃话题（或全部话题）的前缀和，下次访问时重建"""
+        if topic_id is None:
+            self.prefix.clear()
+        else:
+            self.prefix.pop(topic_id, None)
+
+    def total_tokens(self, topic_id: str, messages: List[dict]) -> int:
+        """话题全部消息的token总数"""
+        return self.sync(topic_id, messages)[-1]
+
+    def range_tokens(self, topic_id: str, messages: List[dict], start: int, end: int = None) -> int:
+        """消息区间[start, end)的token总数，支持负数下标"""
+        prefix = self.sync(topic_id, messages)
+        start, end, _ = slice(start, end).indices(len(messages))
+        return prefix[end] - prefix[start] if end > start else 0
+
+    def fit_latest(self, topic_id: str, messages: List[dict], budget: int) -> int:
+        """返回在budget个token内最多能容纳的最新消息条数"""
+        prefix = self.sync(topic_id, messages)
+        if budget <= 0:
+            return 0
+        # 找到最小的起点s，使prefix[-1] - prefix[s] <= budget
+        start = bisect_left(prefix, prefix[-1] - budget)
+        return len(messages) - start
@@ -0,0 +1,287 @@
+from dataclasses import dataclass, asdict
+from typing import Dict, List, Optional, Tuple
+
+
+def _field(obj, name, default=None):
+    """同时支持SDK对象和字典的字段读取"""
+    if obj is None:
+        return default
+    if isinstance(obj, dict):
+        return obj.get(name, default)
+    return getattr(obj, name, default)
+
+
+@dataclass
+class ServerUsage:
+    """服务端返回的真实用量"""
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    total_tokens: int = 0
+    prompt_cache_hit_tokens: int = 0
+    prompt_cache_miss_tokens: int = 0
+    reasoning_tokens: int = 0
+
+    @classmethod
+    def from_usage(cls, usage) -> Optional["ServerUsage"]:
+        """解析各提供商的usage字段，无法识别时返回None
+
+        支持OpenAI/DeepSeek（prompt_tokens、prompt_cache_hit_tokens、completion_tokens_details）、
+        Anthropic（input_tokens、cache_read_input_tokens）和Ollama（prompt_eval_count、eval_count）。
+        """
+        if usage is None:
+            return None
+
+        prompt = _field(usage, "prompt_tokens")
+        completion = _field(usage, "completion_tokens")
+        if prompt is None and completion is None:
+            # Anthropic
+            prompt = _field(usage, "input_tokens")
+            completion = _field(usage, "output_tokens")
+            cache_read = _field(usage, "cache_read_input_tokens") or 0
+            if prompt is not None and cache_read:
+                prompt += cache_read
+        if prompt is None and completion is None:
+            # Ollama
+            prompt = _field(usage, "prompt_eval_count")
+            completion = _field(usage, "eval_count")
+        if prompt is None and completion is None:
+            return None
+
+        prompt = prompt or 0
+        completion = completion or 0
+        record = cls(prompt_tokens=prompt, completion_tokens=completion,
+                     total_tokens=_field(usage, "total_tokens") or prompt + completion)
+
+        # DeepSeek上下文缓存命中情况；OpenAI兼容接口放在prompt_tokens_details.cached_tokens
+        hit = _field(usage, "prompt_cache_hit_tokens")
+        if hit is None:
+            hit = _field(_field(usage, "prompt_tokens_details"), "cached_tokens")
+        if hit is None:
+            hit = _field(usage, "cache_read_input_tokens")
+        record.prompt_cache_hit_tokens = hit or 0
+        miss = _field(usage, "prompt_cache_miss_tokens")
+        record.prompt_cache_miss_tokens = miss if miss is not None else max(prompt - record.prompt_cache_hit_tokens, 0)
+
+        record.reasoning_tokens = _field(_field(usage, "completion_tokens_details"), "reasoning_tokens") or 0
+        return record
+
+    def merge(self, other: Optional["ServerUsage"]) -> "ServerUsage":
+        """合并分多次到达的用量（如Anthropic流式的开始/结束事件），取各字段较大值"""
+        if other is None:
+            return self
+        merged = ServerUsage(**{k: max(v, getattr(other, k)) for k, v in asdict(self).items()})
+        merged.total_tokens = max(merged.total_tokens, merged.prompt_tokens + merged.completion_tokens)
+        return merged
+
+    def __add__(self, other: "ServerUsage") -> "ServerUsage":
+        """累加两次请求的用量"""
+        return ServerUsage(**{k: v + getattr(other, k) for k, v in asdict(self).items()})
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class AttemptUsage:
+    """一次对话请求内各次尝试（重试、前缀续写、从头重新生成）的用量
+
+    服务端只在每次尝试自己的流末尾返回该次用量，中途断开的尝试没有用量数据，
+    但已生成的内容同样计费，按本次发送的输入和已收到的输出估算后计入。
+    """
+
+    def __init__(self):
+        self.parts: List[Tuple[ServerUsage, bool]] = []  # (用量, 是否为估算)
+
+    def add(self, server_usage: Optional[ServerUsage], prompt_tokens: int, completion_tokens: int,
+            reasoning_tokens: int = 0) -> int:
+        """记录一次结束的尝试，返回其消耗的token数；既没有服务端用量也没有收到内容的尝试（如连接失败）不计入"""
+        if server_usage is not None:
+            self.parts.append((server_usage, False))
+            return server_usage.total_tokens
+        if completion_tokens > 0:
+            self.parts.append((ServerUsage(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                           total_tokens=prompt_tokens + completion_tokens,
+                                           reasoning_tokens=reasoning_tokens), True))
+            return prompt_tokens + completion_tokens
+        return 0
+
+    @property
+    def attempts(self) -> int:
+        return len(self.parts)
+
+    def total(self) -> Tuple[Optional[ServerUsage], str]:
+        """(合计用量, 来源)：来源为server（全部来自服务端）或mixed（含估算部分）
+
+        只有一次估算的尝试时返回(None, "")，由调用方按单次请求估算（可应用校准）。
+        """
+        if not self.parts or (len(self.parts) == 1 and self.parts[0][1]):
+            return None, ""
+        usage = self.parts[0][0]
+        for part, _ in self.parts[1:]:
+            usage = usage + part
+        return usage, "mixed" if any(estimated for _, estimated in self.parts) else "server"
+
+
+def _solve(matrix: List[List[float]], vector: List[float]) -> List[float]:
+    """高斯消元（部分主元）求解小型线性方程组"""
+    n = len(vector)
+    a = [row[:] + [vector[i]] for i, row in enumerate(matrix)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(a[r][col]))
+        if abs(a[pivot][col]) < 1e-12:
+            raise ValueError("矩阵奇异")
+        a[col], a[pivot] = a[pivot], a[col]
+        for r in range(col + 1, n):
+            factor = a[r][col] / a[col][col]
+            for c in range(col, n + 1):
+                a[r][c] -= factor * a[col][c]
+    result = [0.0] * n
+    for r in range(n - 1, -1, -1):
+        result[r] = (a[r][n] - sum(a[r][c] * result[c] for c in range(r + 1, n))) / a[r][r]
+    return result
+
+
+class LinearCalibration:
+    """带指数遗忘的岭回归：actual ≈ scale * estimate + per_message * messages + per_request
+
+    系数向先验（1, 0, 0）收缩，样本少时保持原估算，样本增多后逐步贴合服务端数据。
+    """
+
+    PRIOR = [1.0, 0.0, 0.0]
+    # 先验强度，约相当于5次含5条消息的请求；单条样本不足以把偏差全部归到固定开销上
+    PRIOR_WEIGHT = [1.0, 125.0, 5.0]
+
+    def __init__(self, decay=0.97, shrinkage=0.05):
+        self.decay = decay
+        self.shrinkage = shrinkage
+        self.xtx = [[0.0] * 3 for _ in range(3)]
+        self.xty = [0.0] * 3
+        self.coefficients = list(self.PRIOR)
+        self.samples = 0
+        # 漂移统计：校准后预测的相对误差（有符号均值与绝对值均值），以及未校准估算的偏差
+        self.bias = 0.0
+        self.abs_error = 0.0
+        self.raw_bias = 0.0
+        self.last_error = 0.0
+
+    def predict(self, estimate: float, messages: int = 1) -> int:
+        scale, per_message, per_request = self.coefficients
+        return max(int(round(scale * estimate + per_message * messages + per_request)), 0)
+
+    def update(self, estimate: float, messages: int, actual: int) -> float:
+        """加入一条样本并重新拟合，返回更新前预测的相对误差"""
+        if actual <= 0:
+            return 0.0
+
+        error = (self.predict(estimate, messages) - actual) / actual
+        raw_error = (estimate - actual) / actual
+        alpha = 1.0 if self.samples == 0 else 1 - self.decay
+        self.bias += alpha * (error - self.bias)
+        self.abs_error += alpha * (abs(error) - self.abs_error)
+        self.raw_bias += alpha * (raw_error - self.raw_bias)
+        self.last_error = error
+        self.samples += 1
+
+        x = [float(estimate), float(messages), 1.0]
+        for i in range(3):
+            self.xty[i] = self.decay * self.xty[i] + x[i] * actual
+            for j in range(3):
+                self.xtx[i][j] = self.decay * self.xtx[i][j] + x[i] * x[j]
+
+        # 按特征能量比例收缩到先验，另加固定先验强度保证方程可解
+        matrix = [row[:] for row in self.xtx]
+        vector = self.xty[:]
+        for i in range(3):
+            ridge = self.shrinkage * self.xtx[i][i] + self.PRIOR_WEIGHT[i]
+            matrix[i][i] += ridge
+            vector[i] += ridge * self.PRIOR[i]
+        try:
+            self.coefficients = _solve(matrix, vector)
+        except ValueError:
+            pass
+        return error
+
+    def stats(self) -> dict:
+        scale, per_message, per_request = self.coefficients
+        return {
+            "samples": self.samples,
+            "scale": scale,
+            "per_message": per_message,
+            "per_request": per_request,
+            "bias": self.bias,
+            "abs_error": self.abs_error,
+            "raw_bias": self.raw_bias,
+            "last_error": self.last_error
+        }
+
+    def to_dict(self) -> dict:
+        return {"xtx": self.xtx, "xty": self.xty, "coefficients": self.coefficients,
+                "samples": self.samples, "bias": self.bias, "abs_error": self.abs_error,
+                "raw_bias": self.raw_bias, "last_error": self.last_error}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "LinearCalibration":
+        calibration = cls()
+        for key, value in data.items():
+            if hasattr(calibration, key):
+                setattr(calibration, key, value)
+        return calibration
+
+
+class UsageCalibrator:
+    """按模型分别校准输入/输出token估算"""
+
+    def __init__(self):
+        self.models: Dict[str, Dict[str, LinearCalibration]] = {}
+
+    def _get(self, model: str, kind: str) -> LinearCalibration:
+        calibrations = self.models.setdefault(model, {})
+        if kind not in calibrations:
+            calibrations[kind] = LinearCalibration()
+        return calibrations[kind]
+
+    def calibrate(self, model: str, kind: str, estimate: int, messages: int = 1) -> int:
+        """返回校准后的估算值"""
+        calibration = self.models.get(model, {}).get(kind)
+        if calibration is None or calibration.samples == 0:
+            return estimate
+        return calibration.predict(estimate, messages)
+
+    def update(self, model: str, estimated: dict, usage: ServerUsage):
+        """用一次请求的估算值和服务端用量更新该模型的系数"""
+        if usage.prompt_tokens and estimated.get("prompt_tokens"):
+            self._get(model, "prompt").update(estimated["prompt_tokens"],
+                                              estimated.get("message_count", 1),
+                                              usage.prompt_tokens)
+        if usage.completion_tokens and estimated.get("completion_tokens"):
+            self._get(model, "completion").update(estimated["completion_tokens"], 1,
+                                                  usage.completion_tokens)
+
+    def stats(self, model: str = None) -> dict:
+        """漂移统计，model为空时返回全部模型"""
+        if model is not None:
+            return {kind: c.stats() for kind, c in self.models.get(model, {}).items()}
+        return {m: {kind: c.stats() for kind, c in kinds.items()} for m, kinds in self.models.items()}
+
+    def describe(self, model: str) -> str:
+        """生成用于界面提示的校准摘要"""
+        lines = []
+        for kind, label in (("prompt", "输入"), ("completion", "输出")):
+            calibration = self.models.get(model, {}).get(kind)
+            if calibration is None or calibration.samples == 0:
+                continue
+            s = calibration.stats()
+            lines.append(f"{label}: 样本{s['samples']}，系数×{s['scale']:.3f}，"
+                         f"校准后误差{s['abs_error']:.1%}（偏差{s['bias']:+.1%}），"
+                         f"原始估算偏差{s['raw_bias']:+.1%}")
+        return f"{model} 估算校准\n" + "\n".join(lines) if lines else f"{model} 暂无校准数据"
+
+    def to_dict(self) -> dict:
+        return {model: {kind: c.to_dict() for kind, c in kinds.items()}
+                for model, kinds in self.models.items()}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "UsageCalibrator":
+        calibrator = cls()
+        for model, kinds in (data or {}).items():
+            calibrator.models[model] = {kind: LinearCalibration.from_dict(c) for kind, c in kinds.items()}
+        return calibrator
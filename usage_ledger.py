@@ -0,0 +1,259 @@
+import sqlite3
+import threading
+from dataclasses import dataclass, asdict
+from datetime import date, datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from .usage_calibration import ServerUsage
+
+
+@dataclass
+class ModelPrice:
+    """模型单价（每百万token）"""
+    input: float
+    output: float
+    cache_hit: Optional[float] = None  # 缓存命中的输入单价，为空时按普通输入计费
+    currency: str = "USD"
+
+    def cost(self, usage: ServerUsage) -> float:
+        hit = usage.prompt_cache_hit_tokens
+        miss = usage.prompt_tokens - hit
+        hit_price = self.input if self.cache_hit is None else self.cache_hit
+        return (hit * hit_price + miss * self.input + usage.completion_tokens * self.output) / 1_000_000
+
+
+# 内置价格表，按模型名前缀匹配（最长前缀优先）；推理token已包含在输出token中
+DEFAULT_PRICES = {
+    "deepseek-chat": ModelPrice(input=2.0, output=3.0, cache_hit=0.2, currency="CNY"),
+    "deepseek-reasoner": ModelPrice(input=2.0, output=3.0, cache_hit=0.2, currency="CNY"),
+    "gpt-4o-mini": ModelPrice(input=0.15, output=0.6, cache_hit=0.075),
+    "gpt-4o": ModelPrice(input=2.5, output=10.0, cache_hit=1.25),
+    "gpt-4.1-mini": ModelPrice(input=0.4, output=1.6, cache_hit=0.1),
+    "gpt-4.1": ModelPrice(input=2.0, output=8.0, cache_hit=0.5),
+    "claude-3-5-haiku": ModelPrice(input=0.8, output=4.0, cache_hit=0.08),
+    "claude-3-5-sonnet": ModelPrice(input=3.0, output=15.0, cache_hit=0.3),
+    "claude-3-7-sonnet": ModelPrice(input=3.0, output=15.0, cache_hit=0.3),
+    "claude-sonnet-4": ModelPrice(input=3.0, output=15.0, cache_hit=0.3),
+}
+
+
+class PriceTable:
+    """模型价格表，支持用户覆盖内置价格"""
+
+    def __init__(self, overrides: Optional[Dict[str, dict]] = None):
+        self.prices: Dict[str, ModelPrice] = dict(DEFAULT_PRICES)
+        for model, price in (overrides or {}).items():
+            self.prices[model] = ModelPrice(**price)
+
+    def lookup(self, model: str) -> Optional[ModelPrice]:
+        """按最长前缀查找模型单价，未知模型（如本地Ollama模型）返回None"""
+        if not model:
+            return None
+        if model in self.prices:
+            return self.prices[model]
+        matches = [name for name in self.prices if model.startswith(name)]
+        return self.prices[max(matches, key=len)] if matches else None
+
+    def cost(self, model: str, usage: ServerUsage):
+        """返回(费用, 币种)，未知模型为(0.0, "")"""
+        price = self.lookup(model)
+        if price is None:
+            return 0.0, ""
+        return price.cost(usage), price.currency
+
+    def to_dict(self) -> dict:
+        return {model: asdict(price) for model, price in self.prices.items()}
+
+
+def format_costs(costs: Dict[str, float]) -> str:
+    """格式化按币种汇总的费用"""
+    symbols = {"CNY": "¥", "USD": "$"}
+    parts = [f"{symbols.get(currency, currency + ' ')}{amount:.4f}"
+             for currency, amount in sorted(costs.items()) if currency]
+    return " + ".join(parts) if parts else "0"
+
+
+def summarize_messages(messages: List[dict], prices: PriceTable) -> dict:
+    """根据话题消息中保存的用量元数据汇总该话题的token与费用"""
+    totals = {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0,
+              "prompt_cache_hit_tokens": 0, "total_tokens": 0, "costs": {}}
+    for message in messages:
+        metadata = message.get("metadata") or {}
+        usage = ServerUsage.from_usage(metadata.get("usage"))
+        if usage is None:
+            continue
+        totals["requests"] += 1
+        totals["prompt_tokens"] += usage.prompt_tokens
+        totals["completion_tokens"] += usage.completion_tokens
+        totals["prompt_cache_hit_tokens"] += usage.prompt_cache_hit_tokens
+        totals["total_tokens"] += usage.prompt_tokens + usage.completion_tokens
+        cost, currency = prices.cost(metadata.get("model", ""), usage)
+        totals["costs"][currency] = totals["costs"].get(currency, 0.0) + cost
+    return totals
+
+
+_TOKEN_COLUMNS = ("prompt_tokens", "cache_hit_tokens", "cache_miss_tokens",
+                  "completion_tokens", "reasoning_tokens")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage_records (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT NOT NULL,
+    day TEXT NOT NULL,
+    model TEXT NOT NULL,
+    provider TEXT NOT NULL DEFAULT '',
+    assistant_id TEXT NOT NULL DEFAULT '',
+    topic_id TEXT NOT NULL DEFAULT '',
+    source TEXT NOT NULL DEFAULT 'server',
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    cache_hit_tokens INTEGER NOT NULL DEFAULT 0,
+    cache_miss_tokens INTEGER NOT NULL DEFAULT 0,
+    completion_tokens INTEGER NOT NULL DEFAULT 0,
+    reasoning_tokens INTEGER NOT NULL DEFAULT 0,
+    cost REAL NOT NULL DEFAULT 0,
+    currency TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_usage_records_topic ON usage_records(topic_id);
+
+CREATE TABLE IF NOT EXISTS usage_rollups (
+    day TEXT NOT NULL,
+    model TEXT NOT NULL,
+    assistant_id TEXT NOT NULL,
+    topic_id TEXT NOT NULL,
+    currency TEXT NOT NULL DEFAULT '',
+    requests INTEGER NOT NULL DEFAULT 0,
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    cache_hit_tokens INTEGER NOT NULL DEFAULT 0,
+    cache_miss_tokens INTEGER NOT NULL DEFAULT 0,
+    completion_tokens INTEGER NOT NULL DEFAULT 0,
+    reasoning_tokens INTEGER NOT NULL DEFAULT 0,
+    cost REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, model, assistant_id, topic_id)
+);
+"""
+
+GROUP_COLUMNS = ("day", "model", "assistant_id", "topic_id")
+
+
+class UsageLedger:
+    """持久化的逐请求用量账本
+
+    每次请求写入一条明细，同一事务内累加到按（日期, 模型, 助手, 话题）聚合的汇总表；
+    按月、按模型等统计只扫描汇总表，行数与天数×组合数成正比，与请求次数无关。
+    """
+
+    def __init__(self, path, prices: Optional[PriceTable] = None):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.prices = prices or PriceTable()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._conn:
+            self._conn.executescript(_SCHEMA)
+
+    def record(self, model: str, usage: ServerUsage, source: str = "server",
+               topic_id: str = "", assistant_id: str = "", provider: str = "",
+               timestamp: Optional[datetime] = None) -> dict:
+        """记录一次请求的用量，返回包含费用的明细"""
+        timestamp = timestamp or datetime.now()
+        cost, currency = self.prices.cost(model, usage)
+        row = {
+            "timestamp": timestamp.isoformat(),
+            "day": timestamp.date().isoformat(),
+            "model": model or "",
+            "provider": provider or "",
+            "assistant_id": assistant_id or "",
+            "topic_id": topic_id or "",
+            "source": source,
+            "prompt_tokens": usage.prompt_tokens,
+            "cache_hit_tokens": usage.prompt_cache_hit_tokens,
+            "cache_miss_tokens": max(usage.prompt_tokens - usage.prompt_cache_hit_tokens, 0),
+            "completion_tokens": usage.completion_tokens,
+            "reasoning_tokens": usage.reasoning_tokens,
+            "cost": cost,
+            "currency": currency,
+        }
+
+        columns = ", ".join(row)
+        placeholders = ", ".join(f":{name}" for name in row)
+        rollup_columns = GROUP_COLUMNS + ("currency",) + _TOKEN_COLUMNS + ("cost",)
+        updates = ", ".join(f"{name} = {name} + excluded.{name}" for name in _TOKEN_COLUMNS + ("cost",))
+        with self._lock, self._conn:
+            self._conn.execute(f"INSERT INTO usage_records ({columns}) VALUES ({placeholders})", row)
+            self._conn.execute(
+                f"INSERT INTO usage_rollups ({', '.join(rollup_columns)}, requests) "
+                f"VALUES ({', '.join(':' + name for name in rollup_columns)}, 1) "
+                f"ON CONFLICT (day, model, assistant_id, topic_id) DO UPDATE SET "
+                f"requests = requests + 1, currency = excluded.currency, {updates}",
+                row)
+        return row
+
+    def _query_rollups(self, group_by, start, end, filters):
+        where = []
+        params = {}
+        if start is not None:
+            where.append("day >= :start")
+            params["start"] = _day(start)
+        if end is not None:
+            where.append("day <= :end")
+            params["end"] = _day(end)
+        for name, value in filters.items():
+            if name not in GROUP_COLUMNS:
+                raise ValueError(f"不支持的筛选字段: {name}")
+            if value is not None:
+                where.append(f"{name} = :{name}")
+                params[name] = value
+
+        keys = list(group_by) + ["currency"]
+        sums = ", ".join(f"SUM({name}) AS {name}" for name in ("requests",) + _TOKEN_COLUMNS + ("cost",))
+        sql = f"SELECT {', '.join(keys)}, {sums} FROM usage_rollups"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" GROUP BY {', '.join(keys)} ORDER BY {', '.join(keys)}"
+        with self._lock:
+            return [dict(r) for r in self._conn.execute(sql, params)]
+
+    def summary(self, start=None, end=None, **filters) -> dict:
+        """汇总区间[start, end]内的用量，可按model、assistant_id、topic_id、day筛选"""
+        totals = {"requests": 0, **{name: 0 for name in _TOKEN_COLUMNS}, "costs": {}}
+        for row in self._query_rollups((), start, end, filters):
+            for name in ("requests",) + _TOKEN_COLUMNS:
+                totals[name] += row[name] or 0
+            totals["costs"][row["currency"]] = totals["costs"].get(row["currency"], 0.0) + (row["cost"] or 0.0)
+        return totals
+
+    def breakdown(self, group_by: str, start=None, end=None, **filters) -> List[dict]:
+        """按day、model、assistant_id或topic_id分组统计"""
+        if group_by not in GROUP_COLUMNS:
+            raise ValueError(f"不支持的分组字段: {group_by}")
+        return self._query_rollups((group_by,), start, end, filters)
+
+    def month_summary(self, day=None) -> dict:
+        """所在自然月至今的用量"""
+        day = _day(day or date.today())
+        return self.summary(start=day[:8] + "01", end=day)
+
+    def records(self, limit: int = 100, **filters) -> List[dict]:
+        """最近的请求明细"""
+        where = " AND ".join(f"{name} = :{name}" for name in filters if name in GROUP_COLUMNS)
+        sql = "SELECT * FROM usage_records"
+        if where:
+            sql += " WHERE " + where
+        sql += " ORDER BY id DESC LIMIT :limit"
+        with self._lock:
+            return [dict(r) for r in self._conn.execute(sql, {**filters, "limit": limit})]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _day(value) -> str:
+    """把date/datetime/字符串统一为YYYY-MM-DD"""
+    if isinstance(value, datetime):
+        return value.date().isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value)[:10]